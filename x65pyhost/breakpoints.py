@@ -0,0 +1,451 @@
+import time
+import numpy as np
+from icd import ICD
+from cpumem import CpuMemMap
+from cpuregs import CpuRegs
+from tracecap import TraceCapture
+from tracearr import TRACE_DTYPE
+
+# Breakpoints and watchpoints: run the CPU program to a breakpoint at (nearly) the full speed,
+# instead of single-stepping it from the host.
+# NORA has no hardware breakpoints (the ICD commands 0x4 and 0x5 are not implemented in icd_controller.v), so:
+#   - Software breakpoints: while the CPU runs, the opcode at the breakpoint is replaced by COP (65C816)
+#     or BRK (65C02), written to the memory by the ICD (sram_blockwrite, see CpuMemMap.write()).
+#     The COP/BRK vector is redirected to a small trap routine, which stops the CPU by the CPUSTOP bit
+#     of SYSCTRL ($9F54). The host polls the ICD status until the CPU stops, and checks in the sampled
+#     trace register that it stands in the trap. Then all the patched bytes are restored, the trace buffer
+#     is drained (NORA keeps the last cycles while the CPU runs), and the registers saved on the stack
+#     by COP/BRK and by the trap are written back (CpuRegs.cpu_write_regs): the CPU stands at the breakpoint,
+#     as if the breakpoint had never been there.
+#   - Conditional breakpoints: the condition is a function of the registers, evaluated by the host at the hit;
+#     if false, the CPU continues.
+#   - Data watchpoints (reads/writes of an address range, optionally of a value) cannot be caught
+#     at the full speed: the CPU is stepped in batches (see TraceCapture) and the host looks up the accesses
+#     in the trace. The software breakpoints work the same in this mode.
+# While the breakpoints are active the COP instruction of the 65C816 is reserved for them
+# (a COP of the program is reported as a hit without a breakpoint). The 65C02 shares the BRK vector with IRQ,
+# the trap passes the IRQs to the original vector.
+
+# A software breakpoint
+class Breakpoint:
+    # addr: 24-bit CPU address of the instruction
+    # cond: optional function(CpuRegs) -> bool, evaluated at the hit; False => continue
+    def __init__(self, addr, cond=None):
+        self.addr = addr
+        self.cond = cond
+        self.hits = 0
+
+    def __repr__(self):
+        return "Breakpoint(${:06X}{})".format(self.addr, ", conditional" if self.cond is not None else "")
+
+
+# A data watchpoint: the accesses to the CPU addresses [lo, hi)
+class Watchpoint:
+    READ = 1
+    WRITE = 2
+
+    # access: READ, WRITE or both
+    # value: optional byte value of the access
+    def __init__(self, lo, hi, access=READ|WRITE, value=None):
+        self.lo = lo
+        self.hi = hi
+        self.access = access
+        self.value = value
+        self.hits = 0
+
+    def __repr__(self):
+        return "Watchpoint(${:06X}-${:06X}, {}{})".format(self.lo, self.hi - 1,
+                    ('r' if self.access & Watchpoint.READ else '') + ('w' if self.access & Watchpoint.WRITE else ''),
+                    ", =${:02X}".format(self.value) if self.value is not None else "")
+
+    # The matching cycles of the trace records (TRACE_DTYPE array); the data accesses are
+    # the VDA cycles without VPA (the opcode fetch of the 65C02, the opcode and operands of the 65C816)
+    def match(self, arr):
+        sta = arr['sta']
+        addr = (arr['CBA'].astype(np.uint32) << 16) | arr['CA']
+        m = ((sta & ICD.TRACE_FLAG_VDA) != 0) & ((sta & ICD.TRACE_FLAG_SYNC_VPA) == 0) & (addr >= self.lo) & (addr < self.hi)
+        rd = (sta & ICD.TRACE_FLAG_RWN) != 0
+        if not (self.access & Watchpoint.READ):
+            m &= ~rd
+        if not (self.access & Watchpoint.WRITE):
+            m &= rd
+        if self.value is not None:
+            m &= arr['CD'] == self.value
+        return m
+
+
+# The result of Breakpoints.run()
+class Hit:
+    BREAK = 'break'             # a software breakpoint (or a COP/BRK of the program itself: point is None)
+    WATCH = 'watch'             # a watchpoint
+    STOP = 'stop'               # the CPU was stopped otherwise, e.g. by the program via SYSCTRL
+
+    def __init__(self, kind, point, regs, history, access=None):
+        self.kind = kind
+        self.point = point          # Breakpoint or Watchpoint
+        self.regs = regs            # CpuRegs at the hit; a watchpoint: at the end of the stepped batch
+        self.history = history      # packed 7-byte trace records up to the hit, the oldest first
+        self.access = access        # watchpoint: ICD.TraceReg of the access
+
+
+# The last n trace records; a sink of TraceCapture.capture()
+class _TraceTail:
+    def __init__(self, n):
+        self.size = n * ICD.TRACEREC_SIZE
+        self.recs = bytearray()
+
+    def append(self, recs):
+        self.recs += recs
+        del self.recs[:-self.size]
+
+
+class Breakpoints:
+    SYSCTRL = 0x54                  # NORA SYSCTRL register, IO offset
+    SYSCTRL_UNLOCK = 0x80
+    SYSCTRL_CPUSTOP = 0x02
+    SYSCTRL_ABRT02 = 0x40           # each unlocked write sets it, the trap keeps its value
+
+    TRAP_ADDR = 0x07E0              # default trap location in the bank 0: the top of the CX16 "golden RAM" $0400-$07FF
+    POLL_INTERVAL = 0.02            # [s] of the status polling while the CPU runs
+    STEP_CYCLES_MAX = 32            # cycles to reach the start of the next instruction
+    HISTORY = ICD.TRACEBUF_DEPTH    # cycles kept before a hit in the stepping mode
+
+    # COP vectors of the 65C816 (native, emulation), BRK/IRQ vector of the 65C02
+    VECTORS_816 = [ 0xFFE4, 0xFFF4 ]
+    VECTORS_02 = [ 0xFFFE ]
+    OPC_COP = 0x02
+    OPC_BRK = 0x00
+
+    # icd: ICD object
+    # trap_addr: CPU address in the bank 0 of the trap routine (32 bytes at most); the memory is restored after the run
+    # batch_steps: CPU cycles stepped per ICD batch in the stepping mode (with watchpoints)
+    def __init__(self, icd, trap_addr=TRAP_ADDR, batch_steps=256):
+        self.icd = icd
+        self.trap_addr = trap_addr
+        self.batch_steps = batch_steps
+        self.is02 = icd.is_cputype02()
+        self.breakpoints = []
+        self.watchpoints = []
+        self.saved = None           # (CpuMemMap, [(addr, vp, original bytes)]) while the patches are in the memory
+        # the trap routine ends by BRA * at this address
+        self.trap_stop = trap_addr + len(self.trap_code(0)) - 2
+
+    def add(self, point):
+        (self.watchpoints if isinstance(point, Watchpoint) else self.breakpoints).append(point)
+
+    def remove(self, point):
+        (self.watchpoints if isinstance(point, Watchpoint) else self.breakpoints).remove(point)
+
+    # Machine code of the trap routine; the CPU stops at its final BRA *.
+    # irq_vector: the original BRK/IRQ vector of the 65C02
+    def trap_code(self, irq_vector):
+        if self.is02:
+            # entered by BRK or IRQ: the stack is X, A, P, PCL, PCH
+            return bytes([
+                0x48,                       # PHA
+                0xDA,                       # PHX
+                0xBA,                       # TSX
+                0xBD, 0x03, 0x01,           # LDA $0103,X       P pushed by BRK/IRQ
+                0x29, 0x10,                 # AND #$10          B flag
+                0xD0, 0x05,                 # BNE stop
+                0xFA,                       # PLX
+                0x68,                       # PLA
+                0x4C, irq_vector & 0xFF, irq_vector >> 8,   # JMP irq_vector
+                0xA9, Breakpoints.SYSCTRL_UNLOCK,           # stop: LDA #$80
+                0x8D, Breakpoints.SYSCTRL, 0x9F,            # STA SYSCTRL
+                0xAD, Breakpoints.SYSCTRL, 0x9F,            # LDA SYSCTRL
+                0x29, Breakpoints.SYSCTRL_ABRT02,           # AND #$40          keep ABRT02
+                0x09, Breakpoints.SYSCTRL_CPUSTOP,          # ORA #$02
+                0x8D, Breakpoints.SYSCTRL, 0x9F,            # STA SYSCTRL
+                0x80, 0xFE,                 # BRA *
+            ])
+        else:
+            # entered by COP: the stack is P', A (8 or 16-bit by M in P'), P, PCL, PCH, PBR (native)
+            return bytes([
+                0x48,                       # PHA
+                0x08,                       # PHP
+                0xE2, 0x20,                 # SEP #$20
+                0xA9, Breakpoints.SYSCTRL_UNLOCK,           # LDA #$80
+                0x8F, Breakpoints.SYSCTRL, 0x9F, 0x00,      # STA $00:SYSCTRL
+                0xAF, Breakpoints.SYSCTRL, 0x9F, 0x00,      # LDA $00:SYSCTRL
+                0x29, Breakpoints.SYSCTRL_ABRT02,           # AND #$40          keep ABRT02
+                0x09, Breakpoints.SYSCTRL_CPUSTOP,          # ORA #$02
+                0x8F, Breakpoints.SYSCTRL, 0x9F, 0x00,      # STA $00:SYSCTRL
+                0x80, 0xFE,                 # BRA *
+            ])
+
+    # Write the trap routine, the vectors and the breakpoint opcodes into the memory, saving the originals
+    def insert(self):
+        icd = self.icd
+        mm = CpuMemMap.from_hw(icd)
+        vectors = Breakpoints.VECTORS_02 if self.is02 else Breakpoints.VECTORS_816
+        n_trap = self.trap_stop + 2 - self.trap_addr
+        places = [ (self.trap_addr, False, n_trap) ] + [ (v, True, 2) for v in vectors ] \
+                    + [ (bp.addr, False, 1) for bp in self.breakpoints ]
+        with icd.batch():
+            reads = [ mm.read(icd, addr, n, vp) for (addr, vp, n) in places ]
+        saved = [ (addr, vp, bytes(rd.result())) for ((addr, vp, n), rd) in zip(places, reads) ]
+        irq_vector = saved[1][2][0] | (saved[1][2][1] << 8)
+        opc = Breakpoints.OPC_BRK if self.is02 else Breakpoints.OPC_COP
+        with icd.batch():
+            mm.write(icd, self.trap_addr, self.trap_code(irq_vector))
+            for v in vectors:
+                mm.write(icd, v, bytes([ self.trap_addr & 0xFF, (self.trap_addr >> 8) & 0xFF ]), True)
+            for bp in self.breakpoints:
+                mm.write(icd, bp.addr, bytes([ opc ]))
+        self.saved = (mm, saved)
+
+    # Restore the memory patched by insert(); in the reverse order, the same byte could be saved twice
+    def restore(self):
+        if self.saved is None:
+            return
+        (mm, saved) = self.saved
+        with self.icd.batch():
+            for (addr, vp, data) in reversed(saved):
+                mm.write(self.icd, addr, data, vp)
+        self.saved = None
+
+    # Read the trace register and the trace buffer of the stopped CPU; packed records, the oldest first
+    def read_history(self):
+        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace()
+        hist = self.icd.drain_tracebuffer() if is_tbr_valid else b''
+        if is_valid:
+            hist += bytes(rawbuf[0:ICD.TRACEREC_SIZE])
+        return hist
+
+    # Sample the state of the stopped CPU: ICD.TraceReg of the upcoming cycle
+    def sample(self):
+        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace(sample_cpu=True)
+        return ICD.TraceReg(rawbuf)
+
+    # Step the stopped CPU cycle by cycle, until the next cycle starts an instruction.
+    # min_steps: cycles stepped at least, e.g. 1 to complete the current instruction
+    # Returns the packed trace records of the stepped cycles, or None on an error.
+    def step_to_sync(self, min_steps=0):
+        icd = self.icd
+        recs = bytearray()
+        for i in range(0, Breakpoints.STEP_CYCLES_MAX):
+            if i >= min_steps:
+                is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = icd.cpu_read_trace(sample_cpu=True)
+                if is_cpuruns:
+                    print("ERROR: the CPU is running, it must be stopped!")
+                    return None
+                if ICD.TraceReg(rawbuf).is_sync:
+                    return bytes(recs)
+            icd.cpu_ctrl(False, True, False)
+            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = icd.cpu_read_trace()
+            if is_valid:
+                recs += rawbuf[0:ICD.TRACEREC_SIZE]
+        print("ERROR: {} CPU cycles without a new instruction! Is CPU stopped?".format(Breakpoints.STEP_CYCLES_MAX))
+        return None
+
+    # Read n bytes of the stack above SP, in the bank 0
+    def _read_stack(self, mm, SP, is_emu, n):
+        addrs = [ (0x100 | ((SP + i) & 0xFF)) if is_emu else ((SP + i) & 0xFFFF) for i in range(1, n + 1) ]
+        with self.icd.batch():
+            data = ICD.concat([ mm.read(self.icd, a, 1) for a in addrs ])
+        return data.result()
+
+    # The CPU stands in the trap: restore the registers of the program at the COP/BRK.
+    # Returns (CpuRegs read back, the breakpoint or None), or None on an error.
+    def _leave_trap(self):
+        icd = self.icd
+        regs = CpuRegs()
+        if not regs.cpu_read_regs(icd):
+            return None
+        mm = CpuMemMap.from_hw(icd)
+        prog = CpuRegs()
+        is_emu = self.is02 or bool(regs.EMU)
+        if self.is02:
+            st = self._read_stack(mm, regs.SP, True, 5)
+            (prog.XL, prog.AL, prog.FL) = (st[0], st[1], st[2])
+            (ret, bank, n) = (st[3] | (st[4] << 8), None, 5)
+        else:
+            st = self._read_stack(mm, regs.SP, is_emu, 8)
+            # the A pushed by the trap is 16-bit when M was 0 before the SEP #$20
+            k = 1 if is_emu or (st[0] & 0x20) else 2
+            (prog.AL, prog.FL) = (st[1], st[1 + k])
+            ret = st[2 + k] | (st[3 + k] << 8)
+            (bank, n) = (None, 4 + k) if is_emu else (st[4 + k], 5 + k)
+        prog.SP = (0x100 | ((regs.SP + n) & 0xFF)) if is_emu else ((regs.SP + n) & 0xFFFF)
+        # COP/BRK push the address of the instruction + 2
+        CA = (ret - 2) & 0xFFFF
+        bp = None
+        for b in self.breakpoints:
+            if (b.addr & 0xFFFF) == CA and (bank is None or (b.addr >> 16) == bank):
+                bp = b
+                break
+        prog.PC = bp.addr if bp is not None else ((bank or 0) << 16) | CA
+        if not regs.cpu_write_regs(icd, prog):
+            return None
+        return (regs, bp)
+
+    # Drop the cycles of COP/BRK and of the trap from the end of the history
+    def _trim_history(self, hist, PC):
+        opc = Breakpoints.OPC_BRK if self.is02 else Breakpoints.OPC_COP
+        for i in reversed(range(0, len(hist) // ICD.TRACEREC_SIZE)):
+            tbuf = ICD.TraceReg(hist[i * ICD.TRACEREC_SIZE:(i + 1) * ICD.TRACEREC_SIZE])
+            if tbuf.is_sync and tbuf.CD == opc and tbuf.CA == (PC & 0xFFFF):
+                return hist[0:i * ICD.TRACEREC_SIZE]
+        return hist
+
+    # The CPU has stopped: find out why, restore the memory and the program state.
+    # hist: the trace before the stop
+    # Returns Hit, or None if the CPU was stopped because of the timeout (or on an error).
+    def _stopped(self, hist, is_timeout):
+        n_trap = self.trap_stop + 2 - self.trap_addr
+        in_trap = lambda tbuf: tbuf.CBA == 0 and self.trap_addr <= tbuf.CA < self.trap_addr + n_trap
+        is_trap_stop = False
+        if in_trap(self.sample()):
+            # in the trap; it could have been stopped by the timeout before its end: complete it.
+            # The 65C02 could leave it instead, by the IRQ pass-through to the original vector.
+            if self.step_to_sync() is None:
+                return None
+            for i in range(0, n_trap):
+                tbuf = self.sample()
+                if tbuf.CBA == 0 and tbuf.CA == self.trap_stop:
+                    is_trap_stop = True
+                    break
+                if not in_trap(tbuf):
+                    break
+                if self.step_to_sync(1) is None:
+                    return None
+
+        if is_trap_stop:
+            self.restore()
+            r = self._leave_trap()
+            if r is None:
+                return None
+            (regs, bp) = r
+            return Hit(Hit.BREAK, bp, regs, self._trim_history(hist, regs.PC))
+
+        self.restore()
+        if self.step_to_sync() is None:
+            return None
+        if is_timeout:
+            return None
+        regs = CpuRegs()
+        if not regs.cpu_read_regs(self.icd):
+            return None
+        return Hit(Hit.STOP, None, regs, hist)
+
+    # Run the CPU at the full speed until it stops in the trap.
+    def _run_full(self, timeout, interrupt):
+        icd = self.icd
+        self.insert()
+        with icd.batch():
+            icd.cpu_read_trace(tbr_clear=True)
+            icd.cpu_ctrl(True, False, False)
+        t0 = time.monotonic()
+        is_timeout = False
+        while True:
+            time.sleep(Breakpoints.POLL_INTERVAL)
+            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = icd.cpu_get_status()
+            if not is_cpuruns:
+                break
+            if (timeout is not None and time.monotonic() - t0 >= timeout) or (interrupt is not None and interrupt()):
+                icd.cpu_ctrl(False, False, False)
+                is_timeout = True
+                break
+        return self._stopped(self.read_history(), is_timeout)
+
+    # Index of the first cycle hitting a watchpoint in the records, or None; sets self.watch_hit
+    def _find_watch(self, arr):
+        first = None
+        for wp in self.watchpoints:
+            m = np.flatnonzero(wp.match(arr))
+            if len(m) > 0 and (first is None or m[0] < first):
+                first = int(m[0])
+                self.watch_hit = (wp, ICD.TraceReg(arr[first].tobytes()))
+        return first
+
+    # Step the CPU in batches and look for the watchpoints and the trap in the trace.
+    # The CPU is stepped up to the end of the batch with the access of a watchpoint.
+    def _run_stepping(self, timeout, progress, interrupt, hist):
+        icd = self.icd
+        cap = TraceCapture(icd, self.batch_steps)
+        tail = _TraceTail(Breakpoints.HISTORY)
+        tail.append(hist)
+        self.watch_hit = None
+
+        def stop_at(arr):
+            sync = (arr['sta'] & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC
+            traps = np.flatnonzero(sync & (arr['CA'] == self.trap_stop) & (arr['CBA'] == 0))
+            t = int(traps[0]) if len(traps) > 0 else None
+            w = self._find_watch(arr[0:t])
+            if w is not None:
+                return w
+            self.watch_hit = None
+            return t
+
+        self.insert()
+        t0 = time.monotonic()
+        n_cycles = 0
+        while True:
+            n = cap.capture(self.batch_steps * 16, tail, until=stop_at)
+            if n is None:
+                self.restore()
+                return None
+            n_cycles += n
+            if progress is not None:
+                progress(n_cycles, time.monotonic() - t0)
+            if cap.stopped_at_until:
+                break
+            if (timeout is not None and time.monotonic() - t0 >= timeout) or (interrupt is not None and interrupt()):
+                break
+        if self.watch_hit is None:
+            return self._stopped(bytes(tail.recs), not cap.stopped_at_until)
+
+        self.restore()
+        if self.step_to_sync() is None:
+            return None
+        regs = CpuRegs()
+        if not regs.cpu_read_regs(icd):
+            return None
+        (wp, access) = self.watch_hit
+        return Hit(Hit.WATCH, wp, regs, bytes(tail.recs), access)
+
+    # Run the CPU until a breakpoint or a watchpoint is hit; the CPU must be stopped.
+    # With watchpoints the CPU is stepped from the host, otherwise it runs at the full speed.
+    # timeout: optional seconds; then the CPU is stopped and None returned
+    # progress: optional function(cycles, elapsed_seconds), called in the stepping mode
+    # interrupt: optional function() -> bool, polled while the CPU runs; True stops it as the timeout
+    # Returns Hit, or None on the timeout or an error; the CPU is left stopped at the start of an instruction.
+    def run(self, timeout=None, progress=None, interrupt=None):
+        icd = self.icd
+        t0 = time.monotonic()
+        if self.step_to_sync() is None:
+            return None
+        while True:
+            regs = CpuRegs()
+            if not regs.cpu_read_regs(icd):
+                return None
+            hist = b''
+            if any(bp.addr == regs.PC for bp in self.breakpoints):
+                # continue from a breakpoint: its instruction first, without the patch
+                hist = self.step_to_sync(1)
+                if hist is None:
+                    return None
+                if len(self.watchpoints) > 0:
+                    arr = np.frombuffer(hist, dtype=TRACE_DTYPE)
+                    if self._find_watch(arr) is not None:
+                        (wp, access) = self.watch_hit
+                        regs = CpuRegs()
+                        if not regs.cpu_read_regs(icd):
+                            return None
+                        wp.hits += 1
+                        return Hit(Hit.WATCH, wp, regs, hist, access)
+            remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - t0))
+            if len(self.watchpoints) > 0:
+                hit = self._run_stepping(remaining, progress, interrupt, hist)
+            else:
+                hit = self._run_full(remaining, interrupt)
+            if hit is None:
+                return None
+            if hit.kind == Hit.BREAK and hit.point is not None and hit.point.cond is not None \
+                    and not hit.point.cond(hit.regs):
+                # the condition is false: continue
+                continue
+            if hit.point is not None:
+                hit.point.hits += 1
+            return hit
@@ -0,0 +1,214 @@
+import numpy as np
+from icd import ICD
+from tracearr import TRACE_DTYPE, TraceArray
+from disasm import opcode_table, FLOW_CALL, FLOW_RETURN, FLOW_INTERRUPT
+
+# Call-graph reconstruction and the inclusive/exclusive cycle profile from a recorded CPU trace.
+# The trace is processed as a stream (see append()), instruction by instruction:
+#   - JSR/JSL push a frame of the callee; the callee is the PC of the next instruction,
+#   - RTS/RTL/RTI pop the frame that was expected to return to the PC of the next instruction,
+#     i.e. the frames left by stack tricks (PLA/PLA/RTS, longjmp) are unwound as well,
+#   - an instruction with vector-pull cycles is an interrupt entry (BRK/COP, or IRQ/NMI/ABORT
+#     taken in place of the fetched instruction); it pushes a frame of the interrupt handler.
+# Each cycle is attributed exclusively to the function on the top of the call stack; the cycles
+# of an interrupt entry belong to the handler. Inclusive cycles of a function count all its frames,
+# except the nested (recursive) ones.
+# Functions are identified by the bank-aware address of their entry, the key MAH<<24 | CBA<<16 | CA, as in HeatMap.
+
+# One frame on the reconstructed call stack
+class _Frame:
+    __slots__ = ('fn', 'ret_ca', 'start', 'site', 'caller')
+
+    def __init__(self, fn, ret_ca, start, site, caller):
+        self.fn = fn                # function key
+        self.ret_ca = ret_ca        # CA the frame is expected to return to, None for the root
+        self.start = start          # cycle number of the entry
+        self.site = site            # key of the call instruction (or the interrupted one)
+        self.caller = caller        # function key of the caller
+
+
+class CallGraph:
+    # is_cputype02: CPU type, for the instruction lengths and flow classes
+    # syms: optional symbols.SymbolTable, for the function names
+    def __init__(self, is_cputype02=False, syms=None):
+        self.is_cputype02 = is_cputype02
+        self.syms = syms
+        self.table = opcode_table(is_cputype02)
+        self.n_cycles = 0
+        self.n_instrs = 0
+        self.n_interrupts = 0
+        self.n_unmatched = 0        # returns without a matching frame
+        self.stack = []
+        # per function key: [exclusive cycles, exclusive instructions, inclusive cycles, number of calls]
+        self.fns = {}
+        # per (caller key, call site key, callee key): [number of calls, inclusive cycles]
+        self.calls = {}
+        # number of active frames per function key, to not count the recursion twice in the inclusive cycles
+        self.active = {}
+        # the instruction being executed, completed by the next SYNC:
+        #   [key, opcode, first cycle, number of cycles, vector pull seen, CA]
+        self.pend = None
+
+    def _fn(self, key):
+        f = self.fns.get(key)
+        if f is None:
+            f = self.fns[key] = [0, 0, 0, 0]
+        return f
+
+    def _push(self, fn, ret_ca, start, site):
+        caller = self.stack[-1].fn if len(self.stack) > 0 else None
+        self.stack.append(_Frame(fn, ret_ca, start, site, caller))
+        self.active[fn] = self.active.get(fn, 0) + 1
+        self._fn(fn)[3] += 1
+
+    # Close the top frame at the cycle `now`
+    def _pop(self, now):
+        fr = self.stack.pop()
+        incl = now - fr.start
+        self.active[fr.fn] -= 1
+        if self.active[fr.fn] == 0:
+            self.fns[fr.fn][2] += incl
+        if fr.caller is not None:
+            e = self.calls.get((fr.caller, fr.site, fr.fn))
+            if e is None:
+                e = self.calls[(fr.caller, fr.site, fr.fn)] = [0, 0]
+            e[0] += 1
+            e[1] += incl
+
+    # Complete the pending instruction; nkey, nCA: the next instruction, start: its first cycle
+    def _finish_instr(self, nkey, nCA, start):
+        (key, opcode, c0, ncyc, is_vp, CA) = self.pend
+        self.n_instrs += 1
+        if len(self.stack) == 0:
+            # the first instruction of the trace: the root frame
+            self._push(key, None, c0, None)
+
+        if is_vp:
+            # interrupt entry: BRK/COP return behind the signature byte, IRQ/NMI to the replaced instruction
+            op = self.table[opcode]
+            ret_ca = (CA + 2) & 0xFFFF if op.flow == FLOW_INTERRUPT else CA
+            self.n_interrupts += 1
+            self._push(nkey, ret_ca, c0, key)
+            f = self.fns[nkey]
+            f[0] += ncyc
+            f[1] += 1
+            return
+
+        f = self.fns[self.stack[-1].fn]
+        f[0] += ncyc
+        f[1] += 1
+        op = self.table[opcode]
+        if op.flow == FLOW_CALL:
+            self._push(nkey, (CA + op.size(True, True)) & 0xFFFF, c0, key)
+        elif op.flow == FLOW_RETURN:
+            # unwind to the frame returning to the next PC
+            for i in range(len(self.stack) - 1, 0, -1):
+                if self.stack[i].ret_ca == nCA:
+                    while len(self.stack) > i:
+                        self._pop(start)
+                    return
+            self.n_unmatched += 1
+            self._pop(start)
+            if len(self.stack) == 0:
+                # returned from the function the trace started in: the caller becomes the new root
+                self._push(nkey, None, start, None)
+
+    # Process the next part of the trace: packed 7-byte records (bytes) or a TraceArray.
+    # A CallGraph can thus be used directly as the sink of TraceCapture.capture().
+    def append(self, recs):
+        if isinstance(recs, TraceArray):
+            recs = recs.array()
+        else:
+            recs = np.frombuffer(bytes(recs), dtype=TRACE_DTYPE)
+        n = len(recs)
+        if n == 0:
+            return
+        sta = np.ascontiguousarray(recs['sta'])
+        sync = (sta & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC
+        # the vector pull is active low
+        vpull = (sta & ICD.TRACE_FLAG_VECTPULL) == 0
+        idx = np.flatnonzero(sync)
+        c0 = self.n_cycles
+        self.n_cycles += n
+
+        # the cycles before the first SYNC complete the pending instruction
+        head = int(idx[0]) if len(idx) > 0 else n
+        if self.pend is not None:
+            self.pend[3] += head
+            self.pend[4] = self.pend[4] or bool(vpull[0:head].any())
+        if len(idx) == 0:
+            return
+
+        ends = np.append(idx[1:], n)
+        vps = np.logical_or.reduceat(vpull, idx).tolist()
+        ops = recs['CD'][idx].tolist()
+        cas = recs['CA'][idx].tolist()
+        keys = ((recs['MAH'][idx].astype(np.uint32) << 24) | (recs['CBA'][idx].astype(np.uint32) << 16)
+                    | recs['CA'][idx]).tolist()
+        for (s, e, key, opcode, CA, vp) in zip(idx.tolist(), ends.tolist(), keys, ops, cas, vps):
+            if self.pend is not None:
+                self._finish_instr(key, CA, c0 + s)
+            self.pend = [key, opcode, c0 + s, e - s, vp, CA]
+
+    # Close the call stack at the end of the trace. The pending instruction is counted to the top function.
+    def finish(self):
+        if self.pend is not None:
+            if len(self.stack) == 0:
+                self._push(self.pend[0], None, self.pend[2], None)
+            f = self.fns[self.stack[-1].fn]
+            f[0] += self.pend[3]
+            f[1] += 1
+            self.n_instrs += 1
+            self.pend = None
+        while len(self.stack) > 0:
+            self._pop(self.n_cycles)
+
+    # The memory area and the name of the function: its symbol, or the address
+    def _area_fn(self, key):
+        (MAH, CBA, CA) = (key >> 24, (key >> 16) & 0xFF, key & 0xFFFF)
+        area = ICD.MAHDecoded.from_trace(MAH, CBA, CA).area_name
+        name = self.syms.format_addr(key & 0xFFFFFF, area) if self.syms is not None else None
+        return (area, name if name is not None else "${:02X}:{:04X}".format(CBA, CA))
+
+    # Format the function key
+    def fn_name(self, key):
+        return "{} {}".format(*self._area_fn(key))
+
+    # Write the flat profile by the inclusive cycles; top = number of the entries, None => all
+    def write_flat(self, f, top=None):
+        tot = self.n_cycles
+        pct = lambda n: n * 100.0 / tot if tot > 0 else 0.0
+        f.write("# cycles: {}, instructions: {}, interrupts: {}, unmatched returns: {}\n".format(
+                    self.n_cycles, self.n_instrs, self.n_interrupts, self.n_unmatched))
+        f.write("#  inclusive      %   exclusive      %     calls   function\n")
+        for (key, (excl, ninstr, incl, ncalls)) in sorted(self.fns.items(), key=lambda kv: -kv[1][2])[0:top]:
+            f.write("{:12} {:6.2f} {:11} {:6.2f} {:9}   {}\n".format(incl, pct(incl), excl, pct(excl), ncalls, self.fn_name(key)))
+
+    # Write the profile in the callgrind format (for KCachegrind and the like).
+    # The object (ob=) is the memory area (RAM/ROM-Block) of the function, the positions are the CPU addresses.
+    def write_callgrind(self, f):
+        f.write("# callgrind format\n")
+        f.write("version: 1\n")
+        f.write("creator: x65 callgraph\n")
+        f.write("positions: instr\n")
+        f.write("events: Cycles Instrs\n")
+        f.write("summary: {} {}\n".format(self.n_cycles, self.n_instrs))
+
+        def obfn(key):
+            (area, name) = self._area_fn(key)
+            return (area.replace(' ', ''), name)
+
+        # the outgoing calls of each function
+        outgoing = {}
+        for ((caller, site, callee), v) in self.calls.items():
+            outgoing.setdefault(caller, []).append((site, callee, v))
+
+        for (key, (excl, ninstr, incl, ncalls)) in sorted(self.fns.items()):
+            (ob, fn) = obfn(key)
+            f.write("\nob={}\nfn={}\n".format(ob, fn))
+            f.write("0x{:x} {} {}\n".format(key & 0xFFFFFF, excl, ninstr))
+            for (site, callee, (n, cyc)) in sorted(outgoing.get(key, [])):
+                (cob, cfn) = obfn(callee)
+                f.write("cob={}\ncfn={}\n".format(cob, cfn))
+                f.write("calls={} 0x{:x}\n".format(n, callee & 0xFFFFFF))
+                f.write("0x{:x} {}\n".format(site & 0xFFFFFF, cyc))
@@ -0,0 +1,160 @@
+from icd import ICD
+
+# CPU view of the X65 memory: translation of CPU addresses (CBA:CA) to the physical areas
+# accessible via the ICD (SRAM, IO registers, bank registers, PBL bootrom).
+# The translation follows the RAM/ROM-Block mapping of NORA (see doc/mem-map.md and doc/ioregs-nora.md)
+# and uses one snapshot of the mapping registers, so that a whole CPU address range
+# could be split in a few physical segments and each transferred in a single burst.
+class CpuMemMap:
+    # Kinds of physical areas, as accessed via the ICD
+    AREA_SRAM = 'sram'              # 2MB SRAM, linear address
+    AREA_IO = 'io'                  # IO registers $9F00-$9FFF, offset 0-255
+    AREA_BANKREG = 'banks'          # bank registers mirrored at $0000-$0001, offset 0-1
+    AREA_BOOTROM = 'bootrom'        # PBL bootrom inside of NORA, offset 0-511
+
+    BOOTROM_SIZE = 512              # PBL bootrom is mirrored over the $E000-$FFFF frame
+
+    # RMBCTRL ($9F53) bits
+    RMBCTRL_MAP_BOOTROM = 0x80
+    RMBCTRL_AUTO_UNMAP = 0x40
+    RMBCTRL_MIRROR_ZP = 0x20
+    RMBCTRL_ENABLE_ROM_CDEF = 0x10
+    RMBCTRL_ENABLE_RAM_CD = 0x08
+
+    # One contiguous piece of the CPU address range, mapped to a contiguous physical area.
+    class Segment:
+        def __init__(self, cpu_addr, area, phys, length):
+            self.cpu_addr = cpu_addr        # 24-bit CPU address (CBA:CA)
+            self.area = area                # one of CpuMemMap.AREA_*
+            self.phys = phys                # address/offset in the area
+            self.length = length            # number of bytes
+
+        def __repr__(self):
+            return "Segment(cpu=${:06X}, {}:0x{:x}, len={})".format(self.cpu_addr, self.area, self.phys, self.length)
+
+    # ramblock_ab: register RamBLOCK_AB ($9F50)
+    # ram_romblock_cd: register ROMBLOCK / RamBLOCK_CD ($9F51)
+    # rambmask: register RamBMASK ($9F52)
+    # rmbctrl: register RMBCTRL ($9F53)
+    def __init__(self, ramblock_ab, ram_romblock_cd, rambmask=0xFF, rmbctrl=RMBCTRL_ENABLE_ROM_CDEF):
+        self.ramblock_ab = ramblock_ab
+        self.ram_romblock_cd = ram_romblock_cd
+        self.rambmask = rambmask
+        self.rmbctrl = rmbctrl
+
+        self.map_bootrom = (rmbctrl & CpuMemMap.RMBCTRL_MAP_BOOTROM) != 0
+        self.mirror_zp = (rmbctrl & CpuMemMap.RMBCTRL_MIRROR_ZP) != 0
+        self.enable_rom_cdef = (rmbctrl & CpuMemMap.RMBCTRL_ENABLE_ROM_CDEF) != 0
+        self.enable_ram_cd = (rmbctrl & CpuMemMap.RMBCTRL_ENABLE_RAM_CD) != 0
+
+        # SRAM 8kB blocks mapped into the frames, the same way as in NORA sysregs.v
+        self.block_ab = (ramblock_ab & rambmask) ^ 0x80
+        if self.enable_rom_cdef:
+            self.block_cd = 0x40 | ((ram_romblock_cd & 0x1F) << 1)
+            self.block_ef = 0x40 | ((ram_romblock_cd & 0x1F) << 1) | 1
+            # vector pull always goes to ROM-Block 0
+            self.vp_block_ef = 0x41
+        else:
+            if self.enable_ram_cd:
+                self.block_cd = (ram_romblock_cd & rambmask) ^ 0x80
+            else:
+                self.block_cd = 0x06
+            self.block_ef = 0x07
+            self.vp_block_ef = 0x07
+
+    # Create the map from the present registers in the hw (one ICD transaction).
+    @classmethod
+    def from_hw(cls, icd):
+        regs = icd.ioregs_read(0x50, 4)
+        if isinstance(regs, ICD.Deferred):
+            raise RuntimeError("CpuMemMap.from_hw cannot be used inside of ICD.batch()")
+        return cls(regs[0], regs[1], regs[2], regs[3])
+
+    # Translate one CPU address.
+    # addr: 24-bit CPU address (CBA:CA)
+    # vp: True => vector-pull access (differs for $E000-$FFFF with enabled ROM-Blocks)
+    # Returns (area, phys, run), where run is the number of bytes from addr
+    # which continue linearly in the same area.
+    def translate(self, addr, vp=False):
+        CBA = (addr >> 16) & 0xFF
+        CA = addr & 0xFFFF
+        if CBA != 0:
+            # CPU Bank non-zero -> linear address into SRAM (just 2MB)
+            return (CpuMemMap.AREA_SRAM, addr & 0x1FFFFF, 0x10000 - CA)
+        if CA < 2 and self.mirror_zp:
+            # bank regs mirrored in the zero page
+            return (CpuMemMap.AREA_BANKREG, CA, 2 - CA)
+        if CA < 0x9F00:
+            # CPU low memory starts at sram fix 0x000000
+            return (CpuMemMap.AREA_SRAM, CA, 0x9F00 - CA)
+        if CA < 0xA000:
+            # IO regs
+            return (CpuMemMap.AREA_IO, CA - 0x9F00, 0xA000 - CA)
+        if CA < 0xC000:
+            # RAM-Block frame
+            return (CpuMemMap.AREA_SRAM, self.block_ab * ICD.BLOCKSIZE + (CA - 0xA000), 0xC000 - CA)
+        if CA < 0xE000:
+            # second RAM-Block frame, or lower half of the ROM-Block, or direct SRAM
+            return (CpuMemMap.AREA_SRAM, self.block_cd * ICD.BLOCKSIZE + (CA - 0xC000), 0xE000 - CA)
+        if self.map_bootrom:
+            # PBL bootrom, mirrored over the frame
+            offs = (CA - 0xE000) % CpuMemMap.BOOTROM_SIZE
+            return (CpuMemMap.AREA_BOOTROM, offs, CpuMemMap.BOOTROM_SIZE - offs)
+        # upper half of the ROM-Block, or direct SRAM
+        block = self.vp_block_ef if vp else self.block_ef
+        return (CpuMemMap.AREA_SRAM, block * ICD.BLOCKSIZE + (CA - 0xE000), 0x10000 - CA)
+
+    # Split the CPU address range in the minimal list of physical segments.
+    # addr: 24-bit CPU address (CBA:CA) of the start
+    # n: number of bytes
+    # vp: True => as seen by the vector pull, see translate()
+    # Returns list of CpuMemMap.Segment.
+    def segments(self, addr, n, vp=False):
+        segs = []
+        k = 0
+        while k < n:
+            (area, phys, run) = self.translate(addr + k, vp)
+            run = min(run, n - k)
+            last = segs[-1] if len(segs) > 0 else None
+            if last is not None and last.area == area and last.phys + last.length == phys:
+                # physically contiguous with the previous segment -> merge
+                last.length += run
+            else:
+                segs.append(CpuMemMap.Segment(addr + k, area, phys, run))
+            k += run
+        return segs
+
+    # Read the CPU address range, each segment in a single burst; all of them in one ICD batch.
+    # Returns bytearray, or ICD.Deferred if called inside of an outer ICD.batch().
+    def read(self, icd, addr, n, vp=False):
+        parts = []
+        with icd.batch():
+            for seg in self.segments(addr, n, vp):
+                if seg.area == CpuMemMap.AREA_SRAM:
+                    parts.append(icd.sram_blockread(seg.phys, seg.length))
+                elif seg.area == CpuMemMap.AREA_IO:
+                    parts.append(icd.ioregs_read(seg.phys, seg.length))
+                elif seg.area == CpuMemMap.AREA_BANKREG:
+                    parts.append(icd.bankregs_read(seg.phys, seg.length))
+                else:
+                    parts.append(icd.bootrom_blockread(seg.phys, seg.length))
+            data = ICD.concat(parts)
+        # outside of any batch the result is ready now; n == 0 gives the empty bytearray right away
+        return data.result() if isinstance(data, ICD.Deferred) and icd.batch_queue is None else data
+
+    # Write the CPU address range, each segment in a single burst; all of them in one ICD batch.
+    # Note that the ICD writes ignore the read-only protection of the ROM-Block frame.
+    def write(self, icd, addr, data, vp=False):
+        with icd.batch():
+            k = 0
+            for seg in self.segments(addr, len(data), vp):
+                chunk = data[k:k+seg.length]
+                if seg.area == CpuMemMap.AREA_SRAM:
+                    icd.sram_blockwrite(seg.phys, chunk)
+                elif seg.area == CpuMemMap.AREA_IO:
+                    icd.ioregs_write(seg.phys, chunk)
+                elif seg.area == CpuMemMap.AREA_BANKREG:
+                    icd.bankregs_write(seg.phys, chunk)
+                else:
+                    icd.bootrom_blockwrite(seg.phys, chunk)
+                k += seg.length
@@ -76,6 +76,68 @@ class CpuRegs:
         self.DPR = None             # Data Page Register, 16b
         self.PC = None              # Program counter incl. PBR, 24-bit
     
+    # the same for the 65C02: there are no DBR, DPR nor 16-bit registers, so X is stored to the zero page
+    # (one cycle shorter than the absolute address, which is there just to see the DBR of the 65C816)
+    steps_readregs_02 = [
+        { 'CD': 0xEA,   'sta': STA_ISYNC,   'cmd': CMD_GET_PC  },           # NOP - guard for the first step, to detect interrupts
+        {               'sta': 0,           'cmd': 0 },                     # internal op
+
+        { 'CD': 0x08,   'sta': STA_ISYNC | STA_NO_SYNC_THEN_IRQ,   
+                                            'cmd': 0  },           # PHP
+        {               'sta': 0,           'cmd': 0 },                # internal op (stack dec)
+        {               'sta': 0,           'cmd': CMD_GET_SP | CMD_GET_FLAGS },              # writing Flags to the Stack
+
+        { 'CD': 0x28,   'sta': STA_ISYNC,   'cmd': 0 },           # PLP
+        {               'sta': 0,           'cmd': 0 },                # internal op (stack inc)
+        {               'sta': 0,           'cmd': 0 },                # internal op (?)
+        {               'sta': 0,           'cmd': 0 },              # reading Flags from the Stack
+
+        { 'CD': 0x85,   'sta': STA_ISYNC,   'cmd': 0 },           # STA
+        { 'CD': 0x02,   'sta': 0,           'cmd': 0 },   # arg: 0x02
+        {               'sta': 0,           'cmd': CMD_BLOCK_WRITE | CMD_GET_A },              # writing A to the (0x02)
+
+        { 'CD': 0x86,   'sta': STA_ISYNC,   'cmd': 0 },           # STX
+        { 'CD': 0x40,   'sta': 0,           'cmd': 0 },   # arg: 0x40
+        {               'sta': 0,           'cmd': CMD_BLOCK_WRITE | CMD_GET_X },              # writing X to the (0x40)
+
+        { 'CD': 0x84,   'sta': STA_ISYNC,   'cmd': 0 },           # STY
+        { 'CD': 0x06,   'sta': 0,           'cmd': 0 },   # arg: 0x06
+        {               'sta': 0,           'cmd': CMD_BLOCK_WRITE | CMD_GET_Y },              # writing Y to the (0x06)
+
+        { 'CD': 0x80,   'sta': STA_ISYNC,   'cmd': 0 },           # BRA
+        { 'CD': 0xF5,   'sta': 0,           'cmd': 0 },   # arg: 0xF5 (back to the original PC, one byte less than above)
+        {               'sta': 0,           'cmd': 0 },                # jump, internal op.
+    ]
+
+    # Force the opcodes of the given steps into the CPU and step it, in one ICD batch.
+    # Returns the list of the trace register reads (ICD.Deferred), one for each step.
+    def force_steps(self, icd, steps):
+        reads = []
+        with icd.batch():
+            for st in steps:
+                # shall we force the opcode?
+                if 'CD' in st:
+                    icd.cpu_force_opcode(int(st['CD']), False)
+                else:
+                    block_write = True if (st['cmd'] & CpuRegs.CMD_BLOCK_WRITE) != 0 else 0
+                    if block_write:
+                        icd.cpu_force_opcode(None, True)
+
+                # Now we should normally step the CPU by one cycle.
+                icd.cpu_ctrl(False, True, False,
+                        force_irq=False, force_nmi=False, force_abort=False,
+                        block_irq=True, block_nmi=True, block_abort=True)
+
+                # read the current trace register
+                reads.append(icd.cpu_read_trace())
+        return reads
+
+    # Read the CPU registers by forcing the opcodes of the steps_readregs table into the stopped CPU.
+    # The CPU must be stopped at the beginning of an instruction.
+    # The forced-opcode/step/trace-read sequence is sent in two ICD batches (one USB transfer each in the packed mode):
+    # the steps depending on the M/X flags are selected in advance from the sampled CPU state,
+    # and all the trace records are checked against the expectations after the transfer.
+    # Returns True on success.
     def cpu_read_regs(self, icd):
         # We should check the CPU state first and continue just if there is NOT a new instruction
         # upcoming.
@@ -99,48 +161,35 @@ class CpuRegs:
             return False
         
         # CPU is stopped and awaits next opcode.
-        # Ok, lets start the read sequence!
-        
-        step = 0
-        is_am16 = False
-        is_xy16 = False
+        # The 8/16 bitness of the A+M and X+Y registers does not change during the sequence (PLP restores the flags),
+        # so the steps expecting M16 or X16 are dropped right now if the reality is M8 or X8.
+        # (65C02: NORA forces the M and X flags to 1, i.e. 8-bit, automatically.)
+        is_am16 = not tbuf.is_am8
+        is_xy16 = not tbuf.is_xy8
+        steps = CpuRegs.steps_readregs_02 if icd.is_cputype02() else CpuRegs.steps_readregs
+        steps = [ st for st in steps
+                    if not ((st['sta'] & CpuRegs.STA_AM16) and not is_am16)
+                        and not ((st['sta'] & CpuRegs.STA_XY16) and not is_xy16) ]
+
+        # Ok, lets run the read sequence!
+        # The steps up to the interrupt guard (PHP) go first: if the CPU is entering an interrupt handler
+        # there, no more opcodes may be forced into it. The rest of the sequence then goes all in one go.
+        g = [ i for i, st in enumerate(steps) if st['sta'] & CpuRegs.STA_NO_SYNC_THEN_IRQ ][0] + 1
+        reads = self.force_steps(icd, steps[0:g])
+        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = reads[-1].result()
+        if is_valid and not ICD.TraceReg(rawbuf).is_sync:
+            print("INFO: The CPU is entering an exception handler => not possible to obtain the internal register state now.")
+            return False
+        reads += self.force_steps(icd, steps[g:])
 
-        while step < len(CpuRegs.steps_readregs):
-            # get the step definition from the table.
-            st = CpuRegs.steps_readregs[step]
+        for step, (st, rd) in enumerate(zip(steps, reads)):
             # expected CPU State value
             exp_sta = st['sta']
             exp_sync = True if (exp_sta & CpuRegs.STA_ISYNC) == CpuRegs.STA_ISYNC else False
-            exp_am16 = True if (exp_sta & CpuRegs.STA_AM16) else False
-            exp_xy16 = True if (exp_sta & CpuRegs.STA_XY16) else False
             exp_no_sync_then_irq = True if (exp_sta & CpuRegs.STA_NO_SYNC_THEN_IRQ) else False
 
-            if exp_am16 and not is_am16:
-                # the current Step expect M16 (A16), but reality is M8 (A8) => skip this step!
-                step = step + 1
-                continue
-                
-            if exp_xy16 and not is_xy16:
-                # the current Step expect X16, but reality is X8 => skip this step!
-                step = step + 1
-                continue
-            
-            # shall we force the opcode?
-            if 'CD' in st:
-                icd.cpu_force_opcode(int(st['CD']), False)
-            else:
-                block_write = True if (st['cmd'] & CpuRegs.CMD_BLOCK_WRITE) != 0 else 0
-                if block_write:
-                    icd.cpu_force_opcode(None, True)
-            
-            # Now we should normally step the CPU by one cycle.
-            icd.cpu_ctrl(False, True, False, 
-                    force_irq=False, force_nmi=False, force_abort=False,
-                    block_irq=True, block_nmi=True, block_abort=True)
-
-            # read the current trace register
-            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = icd.cpu_read_trace()
-            
+            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = rd.result()
+
             # check if trace buffer memory is non-empty
             if is_tbr_valid:
                 # yes, this is unexpected.
@@ -156,9 +205,6 @@ class CpuRegs:
             tbuf = ICD.TraceReg(rawbuf)
             # Emulation Flag is obtained from the instruction trace directly
             self.EMU = tbuf.is_emu8
-            # remmember the 8/16 bitnes of the A+M and X+Y registers
-            is_am16 = not tbuf.is_am8
-            is_xy16 = not tbuf.is_xy8
 
             # disinst = decode_traced_instr(icd, tbuf, False)
             # print("  cpu-reg-read: CBA={:2x}, CA={:4x}, CD={:2x}, sta={:2x}   {}".format(
@@ -177,6 +223,12 @@ class CpuRegs:
                 print("    step={}, sta={:2x}, ctr={:2x}, CD={:2x}".format(step, tbuf.sta_flags, tbuf.ctr_flags, tbuf.CD))
                 return False
 
+            # the steps were selected by the M/X flags sampled before the sequence
+            if is_am16 == tbuf.is_am8 or is_xy16 == tbuf.is_xy8:
+                print("ERROR: M/X flags changed during cpu_read_regs!!")
+                print("    step={}, sta={:2x}, ctr={:2x}, CD={:2x}".format(step, tbuf.sta_flags, tbuf.ctr_flags, tbuf.CD))
+                return False
+
             cmd = st['cmd'] 
             # decode commands
             if cmd & CpuRegs.CMD_GET_A:
@@ -202,8 +254,132 @@ class CpuRegs:
             if cmd & CpuRegs.CMD_GET_DBR:
                 self.DBR = tbuf.CBA
 
-            step = step + 1
-        
+        if icd.is_cputype02():
+            # no such registers in the 65C02; it behaves as with the direct page and data bank at 0
+            self.DPR = 0
+            self.DBR = 0
+
+        return True
+
+    # Write the CPU registers: the fields of regs (CpuRegs) which are not None; the others keep their values.
+    # The CPU must be stopped at the beginning of an instruction.
+    # The current registers are read first, then a small program is forced into the CPU (all its data comes
+    # from the ICD, the CPU writes are ignored), and finally the registers are read back and checked.
+    # 65C816 program:
+    #       [CLC/SEC, XCE]              switch to the native/emulation mode
+    #       REP #$10                    (native) 16-bit index registers
+    #       LDX #SP-4, TXS              the stack pointer, 4 bytes lower for the pulls below
+    #       PLD <- DPR, PLB <- DBR      the pulls get the forced data
+    #       LDX #X, LDY #Y
+    #       REP/SEP #$20, LDA #A        (native) 16-bit A only if AH is known, otherwise B is kept
+    #       [LDA #AH, XBA, LDA #AL]     (emulation) set B through XBA
+    #       PLP <- FL
+    #       JML PBR:PC
+    # 65C02 program:
+    #       LDX #SP-1, TXS, LDA #A, LDX #X, LDY #Y, PLP <- FL, JMP PC
+    # On success self holds the read-back registers and True is returned.
+    def cpu_write_regs(self, icd, regs):
+        if not self.cpu_read_regs(icd):
+            print("ERROR: cpu_write_regs: could not read the current CPU registers!")
+            return False
+        is02 = icd.is_cputype02()
+
+        # the new values: given, or the current
+        new = lambda k, cur: getattr(regs, k) if getattr(regs, k) is not None else cur
+        emu = True if is02 else bool(new('EMU', self.EMU))
+        SP = new('SP', self.SP)
+        FL = new('FL', self.FL)
+        PC = new('PC', self.PC)
+        DPR = new('DPR', self.DPR)
+        DBR = new('DBR', self.DBR)
+        AL = new('AL', self.AL)
+        AH = new('AH', self.AH)
+        (XL, XH) = (new('XL', self.XL), new('XH', self.XH) or 0)
+        (YL, YH) = (new('YL', self.YL), new('YH', self.YH) or 0)
+        X = XL if emu else XL | (XH << 8)
+        Y = YL if emu else YL | (YH << 8)
+
+        # the forced program: list of (data byte forced to the CPU or None, is opcode fetch (SYNC expected))
+        cycles = []
+        def ins(opcode, operands=[], n_internal=0, pulled=[]):
+            cycles.append((opcode, True))
+            cycles.extend([ (b, False) for b in operands ])
+            cycles.extend([ (None, False) ] * n_internal)
+            cycles.extend([ (b, False) for b in pulled ])
+
+        imm = lambda v, is16: [ v & 0xFF, (v >> 8) & 0xFF ] if is16 else [ v & 0xFF ]
+
+        if is02:
+            ins(0xA2, imm(SP - 1, False))               # LDX #SP-1
+            ins(0x9A, n_internal=1)                     # TXS
+            ins(0xA9, imm(AL, False))                   # LDA #A
+            ins(0xA2, imm(X, False))                    # LDX #X
+            ins(0xA0, imm(Y, False))                    # LDY #Y
+            ins(0x28, n_internal=2, pulled=[FL])        # PLP
+            ins(0x4C, imm(PC, True))                    # JMP PC
+        else:
+            if emu != bool(self.EMU):
+                ins(0x38 if emu else 0x18, n_internal=1)    # SEC / CLC
+                ins(0xFB, n_internal=1)                     # XCE
+            if not emu:
+                ins(0xC2, [0x10], n_internal=1)             # REP #$10
+            ins(0xA2, imm(SP - 4, not emu))                 # LDX #SP-4
+            ins(0x9A, n_internal=1)                         # TXS
+            ins(0x2B, n_internal=2, pulled=[DPR & 0xFF, DPR >> 8])     # PLD
+            ins(0xAB, n_internal=2, pulled=[DBR])           # PLB
+            ins(0xA2, imm(X, not emu))                      # LDX #X
+            ins(0xA0, imm(Y, not emu))                      # LDY #Y
+            if emu:
+                if AH is not None:
+                    ins(0xA9, imm(AH, False))               # LDA #AH
+                    ins(0xEB, n_internal=2)                 # XBA
+                ins(0xA9, imm(AL, False))                   # LDA #AL
+            else:
+                ins(0xC2 if AH is not None else 0xE2, [0x20], n_internal=1)    # REP/SEP #$20
+                ins(0xA9, imm(AL | ((AH or 0) << 8), AH is not None))      # LDA #A
+            ins(0x28, n_internal=2, pulled=[FL])            # PLP
+            ins(0x5C, [PC & 0xFF, (PC >> 8) & 0xFF, (PC >> 16) & 0xFF])     # JML PC
+
+        # run it all in one go
+        reads = []
+        with icd.batch():
+            for (data, is_opcode) in cycles:
+                icd.cpu_force_opcode(data, True)
+                icd.cpu_ctrl(False, True, False,
+                        force_irq=False, force_nmi=False, force_abort=False,
+                        block_irq=True, block_nmi=True, block_abort=True)
+                reads.append(icd.cpu_read_trace())
+
+        for step, ((data, is_opcode), rd) in enumerate(zip(cycles, reads)):
+            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = rd.result()
+            tbuf = ICD.TraceReg(rawbuf)
+            if not is_valid or is_opcode != tbuf.is_sync:
+                print("ERROR: cpu_write_regs: sync expectation vs reality differs!!")
+                print("    step={}, sta={:2x}, ctr={:2x}, CD={:2x}".format(step, tbuf.sta_flags, tbuf.ctr_flags, tbuf.CD))
+                return False
+
+        # verify; the high bytes of the 8-bit registers are not read, they must not stay from the first readout
+        (self.AH, self.XH, self.YH) = (None, None, None)
+        if not self.cpu_read_regs(icd):
+            print("ERROR: cpu_write_regs: could not read back the CPU registers!")
+            return False
+        exp = { 'AL': AL, 'XL': XL, 'YL': YL, 'PC': PC, 'EMU': emu,
+                # emulation mode: the stack is in the page 1, the flags M and X (B) are read as 1
+                'SP': (SP & 0xFF) | 0x100 if emu else SP,
+                'FL': FL | 0x30 if emu else FL }
+        if not is02:
+            exp.update({ 'DPR': DPR, 'DBR': DBR })
+            if AH is not None and self.AH is not None:
+                exp['AH'] = AH
+            if self.XH is not None:
+                exp.update({ 'XH': XH, 'YH': YH })
+        for (k, v) in exp.items():
+            got = getattr(self, k)
+            if k == 'FL' and emu:
+                got |= 0x30
+            if bool(got) != bool(v) if k == 'EMU' else got != v:
+                print("ERROR: cpu_write_regs: {} written {:x}, read back {:x}".format(k, v, got))
+                return False
         return True
 
     def hex2(self, h, replace='.'):
@@ -1,16 +1,28 @@
 #!/usr/bin/python3
 import x65ftdi
+import argparse
+import threading
+import queue
+import numpy as np
 from icd import *
 from cpuregs import *
 from cpuidec import *
 
 from rich.syntax import Syntax
 from rich.table import Table
+from rich.text import Text
 
 from textual.app import App, ComposeResult
-from textual.containers import ScrollableContainer, HorizontalScroll, VerticalScroll, Grid
-from textual.widgets import Button, Footer, Header, Static, RichLog, DataTable, Label
+from textual.containers import ScrollableContainer, HorizontalScroll, VerticalScroll, Vertical, Grid
+from textual.widgets import Button, Footer, Header, Static, RichLog, DataTable, Label, Input
 from textual.timer import Timer
+from textual.message import Message
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+from textual.geometry import Size
+
+from tracearr import TraceRing
+from memwatch import WatchList, AREAS
 
 
 class CpuRegView(HorizontalScroll):
@@ -66,77 +78,401 @@ class CpuRegView(HorizontalScroll):
         self.regtb.update_cell(self.reg_Flags, self.col_Decode, '{}{}{}{}{}{}{}{}/{}'.format(
             'N' if regs.FL & 128 else '-',
             'V' if regs.FL & 64 else '-',
-            '1' if regs.EMU else ('m' if self.FL & 32 else 'M'),
+            '1' if regs.EMU else ('m' if regs.FL & 32 else 'M'),
             'B' if regs.EMU and (regs.FL & 16) else ('-' if regs.EMU else ('x' if regs.FL & 16 else 'X')),
             'D' if regs.FL & 8 else '-',
             'I' if regs.FL & 4 else '-',
             'Z' if regs.FL & 2 else '-',
             'C' if regs.FL & 1 else '-',
             'emu' if regs.EMU else 'Nat'))
-        
-
-
-class DebuggerApp(App):
-    """A Textual app to debug X65."""
-
-    BINDINGS = [("r", "run_stop_cpu", "Run/Stop"), 
-                ("s", "step_cpu", "Step"),
-                ("q", "quit", "Quit")]
-
-    def compose(self) -> ComposeResult:
-        """Create child widgets for the app."""
-        yield Header()
-        yield Footer()
-        with HorizontalScroll():
-            yield DataTable(id="trace", classes="box")
-            with VerticalScroll():
-                yield Label("Status:", id="targetstatus")
-                yield CpuRegView(id='cpuregs')
-            
-        # yield RichLog(markup=True)
-
-        self.cycle_i = 0                 # CPU Cycles counter
-        self.tracetb_row_preview = None
 
 
-    def on_ready(self) -> None:
-        """Called  when the DOM is ready."""
-        # text_log = self.query_one(RichLog)
-        # text_log.write(Syntax(CODE, "python", indent_guides=True))
-        # rows = iter(csv.reader(io.StringIO(CSV)))
-        # table = Table(*next(rows))
-        # for row in rows:
-        #     table.add_row(*row)
-        # text_log.write(table)
-        # text_log.write("[bold magenta]Write text or any Rich renderable!")
-        # text_log.write("")
-        # self.timer = Timer(event_target=self, interval=0.5)
-        self.statuslabel = self.query_one("#targetstatus")
-
-        self.tracetb = self.query_one('#trace')
-        self.tracetb.add_column("Cycle#")
-        self.tracetb.add_column("MAH")
-        self.tracetb.add_column("Area")
-        self.tracetb.add_column("CBA")
-        self.tracetb.add_column("CA")
-        self.tracetb.add_column("CD")
-        self.tracetb.add_column("ctr")
-        self.tracetb.add_column("sta")
-        self.tracetb.add_column("Instruction")
+class MemPanel(DataTable):
+    """ Memory View: ROWS x 16 bytes from the address in the area (see memwatch.AREAS).
+        Just the changed cells are re-rendered, and highlighted until the next refresh.
+    """
+    ROWS = 8
+
+    def __init__(self, area='cpu', addr=0, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.area = area
+        self.addr = addr
+        self.vals = []                  # the bytes shown
+        self.hot = set()                # offsets highlighted by the last refresh
+        self.is_new = True              # the next refresh is the first one of the region, not a change
+
+    def on_mount(self) -> None:
+        self.add_column("[green]{}[/green]".format(self.area.upper()), key='addr')
+        for i in range(0, 16):
+            self.add_column("+{:x}".format(i), key=str(i))
+        self.set_addr(self.area, self.addr)
+
+    def regions(self):
+        """ The watched regions, for WatchList.set() """
+        return [ (self.area, self.addr, MemPanel.ROWS * 16) ]
+
+    def set_addr(self, area: str, addr: int) -> None:
+        """ Show the memory from addr in the area; the bytes are '--' until the next refresh. """
+        self.area = area
+        self.addr = addr
+        self.hot = set()
+        self.is_new = True
+        self.columns['addr'].label = Text.from_markup("[green]{}[/green]".format(area.upper()))
+        self.clear()
+        for r in range(0, MemPanel.ROWS):
+            self.add_row(format_mem_addr(area, addr + r * 16), *(['--'] * 16), key=str(r))
+
+    def show(self, vals, changed) -> None:
+        """ Update the cells changed by the refresh, and un-highlight the ones of the previous one. """
+        self.vals = vals
+        hl = set() if self.is_new else changed
+        for i in sorted(changed | self.hot):
+            v = vals[i]
+            cell = '--' if v is None else ('[red]{:02x}[/red]' if i in hl else '{:02x}').format(v)
+            self.update_cell(str(i // 16), str(i % 16), cell)
+        self.hot = hl
+        self.is_new = False
+
+
+class WatchPanel(DataTable):
+    """ Watches: named memory regions, shown as a little-endian number (up to 4 bytes) or the bytes.
+        The changed values are highlighted until the next refresh.
+    """
+    BINDINGS = [("delete", "remove", "Remove watch")]
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.watches = []               # (name, area, addr, size)
+        self.vals = []                  # the bytes of all the watches, concatenated
+        self.hot = set()                # watch indexes highlighted by the last refresh
+        self.is_new = True              # the next refresh is the first one of the regions, not a change
+        self.cursor_type = 'row'
+
+    def on_mount(self) -> None:
+        self.add_column("[green]WATCH[/green]", key='name')
+        self.add_column("Where", key='where')
+        self.add_column("Value", key='value')
+
+    def regions(self):
+        """ The watched regions, for WatchList.set() """
+        return [ (area, addr, size) for (name, area, addr, size) in self.watches ]
+
+    def add(self, name: str, area: str, addr: int, size: int) -> None:
+        self.watches.append( (name, area, addr, size) )
+        self.hot = set()
+        self.is_new = True
+        self.add_row(name, format_mem_addr(area, addr), '--', key=str(len(self.watches) - 1))
+
+    def action_remove(self) -> None:
+        if len(self.watches) == 0:
+            return
+        del self.watches[self.cursor_row]
+        self.hot = set()
+        self.is_new = True
+        self.clear()
+        for (i, (name, area, addr, size)) in enumerate(self.watches):
+            self.add_row(name, format_mem_addr(area, addr), '--', key=str(i))
+        self.app.icdw.submit('watch_set', self.id, self.regions())
+
+    def show(self, vals, changed) -> None:
+        """ Update the values of the watches changed by the refresh (vals: all the regions, concatenated). """
+        self.vals = vals
+        k = 0
+        hl = set()
+        for (i, (name, area, addr, size)) in enumerate(self.watches):
+            v = vals[k:k+size]
+            is_changed = any(j in changed for j in range(k, k + size))
+            k += size
+            if not is_changed and i not in self.hot:
+                continue
+            if None in v:
+                cell = '--'
+            elif size <= 4:
+                cell = '${:0{}x}'.format(int.from_bytes(bytes(v), 'little'), 2 * size)
+            else:
+                cell = ' '.join('{:02x}'.format(b) for b in v)
+            if is_changed and not self.is_new:
+                hl.add(i)
+                cell = '[red]{}[/red]'.format(cell)
+            self.update_cell(str(i), 'value', cell)
+        self.hot = hl
+        self.is_new = False
+
+
+class TracePanel(ScrollView):
+    """ Trace View: the captured cycles, kept in a TraceRing (the last TRACE_DEPTH cycles).
+        Virtualized: just the visible lines are formatted (see render_line), and the instructions
+        are disassembled from the trace lazily, when they are scrolled into the view.
+        The lines are the absolute cycle numbers of the ring, plus the upcoming instruction at the end.
+    """
+    TRACE_DEPTH = 1 << 20
+    # column widths: Cycle#, MAH, Area, CBA, CA, CD, ctr, sta, Instruction
+    COLUMNS = [ ("Cycle#", 9), ("MAH", 4), ("Area", 9), ("CBA", 4), ("CA", 6), ("CD", 4), ("ctr", 9), ("sta", 14), ("Instruction", 40) ]
+    DIS_CACHE_MAX = 1 << 16         # max. disassembled lines kept
+
+    BINDINGS = [("up", "cursor(-1)", "Up"), ("down", "cursor(1)", "Down"),
+                ("pageup", "cursor(-20)", "PgUp"), ("pagedown", "cursor(20)", "PgDn"),
+                ("home", "cursor_to(0)", "First"), ("end", "cursor_to(-1)", "Last")]
+
+    DEFAULT_CSS = """
+    TracePanel {
+        height: 1fr;
+    }
+    """
+
+    def __init__(self, is_cputype02=False, syms=None, depth=TRACE_DEPTH, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.can_focus = True
+        self.is_cputype02 = is_cputype02
+        self.syms = syms
+        self.ring = TraceRing(depth)
+        self.gaps = set()               # cycle numbers after which the CPU was running untraced
+        self.upcoming = None            # (raw record, disassembly) of the upcoming instruction
+        self.cursor = None              # cycle number of the cursor line; None => follow the end
+        self.dis_cache = {}             # cycle number -> disassembled instruction
+
+    @staticmethod
+    def header() -> str:
+        return " ".join(name.ljust(w) for (name, w) in TracePanel.COLUMNS)
+
+    def n_lines(self) -> int:
+        return len(self.ring) + (1 if self.upcoming is not None else 0)
+
+    def append(self, recs, is_gap=False, upcoming=None) -> None:
+        """ Append the packed trace records; is_gap: the CPU was running before them. """
+        if len(recs) > 0:
+            if is_gap:
+                self.gaps.add(self.ring.total)
+            self.ring.append(recs)
+        self.upcoming = upcoming
+        self.virtual_size = Size(sum(w + 1 for (n, w) in TracePanel.COLUMNS), self.n_lines())
+        if self.cursor is None:
+            self.scroll_end(animate=False)
+        self.refresh()
+
+    def disasm(self, c: int) -> str:
+        """ Disassembly of the cycle c (empty if not an instruction start), decoded from the trace """
+        dis = self.dis_cache.get(c)
+        if dis is not None:
+            return dis
+        # decode the whole visible window at once; +8: the operands of the last instruction
+        stop = c + self.size.height + 8
+        tbufs = list(self.ring.cycles(c, stop))
+        dis_list = decode_trace_stream_cpu(self.is_cputype02, tbufs, self.syms)
+        if len(self.dis_cache) > TracePanel.DIS_CACHE_MAX:
+            self.dis_cache = {}
+        # the last instructions could still get their operands from the next records
+        for i in range(0, min(len(tbufs), self.ring.total - 8 - c)):
+            self.dis_cache[c + i] = dis_list[i]
+        return dis_list[0] if len(dis_list) > 0 else ""
+
+    def format_line(self, label: str, tbuf, disinst: str, dis_style: str) -> Text:
+        """ Format one trace line """
+        mah_area = ICD.MAHDecoded.from_trace(tbuf.MAH, tbuf.CBA, tbuf.CA).area_name
+        ctr = "${:02x}:{}{}{}{}".format(tbuf.ctr_flags, 
+                ('-' if tbuf.is_resetn else 'R'),
+                ('-' if tbuf.is_irqn else 'I'),
+                ('-' if tbuf.is_nmin else 'N'),
+                ('-' if tbuf.is_abortn else '[red]A[/red]'))
+        sta = "${:02x}:{}{}{}{}{}{}{}{}{}".format(tbuf.sta_flags, 
+                ('r' if tbuf.is_read_nwrite else '[red]W[/red]'), 
+                ('-' if tbuf.is_vectpull else '[yellow]v[/yellow]'),        # vector pull, active low
+                ('-' if tbuf.is_mlock else 'L'),           # mem lock, active low
+                ('e' if tbuf.is_emu8 else '[blue]N[/blue]'),        # 'e': emulation mode, active high; 'N' native mode
+                ('m' if tbuf.is_am8 else '[blue]M[/blue]'),    # '816 M-flag (acumulator): 0=> 16-bit 'M', 1=> 8-bit 'm'
+                ('x' if tbuf.is_xy8 else '[blue]X[/blue]'),    # '816 X-flag (index regs): 0=> 16-bit 'X', 1=> 8-bit 'x'
+                ('P' if tbuf.is_vpa else '-'),        # '02: SYNC, '816: VPA (valid program address)
+                ('D' if tbuf.is_vda else '-'),             # '02: always 1, '816: VDA (valid data address)
+                ('S' if tbuf.is_sync else '-'))
+        cells = [ label, "${:02x}".format(tbuf.MAH), mah_area, "${:02x}".format(tbuf.CBA), "${:04x}".format(tbuf.CA), 
+                    "${:02x}".format(tbuf.CD), ctr, sta ]
+        # the disassembly is not markup: symbols and operands like [ptr1],Y would be taken as tags
+        texts = [ Text.from_markup(cell) for cell in cells ] + [ Text(disinst or "", style=dis_style) ]
+        line = Text()
+        for (t, (name, w)) in zip(texts, TracePanel.COLUMNS):
+            t.truncate(w, pad=True)
+            line.append_text(t)
+            line.append(" ")
+        return line
+
+    def render_line(self, y: int) -> Strip:
+        (scroll_x, scroll_y) = self.scroll_offset
+        k = scroll_y + y                # line number
+        width = self.virtual_size.width
+        if k < len(self.ring):
+            c = self.ring.first + k
+            # a mark after the untraced run of the CPU
+            label = ("»" if c in self.gaps else " ") + str(c)
+            line = self.format_line(label, self.ring.cycle(c), self.disasm(c), "green")
+        elif k == len(self.ring) and self.upcoming is not None:
+            # special: not real, but an upcoming instruction cycle
+            (raw, disinst) = self.upcoming
+            line = self.format_line("[underline]next[/underline]", ICD.TraceReg(raw), disinst, "yellow")
+            c = None
+        else:
+            return Strip.blank(self.size.width)
+        if c is not None and c == self.cursor:
+            line.stylize("reverse")
+        strip = Strip(list(line.render(self.app.console)), line.cell_len).extend_cell_length(width)
+        return strip.crop(scroll_x, scroll_x + self.size.width)
+
+    def show_cycle(self, c: int) -> None:
+        """ Move the cursor to the cycle c and scroll it to the middle of the view. """
+        c = max(self.ring.first, min(c, self.ring.total - 1))
+        self.cursor = c
+        self.scroll_to(y=max(0, c - self.ring.first - self.size.height // 2), animate=False)
+        self.refresh()
+
+    def action_cursor(self, delta: int) -> None:
+        if len(self.ring) == 0:
+            return
+        c = self.cursor if self.cursor is not None else self.ring.total - 1
+        self.show_cycle(c + delta)
+
+    def action_cursor_to(self, where: int) -> None:
+        if where < 0:
+            # back to following the end of the trace
+            self.cursor = None
+            self.scroll_end(animate=False)
+            self.refresh()
+        elif len(self.ring) > 0:
+            self.show_cycle(self.ring.first)
+
+    def find_address(self, lo: int, hi: int) -> bool:
+        """ Find the next cycle accessing the 24-bit CPU address in [lo, hi), from the cursor on, wrapping around. """
+        start = (self.cursor + 1) if self.cursor is not None else self.ring.first
+        for (a, b) in [ (start, self.ring.total), (self.ring.first, start) ]:
+            hits = np.flatnonzero(self.ring.cycles(a, b).in_range(lo, hi))
+            if len(hits) > 0:
+                self.show_cycle(max(a, self.ring.first) + int(hits[0]))
+                return True
+        return False
+        
 
-        self.cpuregs = self.query_one('#cpuregs')
-        self.cpuregs.on_ready()
-        # table.add_rows(ROWS[1:])
-        # table.add_row(-255, 6, "(RAMB:134)", "$00", "$c1cd", "$6b", "$0f:----",  "$7d:r--NmXPDS", "[green]RTL[/green]")
 
-        self.set_interval(0.5, self.on_timer)
+class TraceCycles(Message):
+    """ Trace records from the ICD worker: the packed records, whether the CPU was running before them,
+        and the upcoming instruction: (raw record, disassembly) or None. """
+    def __init__(self, recs: bytes, is_gap: bool, upcoming) -> None:
+        self.recs = recs
+        self.is_gap = is_gap
+        self.upcoming = upcoming
+        super().__init__()
+
+
+class RegsUpdate(Message):
+    """ CPU registers read by the ICD worker. """
+    def __init__(self, regs: CpuRegs) -> None:
+        self.regs = regs
+        super().__init__()
+
+
+class MemUpdate(Message):
+    """ Memory refreshed by the ICD worker: {owner: (values, changed offsets)}, see WatchList.refresh(). """
+    def __init__(self, updates) -> None:
+        self.updates = updates
+        super().__init__()
+
+
+class TargetStatus(Message):
+    """ The CPU started/stopped. """
+    def __init__(self, is_cpuruns: bool) -> None:
+        self.is_cpuruns = is_cpuruns
+        super().__init__()
+
+
+class IcdWorker(threading.Thread):
+    """ The thread that owns the ICD (and the X65Ftdi handle under it).
+        All the ICD transactions run here, off the Textual event loop: the UI submits commands
+        to the queue and gets back the decoded trace rows, registers and the status as messages.
+        Without a command the target is polled: fast while the CPU runs, then less and less often while it is stopped.
+    """
+    POLL_RUNNING = 0.1          # polling interval [s] while the CPU runs
+    POLL_IDLE_MIN = 0.5         # ... just after the CPU stopped or a command,
+    POLL_IDLE_MAX = 4.0         # ... doubled up to this while nothing happens
+
+    def __init__(self, icd: ICD, syms=None) -> None:
+        super().__init__(name="icd-worker", daemon=True)
+        self.icd = icd
+        self.syms = syms
+        self.app = None                 # where to post the messages
+        self.cmds = queue.Queue()       # (command name, args)
+        self.poll_interval = self.POLL_IDLE_MIN
+        self.is_cpuruns = None          # last status sent to the UI
+        self.recs = bytearray()         # trace records to be sent to the UI
+        self.is_gap = True              # the CPU was running (untraced) before the records
+        self.upcoming = None            # the upcoming instruction: (raw record, disassembly)
+        self.cycle_i = 0                # CPU Cycles counter
+        self.watch = WatchList()        # memory regions of the panels, refreshed together
+
+    def submit(self, cmd: str, *args) -> None:
+        """ Queue the command cmd_<cmd>(*args) to be run in the worker. """
+        self.cmds.put((cmd, args))
+
+    def stop(self) -> None:
+        """ Finish the worker; the running command is completed first. """
+        self.cmds.put(None)
+        self.join(timeout=5.0)
+
+    def run(self) -> None:
+        while True:
+            try:
+                item = self.cmds.get(timeout=self.poll_interval)
+            except queue.Empty:
+                item = ('poll', ())
+            if item is None:
+                break
+            (cmd, args) = item
+            if cmd != 'poll':
+                # user activity: look at the target again soon
+                self.poll_interval = self.POLL_IDLE_MIN
+            try:
+                getattr(self, 'cmd_' + cmd)(*args)
+            except Exception as e:
+                print("ERROR: ICD worker command {} failed: {}".format(cmd, e))
+            # send out whatever was traced, in one message
+            if len(self.recs) > 0 or self.upcoming is not None:
+                self.app.post_message(TraceCycles(bytes(self.recs), self.is_gap, self.upcoming))
+                if len(self.recs) > 0:
+                    self.is_gap = False
+                self.recs = bytearray()
+                self.upcoming = None
+
+    def post_status(self, is_cpuruns: bool) -> None:
+        """ Send the CPU status to the UI, if changed; and adapt the polling to it. """
+        if is_cpuruns:
+            self.poll_interval = self.POLL_RUNNING
+        elif self.is_cpuruns or self.is_cpuruns is None:
+            self.poll_interval = self.POLL_IDLE_MIN
+        if is_cpuruns != self.is_cpuruns:
+            self.is_cpuruns = is_cpuruns
+            self.app.post_message(TargetStatus(is_cpuruns))
+
+    def refresh_mem(self, is_cpuruns: bool) -> None:
+        """ Re-read the watched memory in one batch; send the changes to the UI.
+            Sent even without a change, to end the highlighting of the previous one. """
+        if len(self.watch.regions) > 0:
+            self.app.post_message(MemUpdate(self.watch.refresh(self.icd, is_cpuruns)))
+
+    def cmd_watch_set(self, owner: str, regions) -> None:
+        """ Set the memory regions watched by the panel owner, and read them. """
+        self.watch.set(owner, regions)
+        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace(sample_cpu=True)
+        self.refresh_mem(is_cpuruns)
 
-   
-    def on_timer(self) -> None:
-        """ Called from interval timer, in main loop - assume ICD is accessible """
+    def cmd_poll(self) -> None:
+        """ Called when there was no command for poll_interval """
         # read the current trace register, without disturbing it
         is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace(sample_cpu=True)
-        self.statuslabel.update("Status: {}".format('CPU RUNs' if is_cpuruns else 'CPU Stopped' ))
+        was_running = self.is_cpuruns is True
+        was_idle = self.is_cpuruns is False
+        self.post_status(is_cpuruns)
+        if was_idle:
+            # nothing changed since the last poll: back off
+            self.poll_interval = min(self.poll_interval * 2, self.POLL_IDLE_MAX)
+        if is_cpuruns or was_running:
+            # the memory changes while running; the last refresh when it stopped
+            self.refresh_mem(is_cpuruns)
 
         # check if trace buffer memory is non-empty, while CPU stopped
         if not is_cpuruns and is_tbr_valid:
@@ -145,32 +481,25 @@ class DebuggerApp(App):
             self.update_tracebuffer()
             
 
-    def action_run_stop_cpu(self) -> None:
-        """An action to run/stop the cpu."""
+    def cmd_run_stop(self) -> None:
+        """Run/stop the cpu."""
         # read the current trace register, without disturbing it
         is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace(sample_cpu=True)
         if is_cpuruns:
             # CPU runs --> stop it!
             self.icd.cpu_ctrl(False, False, False)
+            self.post_status(False)
+            self.refresh_mem(False)
         else:
             # CPU stopped --> run it: deactivate the reset, run the cpu
             self.icd.cpu_ctrl(True, False, False)
-            # add line to the trace view
-            # isnt there an 'preview'/'upcoming' row in the table?
-            # if yes then we should remove it first, to replace with new data
-            if self.tracetb_row_preview is not None:
-                self.tracetb.remove_row(self.tracetb_row_preview)
-                self.tracetb_row_preview = None
-            
-            self.tracetb.add_row("----", 
-                                "----", "----", "----", "----", 
-                                "----", "----", "----", "----")
-            # move cursor to the last entry
-            self.tracetb.move_cursor(row=self.tracetb.row_count)
-        
+            self.post_status(True)
+            # the cycles are not traced until it stops
+            self.is_gap = True
+
     
-    def action_step_cpu(self) -> None:
-        """Action to step the CPU by 1 cc"""
+    def cmd_step(self, step_count: int) -> None:
+        """Step the CPU by step_count instructions, stop it first if running"""
         # self.dark = not self.dark
         # print("action_step_cpu called")
         # Now we should normally step the CPU by one cycle.
@@ -187,10 +516,11 @@ class DebuggerApp(App):
         if is_cpuruns:
             # CPU runs --> stop it!
             self.icd.cpu_ctrl(False, False, False)
+            self.post_status(False)
             # print the buffer out
             self.update_tracebuffer()
 
-        self.do_step_cpu(step_count = 1)              # step just 1 instruction (few cycles)
+        self.do_step_cpu(step_count)
 
 
     def do_step_cpu(self, step_count: int) -> None:
@@ -214,7 +544,7 @@ class DebuggerApp(App):
                     # sanity check /assert:
                     if is_valid or is_cpuruns:
                         print("ERROR: Unexpected IS_VALID=TRUE or IS_CPURUNS=True: COMMUNICATION ERROR!!")
-                        exit(1)
+                        return
                     # We expect is_valid=False because this is not a trace reg from a finished CPU cycle.
                     # Instead, the command sample_cpu=True just samples the stopped CPU state before it is commited.
                     # Let's inspect it to see if this is already a new upcoming instruction, or contination of the old (last) one.
@@ -225,7 +555,7 @@ class DebuggerApp(App):
                         # print()
                         # print("Upcoming:    ", end='')
                         # decode and print cycle line
-                        self.print_traceline(self.cycle_i, tbuf, is_upcoming=True)
+                        self.print_traceline(rawbuf, is_upcoming=True)
                         break
                 
                 # FIXME add
@@ -254,7 +584,7 @@ class DebuggerApp(App):
                 if self.cycle_i > 0:
                     # we expected that is_tbr_valid==0 because we remove entries as we go.
                     print("IS_TBR_VALID=TRUE: COMMUNICATION ERROR!!")
-                    exit(1)
+                    return
                 # print the buffer out
                 self.print_tracebuffer()
             
@@ -270,13 +600,13 @@ class DebuggerApp(App):
                     step_i += 1
                     cycles_without_step = 0
                 # decode and print cycle line
-                self.print_traceline(self.cycle_i, tbuf)
+                self.print_traceline(rawbuf)
             else:
                 # print("N/A")
                 # sanity: this could happen just on the first for-iter!
                 if self.cycle_i > 0:
                     print("IS_VALID=FALSE: COMMUNICATION ERROR!!")
-                    exit(1)
+                    return
 
             # if cycle_i == 0:
             #     # first iteration; all history up to here was printed.
@@ -298,12 +628,10 @@ class DebuggerApp(App):
         cpust_fin = CpuRegs()
         if cpust_fin.cpu_read_regs(self.icd):
             # print(cpust_fin)
-            self.cpuregs.update(cpust_fin)
+            self.app.post_message(RegsUpdate(cpust_fin))
         else:
             print("ERROR: CPU State read failed!!")
-
-        # move cursor to the last entry
-        self.tracetb.move_cursor(row=self.tracetb.row_count)
+        self.refresh_mem(False)
 
 
     # def _on_idle(self) -> None:
@@ -323,89 +651,234 @@ class DebuggerApp(App):
             self.cycle_i = 0
             # print the buffer out
             self.print_tracebuffer()
-            # move cursor to the last entry
-            self.tracetb.move_cursor(row=self.tracetb.row_count)
 
 
     def print_tracebuffer(self):
-        """ Retrieve the complete trace buffer from HW and run print_traceline() over it. """
-        # retrieve line from trace buffer
-        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace(tbr_deq=True)
-        rbuf_list = []
-        while is_tbr_valid:
-            # note down
-            rbuf_list.append(rawbuf)
-            # fetch next trace item into reg
-            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace(tbr_deq=True)
-        # print out
-        for i in range(0, len(rbuf_list)):
-            # print("Cyc #{:5}:  ".format(i - len(rbuf_list)), end='')
-            cycle_nr = i - len(rbuf_list)
-            tbuf = ICD.TraceReg(rbuf_list[i])
-            self.print_traceline(cycle_nr, tbuf)
-
-
-    def print_traceline(self, cycle_nr, tbuf: ICD.TraceReg, is_upcoming=False):
-        """ Decode the given tbuf instruction and append it to the tracetb widget. """
-        # decode instruction in the trace buffer
-        disinst = decode_traced_instr(self.icd, tbuf, is_upcoming)
-
-        # IO area is between 0x9F00 and 0x9FFF of the CPU memory map
-        IO_START_ADDR = 0x9F00          # TODO: move to common!
-        IO_END_ADDR = 0x9FFF
-
-        # extract signal values from trace buffer array
-        CBA = tbuf.CBA  #tbuf[6]           # CPU Bank Address (816 topmost 8 bits; dont confuse with CX16 stuff!!)
-        MAH = tbuf.MAH  #tbuf[5]           # Memory Address High = Physical 8kB Page in SRAM
-        CA = tbuf.CA  #tbuf[4] * 256 + tbuf[3]        # CPU Address, 16-bit
-        CD = tbuf.CD  #tbuf[2]                # CPU Data
-        is_sync = tbuf.is_sync  #(tbuf[0] & ISYNC) == ISYNC
-        is_io = (CA >= IO_START_ADDR and CA <= IO_END_ADDR)
-        is_write = not tbuf.is_read_nwrite  #not(tbuf[0] & TRACE_FLAG_RWN)
-        is_addr_invalid = not(tbuf.is_vpa or tbuf.is_vda)   # not((tbuf[0] & TRACE_FLAG_SYNC_VPA) or (tbuf[0] & TRACE_FLAG_VDA))
-        mah_area = ICD.MAHDecoded.from_trace(MAH, CBA, CA).area_name
+        """ Retrieve the complete trace buffer from HW, for the trace panel. """
+        # retrieve the whole trace buffer in one go; the panel disassembles it from the traced cycles themselves
+        self.recs += self.icd.drain_tracebuffer()
 
-        ctr = "${:02x}:{}{}{}{}".format(tbuf.ctr_flags, 
-                ('-' if tbuf.is_resetn else 'R'),
-                ('-' if tbuf.is_irqn else 'I'),
-                ('-' if tbuf.is_nmin else 'N'),
-                ('-' if tbuf.is_abortn else '[red]A[/red]'))
-        sta = "${:02x}:{}{}{}{}{}{}{}{}{}".format(tbuf.sta_flags, 
-                ('r' if tbuf.is_read_nwrite else '[red]W[/red]'), 
-                ('-' if tbuf.is_vectpull else '[yellow]v[/yellow]'),        # vector pull, active low
-                ('-' if tbuf.is_mlock else 'L'),           # mem lock, active low
-                ('e' if tbuf.is_emu8 else '[blue]N[/blue]'),        # 'e': emulation mode, active high; 'N' native mode
-                ('m' if tbuf.is_am8 else '[blue]M[/blue]'),    # '816 M-flag (acumulator): 0=> 16-bit 'M', 1=> 8-bit 'm'
-                ('x' if tbuf.is_xy8 else '[blue]X[/blue]'),    # '816 X-flag (index regs): 0=> 16-bit 'X', 1=> 8-bit 'x'
-                ('P' if tbuf.is_vpa else '-'),        # '02: SYNC, '816: VPA (valid program address)
-                ('D' if tbuf.is_vda else '-'),             # '02: always 1, '816: VDA (valid data address)
-                ('S' if is_sync else '-'))
 
-        # isnt there an 'preview'/'upcoming' row in the table?
-        # if yes then we should remove it first, to replace with new data
-        if self.tracetb_row_preview is not None:
-            self.tracetb.remove_row(self.tracetb_row_preview)
-            self.tracetb_row_preview = None
-        
+    def print_traceline(self, rawbuf, is_upcoming=False):
+        """ Queue the trace record for the trace panel.
+            The upcoming instruction is not traced yet: it is decoded here, from the memory. """
         if is_upcoming:
-            # special: not real, but an upcoming instruction cycle
-            self.tracetb_row_preview = self.tracetb.add_row("[underline]next[/underline]", 
-                                                            "${:02x}".format(MAH), mah_area, "${:02x}".format(CBA), "${:04x}".format(CA), 
-                                                            "${:02x}".format(CD), ctr, sta, "[yellow]"+disinst+"[/yellow]")
-            return self.tracetb_row_preview
+            disinst = decode_traced_instr(self.icd, ICD.TraceReg(rawbuf), True, self.syms)
+            self.upcoming = (bytes(rawbuf[0:ICD.TRACEREC_SIZE]), disinst)
         else:
-            # normal cycle
-            return self.tracetb.add_row(cycle_nr, "${:02x}".format(MAH), mah_area, "${:02x}".format(CBA), "${:04x}".format(CA), 
-                             "${:02x}".format(CD), ctr, sta, "[green]"+disinst+"[/green]")
+            self.recs += rawbuf[0:ICD.TRACEREC_SIZE]
 
-        
+
+class DebuggerApp(App):
+    """A Textual app to debug X65."""
+
+    BINDINGS = [("r", "run_stop_cpu", "Run/Stop"), 
+                ("s", "step_cpu", "Step"),
+                ("g", "prompt('cycle')", "Go to cycle"),
+                ("slash", "prompt('address')", "Find address"),
+                ("n", "find_next", "Find next"),
+                ("m", "prompt('memory')", "Memory"),
+                ("w", "prompt('watch')", "Add watch"),
+                ("q", "quit", "Quit")]
+
+    def compose(self) -> ComposeResult:
+        """Create child widgets for the app."""
+        yield Header()
+        yield Footer()
+        with HorizontalScroll():
+            with Vertical():
+                yield Static(TracePanel.header())
+                yield TracePanel(self.is_cputype02, self.syms, self.trace_depth, id="trace", classes="box")
+                yield Input(id="prompt")
+            with VerticalScroll():
+                yield Label("Status:", id="targetstatus")
+                yield CpuRegView(id='cpuregs')
+                for (i, (area, addr)) in enumerate(self.mem_views):
+                    yield MemPanel(area, addr, id="mem{}".format(i))
+                yield WatchPanel(id="watches")
+            
+        # yield RichLog(markup=True)
+
+        self.find_range = None           # the last searched address range
+
+
+    def on_ready(self) -> None:
+        """Called  when the DOM is ready."""
+        # text_log = self.query_one(RichLog)
+        # text_log.write(Syntax(CODE, "python", indent_guides=True))
+        # rows = iter(csv.reader(io.StringIO(CSV)))
+        # table = Table(*next(rows))
+        # for row in rows:
+        #     table.add_row(*row)
+        # text_log.write(table)
+        # text_log.write("[bold magenta]Write text or any Rich renderable!")
+        # text_log.write("")
+        # self.timer = Timer(event_target=self, interval=0.5)
+        self.statuslabel = self.query_one("#targetstatus")
+
+        self.tracetb = self.query_one('#trace')
+        self.prompt = self.query_one('#prompt')
+        self.prompt.display = False
+        self.tracetb.focus()
+
+        self.cpuregs = self.query_one('#cpuregs')
+        self.cpuregs.on_ready()
+
+        self.watches = self.query_one('#watches')
+        for (name, area, addr, size) in self.watch_args:
+            self.watches.add(name, area, addr, size)
+        for p in self.query(MemPanel):
+            self.icdw.submit('watch_set', p.id, p.regions())
+        self.icdw.submit('watch_set', self.watches.id, self.watches.regions())
+        # table.add_rows(ROWS[1:])
+        # table.add_row(-255, 6, "(RAMB:134)", "$00", "$c1cd", "$6b", "$0f:----",  "$7d:r--NmXPDS", "[green]RTL[/green]")
+
+        # all the ICD communication runs in the worker thread
+        self.icdw.app = self
+        self.icdw.start()
+
+
+    def on_unmount(self) -> None:
+        self.icdw.stop()
+
+
+    def action_run_stop_cpu(self) -> None:
+        """An action to run/stop the cpu."""
+        self.icdw.submit('run_stop')
+
+
+    def action_step_cpu(self) -> None:
+        """Action to step the CPU by 1 instruction"""
+        self.icdw.submit('step', 1)
+
+
+    def on_target_status(self, message: TargetStatus) -> None:
+        self.statuslabel.update("Status: {}".format('CPU RUNs' if message.is_cpuruns else 'CPU Stopped' ))
+
+
+    def on_regs_update(self, message: RegsUpdate) -> None:
+        self.cpuregs.update(message.regs)
+
+
+    def on_trace_cycles(self, message: TraceCycles) -> None:
+        self.tracetb.append(message.recs, message.is_gap, message.upcoming)
+
+
+    def on_mem_update(self, message: MemUpdate) -> None:
+        for p in [ *self.query(MemPanel), self.watches ]:
+            if p.id in message.updates:
+                p.show(*message.updates[p.id])
+            elif len(p.hot) > 0:
+                # unchanged: just end the highlighting
+                p.show(p.vals, set())
+
+
+    def action_prompt(self, what: str) -> None:
+        """ Ask for the cycle number or the address to find in the trace, or the memory to show """
+        self.prompt_what = what
+        self.prompt.placeholder = {
+            'cycle': "cycle number",
+            'address': "CPU address: $C000, $01:C000, or a range $0200-$02FF",
+            'memory': "[AREA:]ADDR or a symbol; AREA: " + ", ".join(AREAS),
+            'watch': "[NAME=][AREA:]ADDR[/SIZE] or SYMBOL[/SIZE]; AREA: " + ", ".join(AREAS),
+        }[what]
+        self.prompt.value = ""
+        self.prompt.display = True
+        self.prompt.focus()
+
+
+    def on_input_submitted(self, message: Input.Submitted) -> None:
+        self.prompt.display = False
+        self.tracetb.focus()
+        try:
+            if self.prompt_what == 'cycle':
+                self.tracetb.show_cycle(int(message.value, 0))
+            elif self.prompt_what == 'memory':
+                # the focused memory panel, or the first one
+                p = self.focused if isinstance(self.focused, MemPanel) else self.query(MemPanel).first()
+                p.set_addr(*parse_mem_addr(message.value, self.syms)[0:2])
+                self.icdw.submit('watch_set', p.id, p.regions())
+            elif self.prompt_what == 'watch':
+                self.watches.add(*parse_watch(message.value, self.syms))
+                self.icdw.submit('watch_set', self.watches.id, self.watches.regions())
+            else:
+                self.find_range = parse_addr_range(message.value)
+                self.action_find_next()
+        except ValueError:
+            self.notify("Invalid {}: {}".format(self.prompt_what, message.value), severity="error")
+
+
+    def action_find_next(self) -> None:
+        if self.find_range is not None and not self.tracetb.find_address(*self.find_range):
+            self.notify("Address not found in the trace")
+
+
+# Parse the CPU address "[BANK:]ADDR" (hex, with an optional $ or 0x)
+def parse_addr(a: str):
+    a = a.strip().replace('$', '').replace('0x', '')
+    (bank, _, ca) = a.rpartition(':')
+    return (int(bank, 16) << 16 if bank else 0) | int(ca, 16)
+
+
+# Parse the CPU address or the range "ADDR-ADDR"; returns [lo, hi)
+def parse_addr_range(s: str):
+    (lo, _, hi) = s.partition('-')
+    return (parse_addr(lo), parse_addr(hi) + 1 if hi else parse_addr(lo) + 1)
+
+
+# Parse the memory address "[AREA:]ADDR" or a symbol name (a CPU address); returns (area, addr, size of the symbol)
+def parse_mem_addr(s: str, syms=None):
+    s = s.strip()
+    if syms is not None:
+        r = syms.find(s)
+        if r is not None:
+            return ('cpu', r[0], max(r[1], 1))
+    (area, _, a) = s.partition(':')
+    if area.lower() in AREAS:
+        return (area.lower(), parse_addr(a), 1)
+    return ('cpu', parse_addr(s), 1)
+
+
+# Parse the watch "[NAME=]WHERE[/SIZE]", WHERE as in parse_mem_addr(); returns (name, area, addr, size)
+def parse_watch(s: str, syms=None):
+    (name, _, where) = s.rpartition('=')
+    (where, _, size) = where.partition('/')
+    (area, addr, symsize) = parse_mem_addr(where, syms)
+    return (name.strip() or where.strip(), area, addr, int(size, 0) if size else symsize)
+
+
+# Format the address in the memory area
+def format_mem_addr(area: str, addr: int):
+    if area == 'cpu':
+        return '${:02x}:{:04x}'.format(addr >> 16, addr & 0xffff)
+    elif area == 'io':
+        return '$9f{:02x}'.format(addr & 0xff)
+    else:
+        return '${:05x}'.format(addr)
 
 
 if __name__ == "__main__":
+    apa = argparse.ArgumentParser(usage="%(prog)s [OPTION]",
+        description="Debugger of the X65 computer."
+    )
+    apa.add_argument("-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+    apa.add_argument("-n", "--trace-depth", type=int, default=TracePanel.TRACE_DEPTH, help="Number of the last CPU cycles kept in the trace view.")
+    apa.add_argument("-s", "--symbols", action="append", help="Load symbols from the file (llvm-mos ELF, lld map or ca65 labels); FILE@AREA places them in a memory area, e.g. hello.rom.elf@RomB:0.")
+    apa.add_argument("-m", "--mem", action="append", help="Show a memory panel at [AREA:]ADDR or a symbol, AREA is one of: {}; can be repeated.".format(", ".join(AREAS)))
+    apa.add_argument("-w", "--watch", action="append", help="Watch the memory [NAME=][AREA:]ADDR[/SIZE] or SYMBOL[/SIZE]; can be repeated.")
+    args = apa.parse_args()
+
     app = DebuggerApp()
-    app.icd = ICD(x65ftdi.X65Ftdi())
+    app.syms = None
+    app.trace_depth = args.trace_depth
+    if args.symbols is not None:
+        from symbols import load_symbol_files
+        app.syms = load_symbol_files(args.symbols)
+    app.mem_views = [ parse_mem_addr(m, app.syms)[0:2] for m in (args.mem or [ 'cpu:0' ]) ]
+    app.watch_args = [ parse_watch(w, app.syms) for w in (args.watch or []) ]
+    app.icdw = IcdWorker(ICD(x65ftdi.X65Ftdi()), app.syms)
     # which CPU is installed in the target?
-    app.is_cputype02 = app.icd.is_cputype02()
+    app.is_cputype02 = app.icdw.icd.is_cputype02()
 
     # // deactivate the reset, STOP the cpu
     # app.icd.cpu_ctrl(False, False, False, 
@@ -0,0 +1,354 @@
+#
+# Opcode tables and disassembler of the 65C02 and 65C816 instructions.
+#
+# Each opcode is described by a precompiled record (OpInfo): mnemonic, addressing mode,
+# length, M/X-flag dependent length of immediates, base cycle count and the flow-control class.
+# The records are used by the trace decoder (cpuidec.py) and by the static linear disassembler below.
+#
+import re
+
+
+# Addressing modes; the value is the syntax used in the comments.
+AM_IMP = 'imp'              # implied: NOP
+AM_ACC = 'acc'              # accumulator: ASL A
+AM_IMM = 'imm'              # 8-bit immediate, or signature byte (BRK, COP, WDM): LDA #$12
+AM_IMM_M = 'immm'           # immediate, 8 or 16-bit depending on the M flag: LDA #$1234
+AM_IMM_X = 'immx'           # immediate, 8 or 16-bit depending on the X flag: LDX #$1234
+AM_DP = 'dp'                # direct (zero) page: LDA $12
+AM_DPX = 'dp,x'             # LDA $12,X
+AM_DPY = 'dp,y'             # LDX $12,Y
+AM_DPIND = '(dp)'           # LDA ($12)
+AM_DPINDX = '(dp,x)'        # LDA ($12,X)
+AM_DPINDY = '(dp),y'        # LDA ($12),Y
+AM_DPINDL = '[dp]'          # LDA [$12]
+AM_DPINDLY = '[dp],y'       # LDA [$12],Y
+AM_SR = 'sr'                # stack relative: LDA $12,S
+AM_SRINDY = '(sr),y'        # LDA ($12,S),Y
+AM_ABS = 'abs'              # absolute: LDA $1234
+AM_ABSX = 'abs,x'           # LDA $1234,X
+AM_ABSY = 'abs,y'           # LDA $1234,Y
+AM_ABSIND = '(abs)'         # JMP ($1234)
+AM_ABSINDX = '(abs,x)'      # JMP ($1234,X)
+AM_ABSINDL = '[abs]'        # JML [$1234]
+AM_LONG = 'long'            # absolute long: LDA f:$123456
+AM_LONGX = 'long,x'         # LDA f:$123456,X
+AM_REL = 'rel'              # 8-bit relative branch: BNE $1234
+AM_RELL = 'rell'            # 16-bit relative branch: BRL $1234
+AM_BLOCK = 'blk'            # block move: MVN #$src,#$dst (encoded as dst, src!)
+AM_ZPREL = 'zp,rel'         # 65C02 bit branch: BBR0 $12,$1234
+
+# Flow-control classes
+FLOW_SEQ = 'seq'            # continues with the next instruction
+FLOW_BRANCH = 'branch'      # conditional branch
+FLOW_JUMP = 'jump'          # unconditional jump/branch
+FLOW_CALL = 'call'          # subroutine call (JSR, JSL)
+FLOW_RETURN = 'return'      # subroutine or interrupt return (RTS, RTL, RTI)
+FLOW_INTERRUPT = 'interrupt'    # software interrupt (BRK, COP)
+FLOW_STOP = 'stop'          # STP
+
+
+def _s8(v):
+    return v - 256 if v > 127 else v
+
+def _s16(v):
+    return v - 65536 if v > 32767 else v
+
+# Addressing mode -> (number of operand bytes with 8-bit M/X, format, function(ops, pc) giving the format arguments).
+# pc is the 16-bit address of the opcode.
+_MODES = {
+    AM_IMP:     (0, '', None),
+    AM_ACC:     (0, 'A', None),
+    AM_IMM:     (1, '#${:02x}', lambda o, pc: (o[0],)),
+    AM_IMM_M:   (1, '#${:02x}', lambda o, pc: (o[0],)),
+    AM_IMM_X:   (1, '#${:02x}', lambda o, pc: (o[0],)),
+    AM_DP:      (1, '${:02x}', lambda o, pc: (o[0],)),
+    AM_DPX:     (1, '${:02x},X', lambda o, pc: (o[0],)),
+    AM_DPY:     (1, '${:02x},Y', lambda o, pc: (o[0],)),
+    AM_DPIND:   (1, '(${:02x})', lambda o, pc: (o[0],)),
+    AM_DPINDX:  (1, '(${:02x},X)', lambda o, pc: (o[0],)),
+    AM_DPINDY:  (1, '(${:02x}),Y', lambda o, pc: (o[0],)),
+    AM_DPINDL:  (1, '[${:02x}]', lambda o, pc: (o[0],)),
+    AM_DPINDLY: (1, '[${:02x}],Y', lambda o, pc: (o[0],)),
+    AM_SR:      (1, '${:02x},S', lambda o, pc: (o[0],)),
+    AM_SRINDY:  (1, '(${:02x},S),Y', lambda o, pc: (o[0],)),
+    AM_ABS:     (2, '${:04x}', lambda o, pc: (o[0] | (o[1] << 8),)),
+    AM_ABSX:    (2, '${:04x},X', lambda o, pc: (o[0] | (o[1] << 8),)),
+    AM_ABSY:    (2, '${:04x},Y', lambda o, pc: (o[0] | (o[1] << 8),)),
+    AM_ABSIND:  (2, '(${:04x})', lambda o, pc: (o[0] | (o[1] << 8),)),
+    AM_ABSINDX: (2, '(${:04x},X)', lambda o, pc: (o[0] | (o[1] << 8),)),
+    AM_ABSINDL: (2, '[${:04x}]', lambda o, pc: (o[0] | (o[1] << 8),)),
+    AM_LONG:    (3, 'f:${:06x}', lambda o, pc: (o[0] | (o[1] << 8) | (o[2] << 16),)),
+    AM_LONGX:   (3, 'f:${:06x},X', lambda o, pc: (o[0] | (o[1] << 8) | (o[2] << 16),)),
+    AM_REL:     (1, '${:04x}', lambda o, pc: ((pc + 2 + _s8(o[0])) & 0xFFFF,)),
+    AM_RELL:    (2, '${:04x}', lambda o, pc: ((pc + 3 + _s16(o[0] | (o[1] << 8))) & 0xFFFF,)),
+    AM_BLOCK:   (2, '#${:02x},#${:02x}', lambda o, pc: (o[1], o[0])),
+    AM_ZPREL:   (2, '${:02x},${:04x}', lambda o, pc: (o[0], (pc + 3 + _s8(o[1])) & 0xFFFF)),
+}
+
+# 16-bit immediate (M=0 or X=0)
+_FMT_IMM16 = '#${:04x}'
+
+# Modes with no memory address in the operand
+_NONADDR_MODES = (AM_IMP, AM_ACC, AM_IMM, AM_IMM_M, AM_IMM_X, AM_SR, AM_SRINDY, AM_BLOCK)
+
+
+# Precompiled description of one opcode.
+class OpInfo:
+    __slots__ = ('opcode', 'mnemonic', 'mode', 'length', 'mx', 'cycles', 'flow', 'is_valid',
+                 '_prefix', '_fmt', '_fmt_unk', '_args', '_fmt_sym', '_addr_digits')
+
+    # opcode: 0-255
+    # mnemonic: instruction name; '?' for undefined opcodes of the 65C02
+    # mode: one of AM_*
+    # cycles: base cycle count (8-bit M/X, no page crossing, branch not taken, direct page aligned)
+    # flow: one of FLOW_*
+    def __init__(self, opcode, mnemonic, mode, cycles, flow=FLOW_SEQ, is_valid=True):
+        self.opcode = opcode
+        self.mnemonic = mnemonic
+        self.mode = mode
+        self.cycles = cycles
+        self.flow = flow
+        self.is_valid = is_valid
+        (nops, self._fmt, self._args) = _MODES[mode]
+        # instruction length in bytes including the opcode, with 8-bit M/X
+        self.length = 1 + nops
+        # immediates which become 16-bit with M=0 or X=0
+        self.mx = 'm' if mode == AM_IMM_M else 'x' if mode == AM_IMM_X else None
+        self._prefix = mnemonic + ' ' if self._fmt != '' else mnemonic
+        # the operand with unknown bytes
+        self._fmt_unk = self._fmt.replace('{:02x}', '??').replace('{:04x}', '????').replace('{:06x}', '??????')
+        # the operand with the addresses substituted by strings (symbols), and the hex digits of each address
+        if mode in _NONADDR_MODES:
+            (self._fmt_sym, self._addr_digits) = (None, None)
+        else:
+            self._fmt_sym = re.sub(r'\$\{:0\dx\}', '{}', self._fmt)
+            self._addr_digits = [ int(d) for d in re.findall(r'\{:0(\d)x\}', self._fmt) ]
+
+    # Instruction length in bytes including the opcode, for the given M and X flags (True = 8-bit).
+    def size(self, m_flag=True, x_flag=True):
+        if self.mx is None:
+            return self.length
+        if self.mx == 'm':
+            return self.length if m_flag else self.length + 1
+        return self.length if x_flag else self.length + 1
+
+    # Format the instruction.
+    # ibytes: the instruction bytes starting with the opcode; operand bytes which are missing
+    #         or None (not known) are shown as '??'.
+    # pc: address of the opcode (just the lower 16 bits matter), for the relative branches
+    # m_flag, x_flag: True => 8-bit immediates
+    # symname: optional function(address, number of address bytes) giving the symbolic name of an address
+    #          operand (e.g. SymbolTable.format_addr), or None to keep the number
+    def format(self, ibytes, pc=0, m_flag=True, x_flag=True, symname=None) -> str:
+        if self._args is None:
+            return self._prefix + self._fmt
+        n = self.size(m_flag, x_flag)
+        ops = ibytes[1:n]
+        if len(ops) < n - 1 or (isinstance(ops, list) and None in ops):
+            # some operand bytes are not known
+            if n > self.length:
+                return self._prefix + _FMT_IMM16.replace('{:04x}', '????')
+            return self._prefix + self._fmt_unk
+        if n > self.length:
+            return self._prefix + _FMT_IMM16.format(ops[0] | (ops[1] << 8))
+        args = self._args(ops, pc)
+        if symname is not None and self._fmt_sym is not None:
+            names = [ symname(v, d // 2) for (v, d) in zip(args, self._addr_digits) ]
+            if any(nm is not None for nm in names):
+                return self._prefix + self._fmt_sym.format(*[ nm if nm is not None else '${:0{}x}'.format(v, d)
+                                                                for (nm, v, d) in zip(names, args, self._addr_digits) ])
+        return self._prefix + self._fmt.format(*args)
+
+    # Static target address of the branch, jump or call, or None if it could not be determined
+    # from the instruction alone (indirect jumps, returns, other instructions).
+    # The result is 16-bit (within the program bank) except for the long jumps/calls, which are 24-bit.
+    def target(self, ibytes, pc=0):
+        if self.flow not in (FLOW_BRANCH, FLOW_JUMP, FLOW_CALL):
+            return None
+        ops = ibytes[1:self.length]
+        if len(ops) < self.length - 1 or (isinstance(ops, list) and None in ops):
+            return None
+        if self.mode in (AM_REL, AM_RELL, AM_ABS, AM_LONG):
+            return self._args(ops, pc)[0]
+        if self.mode == AM_ZPREL:
+            return self._args(ops, pc)[1]
+        return None
+
+    def __repr__(self):
+        return "OpInfo(${:02x}, {}, {}, len={}, cyc={}, {})".format(self.opcode, self.mnemonic, self.mode,
+                    self.length, self.cycles, self.flow)
+
+
+_FLOWS = {
+    'BPL': FLOW_BRANCH, 'BMI': FLOW_BRANCH, 'BVC': FLOW_BRANCH, 'BVS': FLOW_BRANCH,
+    'BCC': FLOW_BRANCH, 'BCS': FLOW_BRANCH, 'BNE': FLOW_BRANCH, 'BEQ': FLOW_BRANCH,
+    'BRA': FLOW_JUMP, 'BRL': FLOW_JUMP, 'JMP': FLOW_JUMP, 'JML': FLOW_JUMP,
+    'JSR': FLOW_CALL, 'JSL': FLOW_CALL,
+    'RTS': FLOW_RETURN, 'RTL': FLOW_RETURN, 'RTI': FLOW_RETURN,
+    'BRK': FLOW_INTERRUPT, 'COP': FLOW_INTERRUPT,
+    'STP': FLOW_STOP,
+}
+
+# 65C816 opcodes 00 to FF: (mnemonic, addressing mode, base cycles)
+_W65C816_OPS = [
+    # 0
+    ('BRK', AM_IMM, 7), ('ORA', AM_DPINDX, 6), ('COP', AM_IMM, 7), ('ORA', AM_SR, 4),
+    ('TSB', AM_DP, 5), ('ORA', AM_DP, 3), ('ASL', AM_DP, 5), ('ORA', AM_DPINDL, 6),
+    ('PHP', AM_IMP, 3), ('ORA', AM_IMM_M, 2), ('ASL', AM_ACC, 2), ('PHD', AM_IMP, 4),
+    ('TSB', AM_ABS, 6), ('ORA', AM_ABS, 4), ('ASL', AM_ABS, 6), ('ORA', AM_LONG, 5),
+    # 1
+    ('BPL', AM_REL, 2), ('ORA', AM_DPINDY, 5), ('ORA', AM_DPIND, 5), ('ORA', AM_SRINDY, 7),
+    ('TRB', AM_DP, 5), ('ORA', AM_DPX, 4), ('ASL', AM_DPX, 6), ('ORA', AM_DPINDLY, 6),
+    ('CLC', AM_IMP, 2), ('ORA', AM_ABSY, 4), ('INC', AM_ACC, 2), ('TCS', AM_IMP, 2),
+    ('TRB', AM_ABS, 6), ('ORA', AM_ABSX, 4), ('ASL', AM_ABSX, 7), ('ORA', AM_LONGX, 5),
+    # 2
+    ('JSR', AM_ABS, 6), ('AND', AM_DPINDX, 6), ('JSL', AM_LONG, 8), ('AND', AM_SR, 4),
+    ('BIT', AM_DP, 3), ('AND', AM_DP, 3), ('ROL', AM_DP, 5), ('AND', AM_DPINDL, 6),
+    ('PLP', AM_IMP, 4), ('AND', AM_IMM_M, 2), ('ROL', AM_ACC, 2), ('PLD', AM_IMP, 5),
+    ('BIT', AM_ABS, 4), ('AND', AM_ABS, 4), ('ROL', AM_ABS, 6), ('AND', AM_LONG, 5),
+    # 3
+    ('BMI', AM_REL, 2), ('AND', AM_DPINDY, 5), ('AND', AM_DPIND, 5), ('AND', AM_SRINDY, 7),
+    ('BIT', AM_DPX, 4), ('AND', AM_DPX, 4), ('ROL', AM_DPX, 6), ('AND', AM_DPINDLY, 6),
+    ('SEC', AM_IMP, 2), ('AND', AM_ABSY, 4), ('DEC', AM_ACC, 2), ('TSC', AM_IMP, 2),
+    ('BIT', AM_ABSX, 4), ('AND', AM_ABSX, 4), ('ROL', AM_ABSX, 7), ('AND', AM_LONGX, 5),
+    # 4
+    ('RTI', AM_IMP, 6), ('EOR', AM_DPINDX, 6), ('WDM', AM_IMM, 2), ('EOR', AM_SR, 4),
+    ('MVP', AM_BLOCK, 7), ('EOR', AM_DP, 3), ('LSR', AM_DP, 5), ('EOR', AM_DPINDL, 6),
+    ('PHA', AM_IMP, 3), ('EOR', AM_IMM_M, 2), ('LSR', AM_ACC, 2), ('PHK', AM_IMP, 3),
+    ('JMP', AM_ABS, 3), ('EOR', AM_ABS, 4), ('LSR', AM_ABS, 6), ('EOR', AM_LONG, 5),
+    # 5
+    ('BVC', AM_REL, 2), ('EOR', AM_DPINDY, 5), ('EOR', AM_DPIND, 5), ('EOR', AM_SRINDY, 7),
+    ('MVN', AM_BLOCK, 7), ('EOR', AM_DPX, 4), ('LSR', AM_DPX, 6), ('EOR', AM_DPINDLY, 6),
+    ('CLI', AM_IMP, 2), ('EOR', AM_ABSY, 4), ('PHY', AM_IMP, 3), ('TCD', AM_IMP, 2),
+    ('JML', AM_LONG, 4), ('EOR', AM_ABSX, 4), ('LSR', AM_ABSX, 7), ('EOR', AM_LONGX, 5),
+    # 6
+    ('RTS', AM_IMP, 6), ('ADC', AM_DPINDX, 6), ('PER', AM_RELL, 6), ('ADC', AM_SR, 4),
+    ('STZ', AM_DP, 3), ('ADC', AM_DP, 3), ('ROR', AM_DP, 5), ('ADC', AM_DPINDL, 6),
+    ('PLA', AM_IMP, 4), ('ADC', AM_IMM_M, 2), ('ROR', AM_ACC, 2), ('RTL', AM_IMP, 6),
+    ('JMP', AM_ABSIND, 5), ('ADC', AM_ABS, 4), ('ROR', AM_ABS, 6), ('ADC', AM_LONG, 5),
+    # 7
+    ('BVS', AM_REL, 2), ('ADC', AM_DPINDY, 5), ('ADC', AM_DPIND, 5), ('ADC', AM_SRINDY, 7),
+    ('STZ', AM_DPX, 4), ('ADC', AM_DPX, 4), ('ROR', AM_DPX, 6), ('ADC', AM_DPINDLY, 6),
+    ('SEI', AM_IMP, 2), ('ADC', AM_ABSY, 4), ('PLY', AM_IMP, 4), ('TDC', AM_IMP, 2),
+    ('JMP', AM_ABSINDX, 6), ('ADC', AM_ABSX, 4), ('ROR', AM_ABSX, 7), ('ADC', AM_LONGX, 5),
+    # 8
+    ('BRA', AM_REL, 3), ('STA', AM_DPINDX, 6), ('BRL', AM_RELL, 4), ('STA', AM_SR, 4),
+    ('STY', AM_DP, 3), ('STA', AM_DP, 3), ('STX', AM_DP, 3), ('STA', AM_DPINDL, 6),
+    ('DEY', AM_IMP, 2), ('BIT', AM_IMM_M, 2), ('TXA', AM_IMP, 2), ('PHB', AM_IMP, 3),
+    ('STY', AM_ABS, 4), ('STA', AM_ABS, 4), ('STX', AM_ABS, 4), ('STA', AM_LONG, 5),
+    # 9
+    ('BCC', AM_REL, 2), ('STA', AM_DPINDY, 6), ('STA', AM_DPIND, 5), ('STA', AM_SRINDY, 7),
+    ('STY', AM_DPX, 4), ('STA', AM_DPX, 4), ('STX', AM_DPY, 4), ('STA', AM_DPINDLY, 6),
+    ('TYA', AM_IMP, 2), ('STA', AM_ABSY, 5), ('TXS', AM_IMP, 2), ('TXY', AM_IMP, 2),
+    ('STZ', AM_ABS, 4), ('STA', AM_ABSX, 5), ('STZ', AM_ABSX, 5), ('STA', AM_LONGX, 5),
+    # A
+    ('LDY', AM_IMM_X, 2), ('LDA', AM_DPINDX, 6), ('LDX', AM_IMM_X, 2), ('LDA', AM_SR, 4),
+    ('LDY', AM_DP, 3), ('LDA', AM_DP, 3), ('LDX', AM_DP, 3), ('LDA', AM_DPINDL, 6),
+    ('TAY', AM_IMP, 2), ('LDA', AM_IMM_M, 2), ('TAX', AM_IMP, 2), ('PLB', AM_IMP, 4),
+    ('LDY', AM_ABS, 4), ('LDA', AM_ABS, 4), ('LDX', AM_ABS, 4), ('LDA', AM_LONG, 5),
+    # B
+    ('BCS', AM_REL, 2), ('LDA', AM_DPINDY, 5), ('LDA', AM_DPIND, 5), ('LDA', AM_SRINDY, 7),
+    ('LDY', AM_DPX, 4), ('LDA', AM_DPX, 4), ('LDX', AM_DPY, 4), ('LDA', AM_DPINDLY, 6),
+    ('CLV', AM_IMP, 2), ('LDA', AM_ABSY, 4), ('TSX', AM_IMP, 2), ('TYX', AM_IMP, 2),
+    ('LDY', AM_ABSX, 4), ('LDA', AM_ABSX, 4), ('LDX', AM_ABSY, 4), ('LDA', AM_LONGX, 5),
+    # C
+    ('CPY', AM_IMM_X, 2), ('CMP', AM_DPINDX, 6), ('REP', AM_IMM, 3), ('CMP', AM_SR, 4),
+    ('CPY', AM_DP, 3), ('CMP', AM_DP, 3), ('DEC', AM_DP, 5), ('CMP', AM_DPINDL, 6),
+    ('INY', AM_IMP, 2), ('CMP', AM_IMM_M, 2), ('DEX', AM_IMP, 2), ('WAI', AM_IMP, 3),
+    ('CPY', AM_ABS, 4), ('CMP', AM_ABS, 4), ('DEC', AM_ABS, 6), ('CMP', AM_LONG, 5),
+    # D
+    ('BNE', AM_REL, 2), ('CMP', AM_DPINDY, 5), ('CMP', AM_DPIND, 5), ('CMP', AM_SRINDY, 7),
+    ('PEI', AM_DPIND, 6), ('CMP', AM_DPX, 4), ('DEC', AM_DPX, 6), ('CMP', AM_DPINDLY, 6),
+    ('CLD', AM_IMP, 2), ('CMP', AM_ABSY, 4), ('PHX', AM_IMP, 3), ('STP', AM_IMP, 3),
+    ('JML', AM_ABSINDL, 6), ('CMP', AM_ABSX, 4), ('DEC', AM_ABSX, 7), ('CMP', AM_LONGX, 5),
+    # E
+    ('CPX', AM_IMM_X, 2), ('SBC', AM_DPINDX, 6), ('SEP', AM_IMM, 3), ('SBC', AM_SR, 4),
+    ('CPX', AM_DP, 3), ('SBC', AM_DP, 3), ('INC', AM_DP, 5), ('SBC', AM_DPINDL, 6),
+    ('INX', AM_IMP, 2), ('SBC', AM_IMM_M, 2), ('NOP', AM_IMP, 2), ('XBA', AM_IMP, 3),
+    ('CPX', AM_ABS, 4), ('SBC', AM_ABS, 4), ('INC', AM_ABS, 6), ('SBC', AM_LONG, 5),
+    # F
+    ('BEQ', AM_REL, 2), ('SBC', AM_DPINDY, 5), ('SBC', AM_DPIND, 5), ('SBC', AM_SRINDY, 7),
+    ('PEA', AM_ABS, 5), ('SBC', AM_DPX, 4), ('INC', AM_DPX, 6), ('SBC', AM_DPINDLY, 6),
+    ('SED', AM_IMP, 2), ('SBC', AM_ABSY, 4), ('PLX', AM_IMP, 4), ('XCE', AM_IMP, 2),
+    ('JSR', AM_ABSINDX, 8), ('SBC', AM_ABSX, 4), ('INC', AM_ABSX, 7), ('SBC', AM_LONGX, 5),
+]
+
+# 65C02 opcodes which differ from the 65C816: (mnemonic, addressing mode, base cycles).
+# The undefined opcodes ('?') are NOPs of the given length and timing in the W65C02S.
+_W65C02_OPS_DIFF = {
+    0x02: ('?', AM_IMM, 2), 0x22: ('?', AM_IMM, 2), 0x42: ('?', AM_IMM, 2), 0x62: ('?', AM_IMM, 2),
+    0x82: ('?', AM_IMM, 2), 0xC2: ('?', AM_IMM, 2), 0xE2: ('?', AM_IMM, 2),
+    0x44: ('?', AM_DP, 3), 0x54: ('?', AM_DPX, 4), 0xD4: ('?', AM_DPX, 4), 0xF4: ('?', AM_DPX, 4),
+    0x5C: ('?', AM_ABS, 8), 0xDC: ('?', AM_ABS, 4), 0xFC: ('?', AM_ABS, 4),
+    0x6C: ('JMP', AM_ABSIND, 6),
+    0x1E: ('ASL', AM_ABSX, 6), 0x3E: ('ROL', AM_ABSX, 6), 0x5E: ('LSR', AM_ABSX, 6), 0x7E: ('ROR', AM_ABSX, 6),
+    0xCB: ('WAI', AM_IMP, 3), 0xDB: ('STP', AM_IMP, 3),
+}
+
+def _build_w65c02_ops():
+    ops = []
+    for opc in range(0, 256):
+        if opc in _W65C02_OPS_DIFF:
+            ops.append(_W65C02_OPS_DIFF[opc])
+        elif (opc & 0x0F) == 0x03 or (opc & 0x0F) == 0x0B:
+            # single-byte, single-cycle NOPs
+            ops.append(('?', AM_IMP, 1))
+        elif (opc & 0x0F) == 0x07:
+            # RMBx / SMBx
+            ops.append(('{}{}'.format('SMB' if opc & 0x80 else 'RMB', (opc >> 4) & 7), AM_DP, 5))
+        elif (opc & 0x0F) == 0x0F:
+            # BBRx / BBSx
+            ops.append(('{}{}'.format('BBS' if opc & 0x80 else 'BBR', (opc >> 4) & 7), AM_ZPREL, 5))
+        else:
+            (mn, mode, cyc) = _W65C816_OPS[opc]
+            # no 16-bit immediates in the 65C02
+            if mode == AM_IMM_M or mode == AM_IMM_X:
+                mode = AM_IMM
+            ops.append((mn, mode, cyc))
+    return ops
+
+def _make_table(ops):
+    table = []
+    for opc in range(0, 256):
+        (mn, mode, cyc) = ops[opc]
+        flow = FLOW_BRANCH if mn.startswith('BB') else _FLOWS.get(mn, FLOW_SEQ)
+        table.append(OpInfo(opc, mn, mode, cyc, flow, mn != '?'))
+    return table
+
+# The opcode tables, indexed by the opcode value.
+W65C816_OPS = _make_table(_W65C816_OPS)
+W65C02_OPS = _make_table(_build_w65c02_ops())
+
+
+# Return the opcode table for the CPU type.
+def opcode_table(is_cputype02: bool):
+    return W65C02_OPS if is_cputype02 else W65C816_OPS
+
+
+# Static linear disassembler of a memory image.
+# data: bytes/bytearray of the code
+# addr: CPU address of data[0]
+# is_cputype02: True => 65C02, else 65C816
+# m_flag, x_flag: initial width of the accumulator/memory and of the index registers (True = 8-bit);
+#           the 65C816 widths are followed through the REP/SEP instructions, as far as the linear flow goes.
+# Yields tuples (addr, ibytes, opinfo, text) for each instruction;
+# the last instruction could be cut at the end of data (missing operands shown as '??').
+def disassemble(data, addr=0, is_cputype02=False, m_flag=True, x_flag=True):
+    table = opcode_table(is_cputype02)
+    data = bytes(data)
+    n = len(data)
+    k = 0
+    while k < n:
+        op = table[data[k]]
+        sz = op.size(m_flag, x_flag)
+        ibytes = data[k:k+sz]
+        pc = addr + k
+        yield (pc, ibytes, op, op.format(ibytes, pc, m_flag, x_flag))
+        if not is_cputype02 and len(ibytes) == 2:
+            if op.mnemonic == 'REP':
+                m_flag = m_flag and not (ibytes[1] & 0x20)
+                x_flag = x_flag and not (ibytes[1] & 0x10)
+            elif op.mnemonic == 'SEP':
+                m_flag = m_flag or (ibytes[1] & 0x20) != 0
+                x_flag = x_flag or (ibytes[1] & 0x10) != 0
+        k += sz
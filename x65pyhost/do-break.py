@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+import x65ftdi
+import argparse
+from icd import *
+from cpuregs import *
+from cpuidec import *
+from tracefmt import format_traceline
+from breakpoints import Breakpoints, Breakpoint, Watchpoint, Hit
+from colorama import init as colorama_init
+
+colorama_init()
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION]",
+    description="Run the CPU until a breakpoint or a watchpoint is hit; print the registers and the trace before the hit."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-b", "--break", dest="breaks", action="append", default=[],
+    help="breakpoint ADDR[,COND]: CPU address [BANK:]ADDR or a symbol; COND is a Python expression "
+         "of the registers A, X, Y, SP, FL, PC, DBR, DPR, e.g. 0xC000,X==5")
+apa.add_argument(
+    "-w", "--watch", action="append", default=[],
+    help="watchpoint ADDR[-ADDR][/r|w|rw][=VALUE]: accesses to the CPU addresses; the CPU is stepped from the host")
+apa.add_argument(
+    "-t", "--timeout", action="store", type=float, help="seconds to wait for the hit")
+apa.add_argument(
+    "-T", "--trap", action="store", default="0x07E0",
+    help="address of the trap routine in the bank 0 (32 bytes), default 0x07E0")
+apa.add_argument(
+    "-n", "--history", action="store", type=int, default=32, help="number of the cycles printed before the hit")
+apa.add_argument(
+    "-s", "--symbols", action="append",
+    help="Load symbols from the file (llvm-mos ELF, lld map or ca65 labels); FILE@AREA places them in a memory area, e.g. hello.rom.elf@RomB:0.")
+
+args = apa.parse_args()
+
+syms = None
+if args.symbols is not None:
+    from symbols import load_symbol_files
+    syms = load_symbol_files(args.symbols)
+
+
+# Parse the CPU address "[BANK:]ADDR" (hex, with an optional $ or 0x) or a symbol name
+def parse_addr(a: str):
+    a = a.strip()
+    if syms is not None:
+        r = syms.find(a)
+        if r is not None:
+            return r[0]
+    a = a.replace('$', '').replace('0x', '')
+    (bank, _, ca) = a.rpartition(':')
+    return (int(bank, 16) << 16 if bank else 0) | int(ca, 16)
+
+
+# Condition of the breakpoint from the expression
+def make_cond(expr: str):
+    code = compile(expr, "<condition>", "eval")
+    def cond(r: CpuRegs):
+        word = lambda h, l: ((h or 0) << 8) | l
+        env = { 'A': word(r.AH, r.AL), 'X': word(r.XH, r.XL), 'Y': word(r.YH, r.YL),
+                'SP': r.SP, 'FL': r.FL, 'PC': r.PC, 'DBR': r.DBR, 'DPR': r.DPR }
+        return bool(eval(code, {}, env))
+    return cond
+
+
+def parse_watchpoint(s: str):
+    (s, _, value) = s.partition('=')
+    (rng, _, acc) = s.partition('/')
+    (lo, _, hi) = rng.partition('-')
+    lo = parse_addr(lo)
+    hi = parse_addr(hi) + 1 if hi else lo + 1
+    access = 0
+    if 'r' in acc:
+        access |= Watchpoint.READ
+    if 'w' in acc:
+        access |= Watchpoint.WRITE
+    return Watchpoint(lo, hi, access or Watchpoint.READ | Watchpoint.WRITE, int(value, 0) if value else None)
+
+
+icd = ICD(x65ftdi.X65Ftdi())
+
+bps = Breakpoints(icd, int(args.trap, 0))
+for b in args.breaks:
+    (addr, _, expr) = b.partition(',')
+    bps.add(Breakpoint(parse_addr(addr), make_cond(expr) if expr else None))
+for w in args.watch:
+    bps.add(parse_watchpoint(w))
+
+for p in bps.breakpoints + bps.watchpoints:
+    print("  {}".format(p))
+
+# stop the CPU
+icd.cpu_ctrl(False, False, False)
+
+
+def progress(n, elapsed):
+    print("\r  {:10} cycles, {:5.1f} s".format(n, elapsed), end='', flush=True)
+
+print("Running:")
+hit = bps.run(args.timeout, progress)
+if len(bps.watchpoints) > 0:
+    print()
+
+if hit is None:
+    print("Stopped, no hit.")
+    regs = CpuRegs()
+    if regs.cpu_read_regs(icd):
+        print(regs)
+    exit(1)
+
+if hit.kind == Hit.BREAK:
+    print("Hit: {}".format(hit.point if hit.point is not None else "COP/BRK of the program"))
+elif hit.kind == Hit.WATCH:
+    print("Hit: {} by the access at ${:02X}:{:04X} = ${:02X} ({})".format(hit.point, hit.access.CBA, hit.access.CA,
+                    hit.access.CD, "read" if hit.access.is_read_nwrite else "write"))
+else:
+    print("Hit: the CPU was stopped by the program")
+print()
+
+# the trace before the hit
+tbuf_list = ICD.trace_records(hit.history)
+disinst_list = decode_trace_stream(icd, tbuf_list, syms)
+for i in range(max(0, len(tbuf_list) - args.history), len(tbuf_list)):
+    print("Cyc #{:5}:  ".format(i - len(tbuf_list)), end='')
+    print(format_traceline(tbuf_list[i], disinst_list[i]))
+print()
+
+print(hit.regs)
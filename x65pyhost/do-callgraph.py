@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+import sys
+import argparse
+from tracefile import TraceReader
+from callgraph import CallGraph
+from symbols import load_symbol_files
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION] tracefile",
+    description="Rebuild the call graph from a recorded trace file (.x65t) and profile the inclusive/exclusive cycles of the functions."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-c", "--cycles", action="store", help="range of cycles START:STOP to analyze (default: all)")
+apa.add_argument(
+    "-t", "--top", action="store", type=int, default=30, help="number of the top functions printed")
+apa.add_argument(
+    "-o", "--callgrind", action="store", help="write the call-graph profile in the callgrind format into the file")
+apa.add_argument(
+    "-s", "--symbols", action="append", help="load symbols from the file (llvm-mos ELF, lld map or ca65 labels); FILE@AREA places them in a memory area, e.g. hello.rom.elf@RomB:0")
+apa.add_argument('tracefile')
+
+args = apa.parse_args()
+
+# cycles processed at once
+CHUNK = 1 << 20
+
+syms = load_symbol_files(args.symbols)
+tr = TraceReader(args.tracefile)
+(start, stop) = (0, len(tr))
+if args.cycles is not None:
+    (a, b) = (args.cycles.split(':') + [''])[0:2]
+    start = int(a, 0) if a != '' else 0
+    stop = min(len(tr), int(b, 0)) if b != '' else len(tr)
+
+print("Trace {}: CPU {}, cycles {}..{}".format(args.tracefile, tr.meta.get('cpu'), start, stop))
+print()
+cg = CallGraph(tr.is_cputype02(), syms)
+for c in range(start, stop, CHUNK):
+    cg.append(tr.cycles(c, min(c + CHUNK, stop)))
+cg.finish()
+cg.write_flat(sys.stdout, args.top)
+
+if args.callgrind is not None:
+    with open(args.callgrind, 'w') as f:
+        cg.write_callgrind(f)
@@ -30,12 +30,15 @@ if args.rombank is not None:
     icd.bankregs_write(1, [args.rombank])
 
 print("CPU Step while in Reset")
-# // step the cpu while reset is active for some time
-for i in  range(0, 10):
-    icd.cpu_ctrl(False, True, True)
-    # read_print_trace()
-
-banks = icd.bankregs_read(0, 2)
+# // step the cpu while reset is active for some time;
+# // the steps and the bank read go in one batch
+with icd.batch():
+    for i in  range(0, 10):
+        icd.cpu_ctrl(False, True, True)
+        # read_print_trace()
+
+    banks = icd.bankregs_read(0, 2)
+banks = banks.result()
 print('Active banks: RAMBANK={:2x}  ROMBANK={:2x}'.format(banks[0], banks[1]))
 
 if args.run:
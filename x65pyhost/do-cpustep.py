@@ -4,9 +4,8 @@ from icd import *
 from cpuregs import *
 from cpuidec import *
 import argparse
+from tracefmt import format_traceline
 from colorama import init as colorama_init
-from colorama import Fore
-from colorama import Style
 
 colorama_init()
 
@@ -30,6 +29,10 @@ def parse_arguments():
 
     apa.add_argument('-o', "--force_opcode", action="store", help="Force an opcode")
 
+    apa.add_argument('-w', "--write_trace", action="store", help="Record the trace (buffer and steps) into the given trace file (.x65t).")
+
+    apa.add_argument('-s', "--symbols", action="append", help="Load symbols from the file (llvm-mos ELF, lld map or ca65 labels); FILE@AREA places them in a memory area, e.g. hello.rom.elf@RomB:0.")
+
     return apa.parse_args()
 
 
@@ -44,110 +47,27 @@ icd = ICD(x65ftdi.X65Ftdi())
 is_cputype02 = icd.is_cputype02()
 
 
-# IO area is between 0x9F00 and 0x9FFF of the CPU memory map
-IO_START_ADDR = 0x9F00
-IO_END_ADDR = 0x9FFF
-# the ROM and PBL area is between 0xC000 and 0xFFFF of the CPU memory map
-PBL_ROM_CA_START = 0xC000
-
-# "MAH" means Memory Address High, and it is the top 8 bits of the 21-bit SRAM address bus.
-# The SRAM is 2048 kB, and the top 8 bits are used to select one of 256, 8kB blocks.
-# Low memoory from 0 to 40kB = 5 memory blocks (each 8kB)
-MAH_BELOW_40KB = 5
-MAH_OVER_512KB = 64
-MAH_BELOW_1024KB = 128
-MAH_TOP = 255
-
-# Decode the MAH, CBA and CA values into a human-readable string
-# MAH: Memory Address High (top 8 bits of the 21-bit SRAM address bus)
-# CBA: CPU Bank Address (816 topmost 8 bits; dont confuse with CX16 stuff!!)
-# CA: CPU Address, 16-bit
-def mah_area_name(MAH: int, CBA: int, CA: int) -> str:
-    if (MAH < MAH_BELOW_40KB):
-        # Low memory – fix-mapped at CPU blocks 0-4 ; unused 5-7 due to alignment (can be accessed as high-mem pages 189-191)
-        mah_area = "low :{:3}".format(MAH)
-    elif (MAH >= MAH_OVER_512KB) and (MAH < MAH_BELOW_1024KB):
-        # ROM banks: 32 a 16kB, mapped to CPU blocks 6-7 according to REG01
-        mah_area = "RomB:{:3}".format((MAH - 64)//2)
-    elif (MAH == MAH_TOP) and (CBA == 0) and (CA >= PBL_ROM_CA_START):
-        # special case (flag): this combination indicates an access to the PBL ROM
-        mah_area = "PBL     "
-    else:
-        # all else -> some RAMB
-        mah_area = "RAMB:{:3}".format(MAH ^ 0x80)
-    
-    return mah_area
-
-
-def print_traceline(tbuf: ICD.TraceReg, is_upcoming=False):
+# disinst: already decoded instruction (see decode_trace_stream), or None to decode it here
+def print_traceline(tbuf: ICD.TraceReg, is_upcoming=False, disinst=None):
     # decode instruction in the trace buffer
-    disinst = decode_traced_instr(icd, tbuf, is_upcoming)
-
-    # extract signal values from trace buffer array
-    CBA = tbuf.CBA  #tbuf[6]           # CPU Bank Address (816 topmost 8 bits; dont confuse with CX16 stuff!!)
-    MAH = tbuf.MAH  #tbuf[5]           # Memory Address High = Physical 8kB Page in SRAM
-    CA = tbuf.CA  #tbuf[4] * 256 + tbuf[3]        # CPU Address, 16-bit
-    CD = tbuf.CD  #tbuf[2]                # CPU Data
-    is_sync = tbuf.is_sync  #(tbuf[0] & ISYNC) == ISYNC
-    is_io = (CA >= IO_START_ADDR and CA <= IO_END_ADDR)
-    is_write = not tbuf.is_read_nwrite  #not(tbuf[0] & TRACE_FLAG_RWN)
-    is_addr_invalid = not(tbuf.is_vpa or tbuf.is_vda)   # not((tbuf[0] & TRACE_FLAG_SYNC_VPA) or (tbuf[0] & TRACE_FLAG_VDA))
-
-    mah_area = mah_area_name(MAH, CBA, CA)
-
-    addr_color = Fore.LIGHTBLACK_EX if is_addr_invalid \
-                else Fore.YELLOW if is_io  \
-                else Fore.GREEN if is_sync \
-                else Fore.RED if is_write \
-                else Fore.WHITE
-
-    print("MAH:{:2x} ({})  CBA:{:2}  CA:{}{:4x}{}  CD:{}{:2x}{}  ctr:{:2x}:{}{}{}{}  sta:{:2x}:{}{}{}{}{}{}{}{}{}     {}{}{}".format(
-            MAH,
-            mah_area,
-            (CBA if CBA==0 else Fore.BLUE+"{:2x}".format(CBA)+Style.RESET_ALL),
-            addr_color,   
-            CA,  #/*CA:*/
-            Style.RESET_ALL,
-            Fore.RED if is_write 
-                else Fore.YELLOW if is_io
-                else Fore.WHITE,      # red-mark Write Data access
-            CD,  #/*CD:*/
-            Style.RESET_ALL,
-            #/*ctr:*/
-            tbuf.ctr_flags, 
-            ('-' if tbuf.is_resetn else 'R'),
-            ('-' if tbuf.is_irqn else 'I'),
-            ('-' if tbuf.is_nmin else 'N'),
-            ('-' if tbuf.is_abortn else Fore.RED+'A'+Style.RESET_ALL),
-            #/*sta:*/ 
-            tbuf.sta_flags, 
-            ('r' if tbuf.is_read_nwrite else Fore.RED+'W'+Style.RESET_ALL), 
-            ('-' if tbuf.is_vectpull else Fore.YELLOW+'v'+Style.RESET_ALL),        # vector pull, active low
-            ('-' if tbuf.is_mlock else 'L'),           # mem lock, active low
-            ('e' if tbuf.is_emu8 else Fore.BLUE+'N'+Style.RESET_ALL),        # 'e': emulation mode, active high; 'N' native mode
-            ('m' if tbuf.is_am8 else Fore.BLUE+'M'+Style.RESET_ALL),    # '816 M-flag (acumulator): 0=> 16-bit 'M', 1=> 8-bit 'm'
-            ('x' if tbuf.is_xy8 else Fore.BLUE+'X'+Style.RESET_ALL),    # '816 X-flag (index regs): 0=> 16-bit 'X', 1=> 8-bit 'x'
-            ('P' if tbuf.is_vpa else '-'),        # '02: SYNC, '816: VPA (valid program address)
-            ('D' if tbuf.is_vda else '-'),             # '02: always 1, '816: VDA (valid data address)
-            ('S' if is_sync else '-'),
-            Fore.GREEN if not is_upcoming else Fore.LIGHTBLACK_EX, disinst, Style.RESET_ALL
-        ))
+    if disinst is None:
+        disinst = decode_traced_instr(icd, tbuf, is_upcoming, syms)
+
+    print(format_traceline(tbuf, disinst, is_upcoming))
 
 
 def print_tracebuffer():
-    # retrieve line from trace buffer
-    is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = icd.cpu_read_trace(tbr_deq=True)
-    rbuf_list = []
-    while is_tbr_valid:
-        # note down
-        rbuf_list.append(rawbuf)
-        # fetch next trace item into reg
-        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = icd.cpu_read_trace(tbr_deq=True)
+    # retrieve the whole trace buffer in one go
+    recs = icd.drain_tracebuffer()
+    if trace_writer is not None:
+        trace_writer.append(recs)
+    tbuf_list = ICD.trace_records(recs)
+    # disassemble from the traced cycles themselves, without any memory reads
+    disinst_list = decode_trace_stream(icd, tbuf_list, syms)
     # print out
-    for i in range(0, len(rbuf_list)):
-        print("Cyc #{:5}:  ".format(i - len(rbuf_list)), end='')
-        tbuf = ICD.TraceReg(rbuf_list[i])
-        print_traceline(tbuf)
+    for i in range(0, len(tbuf_list)):
+        print("Cyc #{:5}:  ".format(i - len(tbuf_list)), end='')
+        print_traceline(tbuf_list[i], disinst=disinst_list[i])
 
 
 print('Options: block-irq={}, force-irq={}'.format(args.block_irq, args.force_irq))
@@ -161,6 +81,18 @@ icd.cpu_ctrl(False, False, False,
 banks = icd.bankregs_read(0, 2)
 print('Active memory blocks: RAMBLOCK={:2x}  ROMBLOCK={:2x}'.format(banks[0], banks[1]))
 
+syms = None
+if args.symbols is not None:
+    # imported just when needed; the symbol index needs numpy
+    from symbols import load_symbol_files
+    syms = load_symbol_files(args.symbols)
+
+trace_writer = None
+if args.write_trace is not None:
+    # imported just when needed; the trace file needs numpy
+    from tracefile import TraceWriter
+    trace_writer = TraceWriter(args.write_trace, is_cputype02, bankregs=banks, mapregs=icd.read_mapregs())
+
 print("CPU Step:\n")
 
 cycle_i = 0
@@ -233,6 +165,8 @@ while step_i <= step_count:
         if tbuf.is_sync:
             step_i += 1
             cycles_without_step = 0
+        if trace_writer is not None:
+            trace_writer.append(tbuf)
         # decode and print cycle line
         print_traceline(tbuf)
     else:
@@ -257,6 +191,9 @@ while step_i <= step_count:
 
     # read_print_trace(banks)
 
+if trace_writer is not None:
+    trace_writer.close()
+
 # Show the final CPU State (regs)
 cpust_fin = CpuRegs()
 if cpust_fin.cpu_read_regs(icd):
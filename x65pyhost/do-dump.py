@@ -2,6 +2,8 @@
 import x65ftdi
 import argparse
 from icd import *
+from cpumem import CpuMemMap
+from disasm import disassemble
 
 icd = ICD(x65ftdi.X65Ftdi())
 
@@ -14,6 +16,16 @@ apa.add_argument(
     "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0"
 )
 
+apa.add_argument(
+    "-d", "--dis", action="store_true", help="disassemble the code instead of the hex dump")
+apa.add_argument(
+    "--m16", action="store_true", help="disassemble: start with the 16-bit accumulator/memory (65C816 M=0)")
+apa.add_argument(
+    "--x16", action="store_true", help="disassemble: start with the 16-bit index registers (65C816 X=0)")
+apa.add_argument(
+    "--org", action="store", type=lambda x: int(x, 0),
+    help="disassemble: CPU address of the start, if different (default: start for the cpu area)")
+
 apa.add_argument('area')
 apa.add_argument('start')
 apa.add_argument('length')
@@ -65,39 +77,30 @@ elif args.area == 'banks':
     rdata = icd.bankregs_read(start, length)
 
 elif args.area == 'cpu':
-    areasize = 65536
+    # 65C816: 16MB address space, 65C02: just the bank 0
+    areasize = 0x1000000
     if start < 0:
-        start = areasize + start
-
-    # TODO: this code doesn't handle the crossing of boundary within a single dump!!
-    # This is serious proble in the zero page!!
-    if 0 <= start < 2:
-        # bank regs
-        rdata = icd.bankregs_read(start, length)
-    elif start < 0x9F00:
-        # CPU low memory starts at sram fix 0x00000
-        rdata = icd.sram_blockread(start + 0x000000, length)
-    elif start < 0xA000:
-        # IO regs
-        rdata = icd.ioregs_read(start - 0x9F00, length)
-    elif 0xA000 <= start < 0xC000:
-        # CPU RAM Bank starts at sram fix 0x000
-        offs = (start - 0xA000)
-        rdata = icd.sram_blockread(offs + (rambank ^ 0x80)*ICD.BLOCKSIZE, length)
-    elif 0xC000 <= start:
-        # CPU ROM bank
-        offs = (start - 0xC000)
-        if rombank < 32:
-            # CPU ROM bank starts at sram fix 0x080000
-            rdata = icd.sram_blockread(offs + 0x080000 + rombank*2*ICD.BLOCKSIZE, length)
-        else:
-            # bootrom inside of NORA
-            rdata = icd.bootrom_blockread(offs, length)
+        start = 0x10000 + start
+    # split the CPU range to physical segments according to the present RAM/ROM-Block mapping
+    mm = CpuMemMap.from_hw(icd)
+    for seg in mm.segments(start, length):
+        print("  ${:06X}..${:06X} -> {} 0x{:x}".format(seg.cpu_addr, seg.cpu_addr + seg.length - 1, seg.area, seg.phys))
+    rdata = mm.read(icd, start, length)
 
 else:
     print('Unknown area {}'.format(args.area))
     exit(1)
 
+if args.dis:
+    is_cputype02 = icd.is_cputype02()
+    org = args.org if args.org is not None else start
+    print("Disassembly ({}) at CPU address ${:06X}:".format("65C02" if is_cputype02 else "65C816", org))
+    print()
+    for (addr, ibytes, op, text) in disassemble(rdata, org, is_cputype02, not args.m16, not args.x16):
+        print(' {:6x}:   {:<12} {}'.format(addr, ' '.join('{:02x}'.format(b) for b in ibytes), text))
+    print()
+    exit(0)
+
 BYTESSPERLINE = 16
 print()
 
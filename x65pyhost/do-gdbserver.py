@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+import x65ftdi
+import argparse
+from icd import *
+from breakpoints import Breakpoints
+from gdbserver import GdbServer
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION]",
+    description="GDB remote protocol server: debug the X65 CPU with GDB (target remote :PORT) or other RSP front-ends."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-p", "--port", action="store", type=int, default=GdbServer.DEFAULT_PORT, help="TCP port to listen on")
+apa.add_argument(
+    "-T", "--trap", action="store", default="0x{:04X}".format(Breakpoints.TRAP_ADDR),
+    help="address of the breakpoint trap routine in the bank 0 (32 bytes)")
+apa.add_argument(
+    "-l", "--log", action="store_true", help="print the packets")
+
+args = apa.parse_args()
+
+icd = ICD(x65ftdi.X65Ftdi())
+
+print("CPU Type (from strap): {}".format("65C02" if icd.is_cputype02() else "65C816"))
+
+srv = GdbServer(icd, args.port, int(args.trap, 0), args.log)
+try:
+    srv.serve()
+except KeyboardInterrupt:
+    print()
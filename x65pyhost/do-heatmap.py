@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+import sys
+import argparse
+from tracefile import TraceReader
+from heatmap import HeatMap
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION] tracefile",
+    description="Heat-map analysis of a recorded trace file (.x65t): hot PCs, opcodes, memory pages and IO windows."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-c", "--cycles", action="store", help="range of cycles START:STOP to analyze (default: all)")
+apa.add_argument(
+    "-t", "--top", action="store", type=int, default=20, help="number of the entries in each table")
+apa.add_argument('tracefile')
+
+args = apa.parse_args()
+
+tr = TraceReader(args.tracefile)
+(start, stop) = (0, len(tr))
+if args.cycles is not None:
+    (a, b) = (args.cycles.split(':') + [''])[0:2]
+    start = int(a, 0) if a != '' else 0
+    stop = min(len(tr), int(b, 0)) if b != '' else len(tr)
+
+print("Trace {}: CPU {}, cycles {}..{}".format(args.tracefile, tr.meta.get('cpu'), start, stop))
+print()
+hm = HeatMap(tr.cycles(start, stop), tr.is_cputype02())
+hm.write_report(sys.stdout, args.top)
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+import x65ftdi
+import argparse
+from icd import *
+import linkspeed
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION]",
+    description="Calibrate the SPI clock of the ICD link and store it in the link profile cache."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-r", "--rounds", action="store", type=int, default=32, help="write/readback rounds per pass")
+apa.add_argument(
+    "-p", "--passes", action="store", type=int, default=linkspeed.CAL_PASSES,
+    help="clean passes required per frequency, default {}".format(linkspeed.CAL_PASSES))
+apa.add_argument(
+    "-s", "--sram", action="store", type=lambda x: int(x, 0),
+    help="test with a SRAM block at the given address instead of the IO scratchpad $9FF0-$9FFF")
+apa.add_argument(
+    "-l", "--length", action="store", type=lambda x: int(x, 0), default=4096, help="length of the SRAM test block")
+apa.add_argument(
+    "-f", "--freqs", action="store", help="comma-separated list of frequencies in MHz to try, rising")
+apa.add_argument(
+    "-n", "--no-save", action="store_true", help="do not store the result in the profile cache")
+apa.add_argument(
+    "-c", "--clear", action="store_true", help="just remove the stored profile of this board")
+
+args = apa.parse_args()
+
+# always start at the safe default speed
+icd = ICD(x65ftdi.X65Ftdi(freq=x65ftdi.X65Ftdi.DEFAULT_SPI_FREQ))
+board = icd.com.board_key()
+
+if args.clear:
+    linkspeed.clear_profile(board)
+    print("Link profile of {} removed.".format(board))
+    exit(0)
+
+freqs = None
+if args.freqs is not None:
+    freqs = [ float(f) * 1E6 for f in args.freqs.split(',') ]
+
+print("Calibrating the ICD link of {} ({}):".format(board,
+        "IO scratchpad" if args.sram is None else "SRAM 0x{:x}..0x{:x}".format(args.sram, args.sram + args.length - 1)))
+
+(best_freq, max_freq, results) = linkspeed.calibrate(icd, freqs, args.rounds, args.sram, args.length,
+                                                        passes=args.passes)
+
+if best_freq is None:
+    print("ERROR: the link does not work even at the lowest frequency!")
+    exit(1)
+
+print("Highest passing SPI clock: {:.2f} MHz, with the margin: {:.2f} MHz".format(max_freq / 1E6, best_freq / 1E6))
+if not args.no_save:
+    linkspeed.save_profile(board, best_freq, results, max_freq=max_freq, passes=args.passes)
+    print("Stored in {}".format(linkspeed.PROFILE_FILE))
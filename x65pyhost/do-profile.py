@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+import x65ftdi
+import sys
+import argparse
+from icd import *
+from profiler import Profiler
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION] [seconds]",
+    description="Statistical profiler: sample the program counter of the CPU running at full speed."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-r", "--rate", action="store", type=float, default=100, help="samples per second")
+apa.add_argument(
+    "-s", "--skid", action="store", type=int, default=8, help="cycles stepped after a sample to reach an instruction start")
+apa.add_argument(
+    "-t", "--top", action="store", type=int, default=30, help="number of the top addresses printed")
+apa.add_argument(
+    "-f", "--flat", action="store", help="write the whole flat profile into the file")
+apa.add_argument(
+    "-c", "--collapsed", action="store", help="write the collapsed stacks (for flame graphs) into the file")
+apa.add_argument('seconds', nargs='?', default='10', help="duration of profiling")
+
+args = apa.parse_args()
+
+icd = ICD(x65ftdi.X65Ftdi())
+
+prof = Profiler(icd, args.skid)
+
+def progress(n, elapsed):
+    print("\r  {:6} samples, {:5.1f} s".format(n, elapsed), end='', flush=True)
+
+print("Profiling for {} s at {} samples/s:".format(args.seconds, args.rate))
+prof.run(float(args.seconds), args.rate, progress)
+print()
+print()
+
+prof.write_flat(sys.stdout, args.top)
+
+if args.flat is not None:
+    with open(args.flat, 'w') as f:
+        prof.write_flat(f)
+if args.collapsed is not None:
+    with open(args.collapsed, 'w') as f:
+        prof.write_collapsed(f)
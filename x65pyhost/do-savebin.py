@@ -39,9 +39,14 @@ if args.area == 'sram':
     areasize = ICD.SIZE_2MB
     if start < 0:
         start = areasize + start
-    data = icd.sram_blockread(start, length)
+    # stream the data chunk by chunk to the file
+    saved = 0
+    for data in icd.sram_readchunks(start, length):
+        f.write(data)
+        saved += len(data)
 else:
     print("Only the SRAM area is supported!")
+    saved = 0
 
-f.write(data)
-print("Saved {} B to the file.".format(len(data)))
+f.close()
+print("Saved {} B to the file.".format(saved))
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+import x65ftdi
+import argparse
+import os
+import time
+from icd import *
+from breakpoints import Breakpoints
+from snapshot import Snapshot
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION] save|restore file",
+    description="Save the machine state (SRAM, bootrom, IO, CPU registers, optionally VERA) into a snapshot file, or restore it."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-b", "--base", action="store", help="save an incremental snapshot: just the SRAM blocks changed against the base snapshot file")
+apa.add_argument(
+    "-V", "--vera", action="store_true", help="save VERA VRAM and registers as well")
+apa.add_argument(
+    "-r", "--run", action="store_true", help="run the CPU afterwards")
+apa.add_argument('action', choices=['save', 'restore'])
+apa.add_argument('file')
+
+args = apa.parse_args()
+
+icd = ICD(x65ftdi.X65Ftdi())
+
+# stop the CPU at the start of an instruction
+icd.cpu_ctrl(False, False, False)
+if Breakpoints(icd).step_to_sync() is None:
+    exit(1)
+
+t0 = time.monotonic()
+if args.action == 'save':
+    snap = Snapshot.capture(icd, args.vera)
+    if snap is None:
+        exit(1)
+    snap.save(args.file, args.base)
+    print("Saved {} B to {} in {:.2f} s.".format(os.path.getsize(args.file), args.file, time.monotonic() - t0))
+else:
+    snap = Snapshot.load(args.file)
+    if not snap.restore(icd):
+        exit(1)
+    print("Restored {} in {:.2f} s.".format(args.file, time.monotonic() - t0))
+print(snap.regs)
+
+if args.run:
+    icd.cpu_ctrl(True, False, False)
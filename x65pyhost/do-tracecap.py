@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+import x65ftdi
+import argparse
+from icd import *
+from tracecap import TraceCapture
+from tracefile import TraceWriter
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION] tracefile count",
+    description="Capture the CPU trace by continuous single-stepping into a trace file (.x65t)."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-b", "--batch", action="store", type=int, default=256, help="CPU cycles stepped per USB transfer")
+apa.add_argument(
+    "-u", "--until", action="store", type=lambda x: int(x, 0),
+    help="stop when an instruction at this 24-bit CPU address is reached")
+apa.add_argument(
+    "-H", "--no-history", action="store_true", help="do not store the trace buffer history before the capture")
+apa.add_argument("-I", "--force_irq", action="store_true", help="Force CPU IRQ line active.")
+apa.add_argument("-i", "--block_irq", action="store_true", help="Block CPU IRQ line (deassert).")
+apa.add_argument("-N", "--force_nmi", action="store_true", help="Force CPU NMI line active.")
+apa.add_argument("-n", "--block_nmi", action="store_true", help="Block CPU NMI line (deassert).")
+apa.add_argument('tracefile')
+apa.add_argument('count', help="Number of CPU cycles to capture.")
+
+args = apa.parse_args()
+count = int(args.count, 0)
+
+icd = ICD(x65ftdi.X65Ftdi())
+
+cap = TraceCapture(icd, args.batch, force_irq=args.force_irq, force_nmi=args.force_nmi,
+                    block_irq=args.block_irq, block_nmi=args.block_nmi)
+
+# stop the CPU and get the history first
+hist = cap.read_history()
+
+banks = icd.bankregs_read(0, 2)
+print('Active memory blocks: RAMBLOCK={:2x}  ROMBLOCK={:2x}'.format(banks[0], banks[1]))
+
+def progress(cycles, elapsed):
+    print("\r  {:10} cycles, {:8.0f} cycles/s".format(cycles, cycles / elapsed if elapsed > 0 else 0), end='', flush=True)
+
+with TraceWriter(args.tracefile, icd.is_cputype02(), bankregs=banks, mapregs=icd.read_mapregs(),
+                    meta={ 'history_cycles': 0 if args.no_history else len(hist) // ICD.TRACEREC_SIZE }) as tw:
+    if not args.no_history:
+        tw.append(hist)
+    print("Capturing {} cycles into {}:".format(count, args.tracefile))
+    n = cap.capture(count, tw, until=args.until, progress=progress)
+    print()
+
+if n is None:
+    exit(1)
+
+print("Captured {} cycles ({} instructions) in {:.2f} s: {:.0f} cycles/s{}".format(
+        n, tw.n_instrs, cap.elapsed, cap.rate(),
+        ", stopped at ${:06X}".format(args.until) if cap.stopped_at_until else ""))
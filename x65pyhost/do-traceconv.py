@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+import argparse
+from colorama import init as colorama_init
+from tracefile import TraceReader
+from tracefmt import format_traceline
+from cpuidec import decode_trace_stream_cpu
+from symbols import load_symbol_files
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION] tracefile",
+    description="Render a recorded trace file (.x65t) to text."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0")
+apa.add_argument(
+    "-c", "--cycles", action="store", help="range of cycles START:STOP to render (default: all)")
+apa.add_argument(
+    "-i", "--instrs", action="store", help="range of instructions START:STOP to render")
+apa.add_argument(
+    "-n", "--no-color", action="store_true", help="plain text without the colours")
+apa.add_argument(
+    "-s", "--symbols", action="append", help="load symbols from the file (llvm-mos ELF, lld map or ca65 labels); FILE@AREA places them in a memory area, e.g. hello.rom.elf@RomB:0")
+apa.add_argument('tracefile')
+
+args = apa.parse_args()
+
+colorama_init(strip=True if args.no_color else None)
+
+# parse the range "START:STOP"; either could be omitted
+def parse_range(s, n):
+    (a, b) = (s.split(':') + [''])[0:2]
+    start = int(a, 0) if a != '' else 0
+    stop = int(b, 0) if b != '' else n
+    return (max(0, start), min(n, stop))
+
+syms = load_symbol_files(args.symbols)
+tr = TraceReader(args.tracefile)
+
+print("Trace {}: CPU {}, {} cycles, {} instructions".format(args.tracefile, tr.meta.get('cpu'), len(tr), tr.n_instrs))
+for k in ('bankregs', 'mapregs', 'regs'):
+    if k in tr.meta:
+        print("  {}: {}".format(k, tr.meta[k]))
+print()
+
+if args.instrs is not None:
+    (i0, i1) = parse_range(args.instrs, tr.n_instrs)
+    start = tr.instr_cycle(i0) if i0 < tr.n_instrs else len(tr)
+    stop = tr.instr_cycle(i1) if i1 < tr.n_instrs else len(tr)
+elif args.cycles is not None:
+    (start, stop) = parse_range(args.cycles, len(tr))
+else:
+    (start, stop) = (0, len(tr))
+
+# render in pieces; each with a few cycles more to get the operands of the last instruction
+PIECE = 4096
+LOOKAHEAD = 8
+is_cputype02 = tr.is_cputype02()
+for p in range(start, stop, PIECE):
+    q = min(p + PIECE, stop)
+    tbufs = list(tr.cycles(p, min(q + LOOKAHEAD, len(tr))))
+    disinst = decode_trace_stream_cpu(is_cputype02, tbufs, syms)
+    for i in range(0, q - p):
+        print("Cyc #{:5}:  {}".format(p + i, format_traceline(tbufs[i], disinst[i])))
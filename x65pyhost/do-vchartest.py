@@ -37,9 +37,7 @@ icd.iopoke(v.L0_TILEBASE, ((tilebase_va >> 11) << 2))
 fontfile = open("../testsw/testroms/font8x8.bin", mode="rb")
 fontdata = fontfile.read(2048)
 # write font data to the tile memory
-v.vpoke0_setup(tilebase_va, 1)
-for a in range(0, 2048):
-    icd.iopoke(v.DATA0, fontdata[a])
+v.vram_write(tilebase_va, fontdata)
 
 # write character/color data in the map:
 # a tile map containing tile map entries, which are 2 bytes each:
@@ -49,14 +47,13 @@ for a in range(0, 2048):
 # v.vpoke0_setup(0, 1)
 c = 0
 for y in range(0, 60):
+    # one row of the map = 80 visible entries
+    row = bytearray()
     for x in range(0, 80):
-        # 
-        ci = 2*x + 2*128*y
-        v.vpoke(ci, c)              # character
-        v.vpoke(ci+1, x+y)            # colors
+        row.append(c)               # character
+        row.append((x+y) & 0xFF)    # colors
         c = (c + 1) & 0xFF
-        # icd.iopoke(v.DATA0, (((a >> 1)+32) & 0xFF))
-        # icd.iopoke(v.DATA0, ((32+a) >> 4) & 0xFF)
+    v.vram_write(2*128*y, row)
 
 print("After Vpoke")
 v.vdump_regs()
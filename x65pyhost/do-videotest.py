@@ -51,15 +51,16 @@ print('Writing pseudo-random data byte to VRAM...')
 # restart rand sequence
 random.seed(myseed)
 
-# prepare DATA0 reg: start addr = 0, increment on every access
-v.vpoke0_setup(0, inc=True)
-
+wrbuf = bytearray()
 for b in range(0, test_vram_end):
     byte = random.randrange(0, 256)
     # if ((b * ICD.BLOCKSIZE) % ICD.PAGESIZE == 0):
     #     print("  Writing page 0x{:x} (0x{:x} to 0x{:x})...".format(int((b + mstart/ICD.BLOCKSIZE) * ICD.BLOCKSIZE / ICD.PAGESIZE),
     #             int((b + mstart/ICD.BLOCKSIZE) * ICD.BLOCKSIZE), int((b+1) + mstart/ICD.BLOCKSIZE) * ICD.BLOCKSIZE - 1))
-    icd.iopoke(v.DATA0, byte & 0xFF)
+    wrbuf.append(byte & 0xFF)
+
+# burst-write through DATA0: start addr = 0, increment on every access
+v.vram_write(0, wrbuf)
 
 # ###############################################################3
 print('Checking pseudo-random data bytes in VRAM...')
@@ -69,11 +70,11 @@ random.seed(myseed)
 
 errors = 0
 
-# prepare DATA0 reg: start addr = 0, increment on every access
-v.vpoke0_setup(0, inc=True)
+# burst-read through DATA0: start addr = 0, increment on every access
+rdbuf = v.vram_read(0, test_vram_end)
 
 for b in range(0, test_vram_end):
-    byte1 = icd.iopeek(v.DATA0)
+    byte1 = rdbuf[b]
     byte2 = random.randrange(0, 256)
 
     # if ((b * ICD.BLOCKSIZE) % ICD.PAGESIZE == 0):
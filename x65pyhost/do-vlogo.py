@@ -38,14 +38,16 @@ for a in range(0, 16):
 # v.vpoke0_setup(0, 1)
 c = 0
 for y in range(0, 60):
-    for x in range(0, 80):
-        # 
-        ci = 2*x + 2*128*y
-        v.vpoke(ci, c)              # character
-        v.vpoke(ci+1, x+y)            # colors
-        c = (c + 1) & 0x1
-        # icd.iopoke(v.DATA0, (((a >> 1)+32) & 0xFF))
-        # icd.iopoke(v.DATA0, ((32+a) >> 4) & 0xFF)
+    # one batch (= one USB transfer) per row
+    with icd.batch():
+        for x in range(0, 80):
+            # 
+            ci = 2*x + 2*128*y
+            v.vpoke(ci, c)              # character
+            v.vpoke(ci+1, x+y)            # colors
+            c = (c + 1) & 0x1
+            # icd.iopoke(v.DATA0, (((a >> 1)+32) & 0xFF))
+            # icd.iopoke(v.DATA0, ((32+a) >> 4) & 0xFF)
 
 art = """
 012345670123456701234567
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+import x65ftdi
+from icd import *
+from cpuregs import *
+import argparse
+
+apa = argparse.ArgumentParser(usage="%(prog)s [OPTION]",
+    description="Write CPU registers (the CPU must be stopped). The registers not given keep their values."
+)
+
+apa.add_argument(
+    "-v", "--version", action="version", version = f"{apa.prog} version 1.0.0"
+)
+
+apa.add_argument(
+    "--pc", action="store", help="Program counter incl. PBR (24-bit on 65C816)")
+apa.add_argument(
+    "--a", action="store", help="Accumulator (16-bit on 65C816: B:A)")
+apa.add_argument(
+    "--x", action="store", help="Index register X")
+apa.add_argument(
+    "--y", action="store", help="Index register Y")
+apa.add_argument(
+    "--sp", action="store", help="Stack pointer")
+apa.add_argument(
+    "--fl", action="store", help="Flags")
+apa.add_argument(
+    "--dbr", action="store", help="Data Bank Register (65C816)")
+apa.add_argument(
+    "--dpr", action="store", help="Direct Page Register (65C816)")
+apa.add_argument(
+    "--emu", action="store", type=int, choices=[0, 1], help="Emulation mode flag (65C816)")
+
+args = apa.parse_args()
+
+# define connection to the target board via the USB FTDI
+icd = ICD(x65ftdi.X65Ftdi())
+
+num = lambda s: int(s, 0) if s is not None else None
+
+regs = CpuRegs()
+regs.PC = num(args.pc)
+regs.SP = num(args.sp)
+regs.FL = num(args.fl)
+regs.DBR = num(args.dbr)
+regs.DPR = num(args.dpr)
+regs.EMU = args.emu
+for (r, v) in [('A', num(args.a)), ('X', num(args.x)), ('Y', num(args.y))]:
+    if v is not None:
+        setattr(regs, r + 'L', v & 0xFF)
+        # the high byte just when given: a value above 0xFF, or written with 4 hex digits (0x0012)
+        if v > 0xFF or len(getattr(args, r.lower())) > 4:
+            setattr(regs, r + 'H', (v >> 8) & 0xFF)
+
+cpust = CpuRegs()
+if cpust.cpu_write_regs(icd, regs):
+    print(cpust)
@@ -0,0 +1,394 @@
+import socket
+import select
+from icd import ICD
+from cpumem import CpuMemMap
+from cpuregs import CpuRegs
+from breakpoints import Breakpoints, Breakpoint, Watchpoint, Hit
+
+# GDB remote serial protocol (RSP) server on top of the ICD, for the standard debugger front-ends.
+# One client at a time over TCP. Supported requests:
+#   ?, g/G, p/P             stop reason, registers (see REGS)
+#   m/M, X                  memory at the CPU addresses (24-bit CBA:CA, by the present RAM/ROM-Block mapping)
+#   s, c, Ctrl-C            single instruction step, continue until a breakpoint, interrupt
+#   Z0/z0, Z2-4/z2-4        software breakpoints and data watchpoints (see breakpoints.py)
+#   qXfer:memory-map:read, qXfer:features:read (target.xml), QStartNoAckMode
+# Memory is read through the ICD memory cache (ICD.cached_read), valid until the CPU runs again
+# or the host writes. A missed read fetches the whole aligned window of PREFETCH bytes in one SRAM burst,
+# so that the many small m requests of GDB (disassembly, stack unwinding) come from the cache.
+# The ICD transactions of one request go in one batch.
+
+# Registers in the order of the g packet: (name, bits); little-endian hex.
+# The 65C02 reports the same layout, with DP, DB zero and E one.
+REGS = [ ('a', 16), ('x', 16), ('y', 16), ('sp', 16), ('dp', 16), ('db', 8), ('p', 8), ('e', 8), ('pc', 32) ]
+
+# Stop signals
+SIGINT = 2
+SIGTRAP = 5
+
+
+# Checksum of the packet data
+def _checksum(data):
+    return sum(data) & 0xFF
+
+
+# Binary data of the X packet: 0x7D escapes the next byte XOR 0x20
+def _unescape(data):
+    res = bytearray()
+    i = 0
+    while i < len(data):
+        if data[i] == 0x7D and i + 1 < len(data):
+            res.append(data[i + 1] ^ 0x20)
+            i += 2
+        else:
+            res.append(data[i])
+            i += 1
+    return bytes(res)
+
+
+class GdbServer:
+    DEFAULT_PORT = 6502
+    PREFETCH = 256                  # window of the memory read from the hw on a cache miss
+    SRAM_SIZE = 0x200000
+
+    # icd: ICD object
+    # port: TCP port to listen on
+    # trap_addr: location of the breakpoint trap routine, see Breakpoints
+    # log: print the packets
+    def __init__(self, icd, port=DEFAULT_PORT, trap_addr=Breakpoints.TRAP_ADDR, log=False):
+        self.icd = icd
+        self.port = port
+        self.log = log
+        self.is02 = icd.is_cputype02()
+        self.bps = Breakpoints(icd, trap_addr)
+        self.conn = None
+        self.rxbuf = bytearray()
+        self.noack = False
+        self.detached = False
+        self.regs = None            # CpuRegs at the stop
+        self.last_stop = SIGTRAP
+        # (type, addr, kind) -> Breakpoint or Watchpoint
+        self.points = {}
+
+    # Listen and serve the clients, one after another; never returns
+    def serve(self):
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind(('', self.port))
+        srv.listen(1)
+        while True:
+            print("Waiting for GDB on port {}...".format(self.port))
+            (conn, peer) = srv.accept()
+            print("Connected from {}:{}".format(*peer))
+            self.session(conn)
+            print("Disconnected.")
+
+    # Serve one connected client until it disconnects, kills or detaches
+    def session(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn = conn
+        self.rxbuf = bytearray()
+        self.noack = False
+        self.detached = False
+        # stop the CPU at the start of an instruction
+        self.icd.cpu_ctrl(False, False, False)
+        self.bps.step_to_sync()
+        self._stopped()
+        self.last_stop = SIGTRAP
+        try:
+            while True:
+                pkt = self._recv_packet()
+                if pkt is None:
+                    break
+                if self.log:
+                    print("<- {}".format(pkt[0:80]))
+                reply = self.handle(pkt)
+                if reply is None:
+                    break
+                self._send_packet(reply)
+                if pkt == b'QStartNoAckMode':
+                    self.noack = True
+                if self.detached:
+                    # the program continues
+                    self.icd.cpu_ctrl(True, False, False)
+                    break
+        except (ConnectionError, OSError) as e:
+            print("ERROR: connection: {}".format(e))
+        for p in self.points.values():
+            self.bps.remove(p)
+        self.points = {}
+        conn.close()
+        self.conn = None
+
+    # Receive the next packet; handles the acks. Returns the packet data (bytes), or None on disconnect.
+    def _recv_packet(self):
+        while True:
+            # drop the acks and the interrupts of the stopped CPU before the packet
+            while len(self.rxbuf) > 0 and self.rxbuf[0] != ord('$'):
+                del self.rxbuf[0]
+            end = self.rxbuf.find(b'#')
+            if end >= 0 and len(self.rxbuf) >= end + 3:
+                data = bytes(self.rxbuf[1:end])
+                cs = bytes(self.rxbuf[end+1:end+3])
+                del self.rxbuf[0:end+3]
+                if self.noack:
+                    return data
+                if int(cs, 16) == _checksum(data):
+                    self.conn.sendall(b'+')
+                    return data
+                self.conn.sendall(b'-')
+                continue
+            rx = self.conn.recv(4096)
+            if len(rx) == 0:
+                return None
+            self.rxbuf += rx
+
+    # Send the packet (bytes or str) in one write
+    def _send_packet(self, data):
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        if self.log:
+            print("-> {}".format(data[0:80]))
+        self.conn.sendall(b'$' + data + "#{:02x}".format(_checksum(data)).encode())
+
+    # Poll the connection for Ctrl-C while the CPU runs
+    def _interrupted(self):
+        r, w, x = select.select([self.conn], [], [], 0)
+        if len(r) == 0:
+            return False
+        rx = self.conn.recv(4096)
+        if len(rx) == 0:
+            return True
+        self.rxbuf += rx
+        if 0x03 in self.rxbuf:
+            self.rxbuf = self.rxbuf.replace(b'\x03', b'')
+            return True
+        return False
+
+    # The CPU has stopped: read the registers (the memory cache is filled only after that,
+    # because the forced-opcode readout steps the CPU and thus invalidates it)
+    def _stopped(self, regs=None):
+        if regs is None:
+            regs = CpuRegs()
+            if not regs.cpu_read_regs(self.icd):
+                regs = None
+        self.regs = regs
+
+    # Values of the registers, by the REGS names
+    def reg_values(self):
+        r = self.regs
+        word = lambda h, l: ((h or 0) << 8) | (l or 0)
+        return { 'a': word(r.AH, r.AL), 'x': word(r.XH, r.XL), 'y': word(r.YH, r.YL), 'sp': r.SP or 0,
+                 'dp': r.DPR or 0, 'db': r.DBR or 0, 'p': r.FL or 0,
+                 'e': 1 if self.is02 else (r.EMU or 0), 'pc': r.PC or 0 }
+
+    # Write the changed registers; vals: dict name -> value
+    def write_regs(self, vals):
+        if self.regs is None:
+            return False
+        old = self.reg_values()
+        new = CpuRegs()
+        for (name, v) in vals.items():
+            if v == old[name]:
+                continue
+            if name in ('a', 'x', 'y'):
+                setattr(new, name.upper() + 'L', v & 0xFF)
+                setattr(new, name.upper() + 'H', v >> 8)
+            else:
+                setattr(new, { 'sp': 'SP', 'dp': 'DPR', 'db': 'DBR', 'p': 'FL', 'e': 'EMU', 'pc': 'PC' }[name], v)
+        regs = CpuRegs()
+        if not regs.cpu_write_regs(self.icd, new):
+            return False
+        self.regs = regs
+        return True
+
+    # The present memory map; the mapping registers are cached while the CPU is stopped
+    def memmap(self):
+        return CpuMemMap(*self.icd.read_mapregs())
+
+    # Read n bytes at the CPU address
+    def read_mem(self, addr, n):
+        icd = self.icd
+        mm = self.memmap()
+        with icd.batch():
+            parts = []
+            for seg in mm.segments(addr, n):
+                if seg.area == CpuMemMap.AREA_SRAM or seg.area == CpuMemMap.AREA_BOOTROM:
+                    size = GdbServer.SRAM_SIZE if seg.area == CpuMemMap.AREA_SRAM else CpuMemMap.BOOTROM_SIZE
+                    a0 = seg.phys - seg.phys % GdbServer.PREFETCH
+                    a1 = min(size, -(-(seg.phys + seg.length) // GdbServer.PREFETCH) * GdbServer.PREFETCH)
+                    data = icd.cached_read(seg.area, a0, a1 - a0)
+                    parts.append(data[seg.phys - a0:seg.phys - a0 + seg.length])
+                elif seg.area == CpuMemMap.AREA_IO:
+                    # not cached, just the requested registers
+                    parts.append(icd.ioregs_read(seg.phys, seg.length))
+                else:
+                    parts.append(icd.bankregs_read(seg.phys, seg.length))
+            data = ICD.concat(parts)
+        return bytes(data.result() if isinstance(data, ICD.Deferred) else data)
+
+    # Write the bytes at the CPU address
+    def write_mem(self, addr, data):
+        self.memmap().write(self.icd, addr, data)
+
+    # GDB memory map: the whole CPU address space is RAM for GDB, because the ROM-Blocks are SRAM
+    # writable by the ICD (software breakpoints work there as well)
+    def memory_map_xml(self):
+        size = 0x10000 if self.is02 else 0x1000000
+        return ('<?xml version="1.0"?>\n'
+                '<!DOCTYPE memory-map PUBLIC "+//IDN gnu.org//DTD GDB Memory Map V1.0//EN" "http://sourceware.org/gdb/gdb-memory-map.dtd">\n'
+                '<memory-map>\n'
+                '  <memory type="ram" start="0x0" length="0x{:x}"/>\n'
+                '</memory-map>\n').format(size)
+
+    # GDB target description of the registers
+    def target_xml(self):
+        regs = ''.join('    <reg name="{}" bitsize="{}" type="{}"/>\n'.format(name, bits, 'code_ptr' if name == 'pc' else 'int')
+                       for (name, bits) in REGS)
+        return ('<?xml version="1.0"?>\n'
+                '<!DOCTYPE target SYSTEM "gdb-target.dtd">\n'
+                '<target version="1.0">\n'
+                '  <feature name="org.x65.{}">\n'.format('65c02' if self.is02 else '65c816') +
+                regs +
+                '  </feature>\n'
+                '</target>\n')
+
+    # Reply to qXfer:OBJECT:read:ANNEX:OFFSET,LENGTH
+    def _xfer(self, args):
+        (obj, op, annex, rng) = args.split(':')
+        if op != 'read':
+            return ''
+        if obj == 'memory-map':
+            doc = self.memory_map_xml()
+        elif obj == 'features' and annex == 'target.xml':
+            doc = self.target_xml()
+        else:
+            return 'E00'
+        (offs, length) = [ int(x, 16) for x in rng.split(',') ]
+        chunk = doc[offs:offs+length]
+        return ('m' if offs + length < len(doc) else 'l') + chunk
+
+    # Stop reply of the last stop
+    def stop_reply(self):
+        return 'S{:02x}'.format(self.last_stop)
+
+    # Run the CPU until a breakpoint, a watchpoint or Ctrl-C
+    def cont(self):
+        hit = self.bps.run(interrupt=self._interrupted)
+        if hit is None:
+            self._stopped()
+            self.last_stop = SIGINT
+            return self.stop_reply()
+        self._stopped(hit.regs)
+        self.last_stop = SIGTRAP
+        if hit.kind == Hit.WATCH:
+            kind = { Watchpoint.WRITE: 'watch', Watchpoint.READ: 'rwatch' }.get(hit.point.access, 'awatch')
+            return 'T{:02x}{}:{:x};'.format(SIGTRAP, kind, hit.point.lo)
+        return self.stop_reply()
+
+    # Single-step one instruction
+    def step(self):
+        if self.bps.step_to_sync(1) is None:
+            return 'E01'
+        self._stopped()
+        self.last_stop = SIGTRAP
+        return self.stop_reply()
+
+    # Z/z packet: insert or remove a breakpoint or watchpoint
+    def _point(self, insert, args):
+        (t, addr, kind) = args.split(',')[0:3]
+        (t, addr, kind) = (int(t), int(addr, 16), int(kind, 16))
+        key = (t, addr, kind)
+        if t == 0:
+            make = lambda: Breakpoint(addr)
+        elif 2 <= t <= 4:
+            access = { 2: Watchpoint.WRITE, 3: Watchpoint.READ, 4: Watchpoint.READ | Watchpoint.WRITE }[t]
+            make = lambda: Watchpoint(addr, addr + kind, access)
+        else:
+            return ''
+        if insert and key not in self.points:
+            self.points[key] = make()
+            self.bps.add(self.points[key])
+        elif not insert and key in self.points:
+            self.bps.remove(self.points.pop(key))
+        return 'OK'
+
+    # Handle one packet; returns the reply, or None to close the connection
+    def handle(self, pkt):
+        cmd = chr(pkt[0]) if len(pkt) > 0 else ''
+        if cmd == 'X':
+            # binary write: the data must not be decoded as text
+            (hdr, _, data) = pkt[1:].partition(b':')
+            (addr, length) = [ int(x, 16) for x in hdr.decode().split(',') ]
+            data = _unescape(data)
+            if len(data) != length:
+                return 'E01'
+            if length > 0:
+                self.write_mem(addr, data)
+            return 'OK'
+        p = pkt.decode('latin-1')
+        args = p[1:]
+
+        if cmd == '?':
+            return self.stop_reply()
+        elif cmd == 'g':
+            if self.regs is None:
+                return 'E01'
+            vals = self.reg_values()
+            return ''.join(vals[name].to_bytes(bits // 8, 'little').hex() for (name, bits) in REGS)
+        elif cmd == 'G':
+            vals = {}
+            k = 0
+            for (name, bits) in REGS:
+                vals[name] = int.from_bytes(bytes.fromhex(args[k:k + bits // 4]), 'little')
+                k += bits // 4
+            return 'OK' if self.write_regs(vals) else 'E01'
+        elif cmd == 'p':
+            n = int(args, 16)
+            if self.regs is None or n >= len(REGS):
+                return 'E01'
+            (name, bits) = REGS[n]
+            return self.reg_values()[name].to_bytes(bits // 8, 'little').hex()
+        elif cmd == 'P':
+            (n, _, v) = args.partition('=')
+            n = int(n, 16)
+            if n >= len(REGS):
+                return 'E01'
+            return 'OK' if self.write_regs({ REGS[n][0]: int.from_bytes(bytes.fromhex(v), 'little') }) else 'E01'
+        elif cmd == 'm':
+            (addr, length) = [ int(x, 16) for x in args.split(',') ]
+            return self.read_mem(addr, length).hex()
+        elif cmd == 'M':
+            (hdr, _, data) = args.partition(':')
+            addr = int(hdr.split(',')[0], 16)
+            self.write_mem(addr, bytes.fromhex(data))
+            return 'OK'
+        elif cmd == 'c' or cmd == 's':
+            if len(args) > 0:
+                self.write_regs({ 'pc': int(args, 16) })
+            return self.cont() if cmd == 'c' else self.step()
+        elif cmd == 'Z' or cmd == 'z':
+            return self._point(cmd == 'Z', args)
+        elif cmd == 'H' or cmd == 'T':
+            return 'OK'
+        elif cmd == 'k':
+            return None
+        elif cmd == 'D':
+            self.detached = True
+            return 'OK'
+        elif p.startswith('qSupported'):
+            return 'PacketSize=4000;qXfer:memory-map:read+;qXfer:features:read+;QStartNoAckMode+'
+        elif p == 'QStartNoAckMode':
+            # the acks stop after the reply
+            return 'OK'
+        elif p.startswith('qXfer:'):
+            return self._xfer(p[len('qXfer:'):])
+        elif p == 'qAttached':
+            return '1'
+        elif p == 'qC':
+            return 'QC1'
+        elif p == 'qfThreadInfo':
+            return 'm1'
+        elif p == 'qsThreadInfo':
+            return 'l'
+        # not supported
+        return ''
@@ -0,0 +1,143 @@
+import numpy as np
+from icd import ICD
+from tracearr import TraceArray
+from disasm import opcode_table
+
+# Offline heat-map analysis of recorded CPU traces (TraceArray, or TraceReader.cycles()).
+# All the counting is vectorized in NumPy over the whole trace:
+#   - executed instructions per opcode and per PC, and the cycles spent per PC;
+#     the PCs are bank-aware: the MAH of the opcode fetch tells apart the RAM/ROM-Blocks
+#     mapped at the same CPU address (see ICD.MAHDecoded.from_trace),
+#   - reads and writes per 256-byte page of the 24-bit CPU address space,
+#   - reads and writes per IO device window in $9F00-$9FFF (see doc/ioregs.md),
+#   - the share of the internal (neither VPA nor VDA), non-VDA and wait (RDY low) cycles.
+
+# IO device windows: (first CA, end CA, name)
+IO_WINDOWS = [
+    (0x9F00, 0x9F10, "VIA1"),
+    (0x9F10, 0x9F20, "VIA2"),
+    (0x9F20, 0x9F40, "VERA"),
+    (0x9F40, 0x9F50, "AURA"),
+    (0x9F50, 0x9F70, "NORA"),
+    (0x9F70, 0x9F80, "NORA-rsvd"),
+    (0x9F80, 0x9F90, "W6100"),
+    (0x9F90, 0x9FF0, "unused"),
+    (0x9FF0, 0xA000, "scratchpad"),
+]
+
+
+class HeatMap:
+    # ta: TraceArray
+    # is_cputype02: CPU type, for the instruction names
+    def __init__(self, ta: TraceArray, is_cputype02=False):
+        self.is_cputype02 = is_cputype02
+        recs = ta.array()
+        self.n_cycles = len(recs)
+
+        # contiguous copies of the columns: the fields of the (possibly memory-mapped) records are strided,
+        # and every masking pass over them would be several times slower
+        sta = np.ascontiguousarray(recs['sta'])
+        CD = np.ascontiguousarray(recs['CD'])
+        CA = recs['CA'].astype(np.uint32)
+        CBA = recs['CBA'].astype(np.uint32)
+        MAH = recs['MAH'].astype(np.uint32)
+
+        sync = (sta & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC
+        vpa = (sta & ICD.TRACE_FLAG_SYNC_VPA) != 0
+        vda = (sta & ICD.TRACE_FLAG_VDA) != 0
+        rd = (sta & ICD.TRACE_FLAG_RWN) != 0
+
+        # -- instructions
+        self.n_instrs = int(np.count_nonzero(sync))
+        self.opcode_counts = np.bincount(CD[sync], minlength=256)
+
+        # bank-aware PC key of each instruction: MAH:CBA:CA
+        pckey = (MAH << 24) | (CBA << 16) | CA
+        (self.pc_keys, inv, self.pc_instrs) = np.unique(pckey[sync], return_inverse=True, return_counts=True)
+        # cycles per PC: each cycle belongs to the last instruction start at or before it
+        sync_idx = np.flatnonzero(sync)
+        if len(sync_idx) > 0:
+            owner = np.cumsum(sync, dtype=np.int32) - 1
+            counted = owner >= 0
+            self.pc_cycles = np.bincount(inv[owner[counted]], minlength=len(self.pc_keys))
+            # the opcode at each PC (the first seen)
+            first = np.zeros(len(self.pc_keys), dtype=np.int64)
+            first[inv[::-1]] = sync_idx[::-1]
+            self.pc_opcodes = CD[first]
+        else:
+            self.pc_cycles = np.zeros(0, dtype=np.int64)
+            self.pc_opcodes = np.zeros(0, dtype=np.uint8)
+
+        # -- memory accesses: all cycles with a valid address
+        valid = vpa | vda
+        page = (CBA << 8) | (CA >> 8)
+        self.page_reads = np.bincount(page[valid & rd], minlength=65536)
+        self.page_writes = np.bincount(page[valid & ~rd], minlength=65536)
+
+        # -- IO registers
+        io = valid & (CBA == 0) & (CA >= 0x9F00) & (CA < 0xA000)
+        self.io_reads = np.bincount(CA[io & rd] - 0x9F00, minlength=256)
+        self.io_writes = np.bincount(CA[io & ~rd] - 0x9F00, minlength=256)
+        bankregs = valid & (CBA == 0) & (CA < 2)
+        self.bankreg_reads = int(np.count_nonzero(bankregs & rd))
+        self.bankreg_writes = int(np.count_nonzero(bankregs & ~rd))
+
+        # -- cycle classes
+        self.n_internal = int(np.count_nonzero(~valid))
+        self.n_nonvda = int(np.count_nonzero(~vda))
+        self.n_wait = int(np.count_nonzero((sta & ICD.TRACE_FLAG_RDY) == 0))
+
+    # Format the bank-aware PC key
+    @staticmethod
+    def pc_name(key):
+        key = int(key)
+        (MAH, CBA, CA) = (key >> 24, (key >> 16) & 0xFF, key & 0xFFFF)
+        mahd = ICD.MAHDecoded.from_trace(MAH, CBA, CA)
+        return "{} ${:02X}:{:04X}".format(mahd.area_name, CBA, CA)
+
+    # Read/write counts per IO window: list of (name, first CA, reads, writes)
+    def io_windows(self):
+        res = [ ("BANKREGS", 0x0000, self.bankreg_reads, self.bankreg_writes) ]
+        for (lo, hi, name) in IO_WINDOWS:
+            res.append( (name, lo, int(self.io_reads[lo-0x9F00:hi-0x9F00].sum()), int(self.io_writes[lo-0x9F00:hi-0x9F00].sum())) )
+        return res
+
+    # Write the text report; top = number of the entries in each table
+    def write_report(self, f, top=20):
+        table = opcode_table(self.is_cputype02)
+        pct = lambda n, d: n * 100.0 / d if d > 0 else 0.0
+
+        f.write("Cycles: {}, instructions: {}, cycles/instruction: {:.2f}\n".format(
+                    self.n_cycles, self.n_instrs, self.n_cycles / self.n_instrs if self.n_instrs > 0 else 0))
+        f.write("Internal cycles (no VPA/VDA): {:.2f}%   non-VDA: {:.2f}%   wait (RDY low): {:.2f}%\n".format(
+                    pct(self.n_internal, self.n_cycles), pct(self.n_nonvda, self.n_cycles), pct(self.n_wait, self.n_cycles)))
+
+        f.write("\nHot PCs by cycles:\n")
+        f.write("    cycles      %     instrs  cyc/ins   address              instruction\n")
+        for i in np.argsort(-self.pc_cycles, kind='stable')[0:top]:
+            f.write("{:10} {:6.2f} {:10} {:8.2f}   {:<20} {}\n".format(int(self.pc_cycles[i]), pct(int(self.pc_cycles[i]), self.n_cycles),
+                        int(self.pc_instrs[i]), self.pc_cycles[i] / self.pc_instrs[i],
+                        HeatMap.pc_name(self.pc_keys[i]), table[int(self.pc_opcodes[i])].mnemonic))
+
+        f.write("\nOpcodes:\n")
+        f.write("    count      %   opcode\n")
+        for opc in np.argsort(-self.opcode_counts, kind='stable')[0:top]:
+            if self.opcode_counts[opc] == 0:
+                break
+            op = table[int(opc)]
+            f.write("{:9} {:6.2f}   ${:02X} {} {}\n".format(int(self.opcode_counts[opc]), pct(int(self.opcode_counts[opc]), self.n_instrs),
+                        int(opc), op.mnemonic, op.mode))
+
+        f.write("\nPages (256 B) by accesses:\n")
+        f.write("     reads    writes   page\n")
+        tot = self.page_reads + self.page_writes
+        for p in np.argsort(-tot, kind='stable')[0:top]:
+            if tot[p] == 0:
+                break
+            f.write("{:10} {:9}   ${:02X}:{:02X}xx\n".format(int(self.page_reads[p]), int(self.page_writes[p]), int(p) >> 8, int(p) & 0xFF))
+
+        f.write("\nIO windows:\n")
+        f.write("     reads    writes   window\n")
+        for (name, lo, r, w) in self.io_windows():
+            if r + w > 0:
+                f.write("{:10} {:9}   ${:04X} {}\n".format(r, w, lo, name))
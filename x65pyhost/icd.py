@@ -1,5 +1,6 @@
 # import x65ftdi
 import random
+from contextlib import contextmanager
 
 # ICD - In-Circuit Debugger
 # This class provides the low-level access to the ICD (In-Circuit Debugger) of the X65.
@@ -32,11 +33,18 @@ class ICD:
     ICD_OTHER_WRITE = (CMD_BUSMEM_ACC | (1 << nSRAM_OTHER_BIT) | (1 << ADR_INC_BIT))
     ICD_OTHER_READ = (CMD_BUSMEM_ACC | (1 << nSRAM_OTHER_BIT) | (1 << nWRITE_READ_BIT) | (1 << ADR_INC_BIT))
 
+    # Non-incrementing access to the OTHER area, for FIFO-like registers (e.g. VERA DATA0)
+    ICD_OTHER_WRITE_FIFO = (CMD_BUSMEM_ACC | (1 << nSRAM_OTHER_BIT))
+    ICD_OTHER_READ_FIFO = (CMD_BUSMEM_ACC | (1 << nSRAM_OTHER_BIT) | (1 << nWRITE_READ_BIT))
+
     # Aux definitions
     PG65SIZE = 256             # misnomer => PAGE
     BLOCKSIZE = 8192             # misnomer => BLOCK
     MAXREQSIZE = 16384          # max size of a single request (FTDI limit)
     SIZE_2MB =	(2048 * 1024)
+    CACHE_LINE = 16             # size of a line in the memory cache, see read_as_cpu()
+    TRACEBUF_DEPTH = 256        # entries of the trace buffer in NORA (CPUTRACE_DEPTH = 8 in icd_controller.v)
+    TRACEREC_SIZE = 7           # bytes of one trace record (trace register)
 
     # CPU Status flags (low byte of tr_flag)
     TRACE_FLAG_RWN =		1
@@ -61,6 +69,171 @@ class ICD:
         # communication link - x65ftdi
         self.com = com
         self.is_cputype02_hw = None
+        # queue of the pending transactions in the batch mode; None => not in a batch
+        self.batch_queue = None
+        self.batch_depth = 0
+        # Memory cache, valid while the CPU is stopped: cleared by cpu_ctrl() and by all host writes.
+        # cache_lines: (area, line-number) -> bytes; area is 'sram' or 'bootrom'
+        self.cache_lines = {}
+        self.cache_mapregs = None       # registers $9F50-$9F53
+        self.cache_epoch = 0            # incremented on each invalidation
+
+    # Result of an ICD transaction issued inside of a batch().
+    # The value becomes available when the (outermost) batch is finished.
+    class Deferred:
+        def __init__(self, decode=None):
+            self.decode = decode
+            self.done = False
+            self.value = None
+            self.chained = []
+
+        # Return the value; raises if the batch has not been finished yet.
+        def result(self):
+            if not self.done:
+                raise RuntimeError("ICD: deferred result is not available until the end of the batch")
+            return self.value
+
+        # Return a new Deferred that gets the value fn(self.result()).
+        def then(self, fn):
+            d = ICD.Deferred(fn)
+            if self.done:
+                d.set_result(self.value)
+            else:
+                self.chained.append(d)
+            return d
+
+        # Internal: set the raw value, decode it, and propagate it to the chained Deferreds.
+        def set_result(self, raw):
+            self.value = raw if self.decode is None else self.decode(raw)
+            self.done = True
+            for d in self.chained:
+                d.set_result(self.value)
+            self.chained = []
+
+    # Apply fn on a value that could be immediate or an ICD.Deferred.
+    # Returns fn(value), or a Deferred of it.
+    @staticmethod
+    def then(value, fn):
+        if isinstance(value, ICD.Deferred):
+            return value.then(fn)
+        return fn(value)
+
+    # Batch mode: all ICD transactions issued inside of the with-block are queued
+    # and sent at once at the end of the block, using just one USB write/read turn-around
+    # (in the packed mode of X65Ftdi).
+    # Methods returning data return ICD.Deferred inside of the batch; use .result() after the block.
+    # Batches could be nested; the nested batch joins the outer one.
+    # Usage:
+    #   with icd.batch():
+    #       icd.iopoke(0x20, 0x00)
+    #       r = icd.iopeek(0x23)
+    #   print(r.result())
+    @contextmanager
+    def batch(self):
+        if self.batch_depth == 0:
+            self.batch_queue = []
+        self.batch_depth += 1
+        try:
+            yield self
+        except:
+            # drop the queued transactions in case of an error
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.batch_queue = None
+            raise
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.batch_flush()
+
+    # Send out all the pending batched transactions and resolve their results.
+    # Called at the end of the outermost batch(); could be called inside of the batch
+    # when some results are needed before continuing.
+    def batch_flush(self):
+        queue = self.batch_queue
+        self.batch_queue = [] if self.batch_depth > 0 else None
+        if not queue:
+            return
+        rxs = self.com.icd_transfer_many([ (out, readlen) for (out, readlen, d) in queue ])
+        for (out, readlen, d), rx in zip(queue, rxs):
+            d.set_result(rx)
+
+    # Concatenate a list of byte chunks, which could be immediate or ICD.Deferred.
+    # Returns bytearray, or a Deferred of it if any chunk is Deferred.
+    @staticmethod
+    def concat(parts):
+        if not any(isinstance(p, ICD.Deferred) for p in parts):
+            return bytearray().join(parts)
+        # the deferred results are resolved in order, so once the last one is done, all are.
+        last = [ p for p in parts if isinstance(p, ICD.Deferred) ][-1]
+        return last.then(lambda _: bytearray().join(p.result() if isinstance(p, ICD.Deferred) else p for p in parts))
+
+    # Run one ICD transaction, or queue it in the batch mode.
+    # out: bytes to send
+    # readlen: number of bytes to exchange and receive; 0 => write-only
+    # decode: optional function to post-process the received bytes
+    # Returns the (decoded) response, or ICD.Deferred in the batch mode.
+    def transact(self, out, readlen=0, decode=None):
+        if self.batch_queue is not None:
+            d = ICD.Deferred(decode)
+            self.batch_queue.append( (out, readlen, d) )
+            return d
+        rxdata = self.com.icd_transfer(out, readlen)
+        return rxdata if decode is None else decode(rxdata)
+
+    # Invalidate the memory cache. Called automatically when the CPU is started/stepped/stopped
+    # by cpu_ctrl(), when the ICD finds the CPU running, and on every host write via buswrite().
+    def cache_invalidate(self):
+        self.cache_lines = {}
+        self.cache_mapregs = None
+        self.cache_epoch += 1
+
+    # Read through the memory cache.
+    # area: 'sram' or 'bootrom'
+    # maddr: address in the area
+    # n: number of bytes
+    # The missing lines are fetched in one ICD batch; contiguous lines in a single burst.
+    def cached_read(self, area, maddr, n):
+        first = maddr // ICD.CACHE_LINE
+        last = (maddr + n - 1) // ICD.CACHE_LINE
+        missing = [ ln for ln in range(first, last+1) if (area, ln) not in self.cache_lines ]
+        if len(missing) > 0:
+            # group the missing lines to contiguous runs
+            runs = []
+            for ln in missing:
+                if len(runs) > 0 and runs[-1][1] == ln:
+                    runs[-1][1] = ln + 1
+                else:
+                    runs.append([ln, ln + 1])
+            reads = []
+            with self.batch():
+                for (l0, l1) in runs:
+                    if area == 'bootrom':
+                        reads.append(self.bootrom_blockread(l0 * ICD.CACHE_LINE, (l1 - l0) * ICD.CACHE_LINE))
+                    else:
+                        reads.append(self.sram_blockread(l0 * ICD.CACHE_LINE, (l1 - l0) * ICD.CACHE_LINE))
+                # results are needed now, also when inside of an outer batch
+                self.batch_flush()
+            for (l0, l1), rd in zip(runs, reads):
+                data = rd.result()
+                for ln in range(l0, l1):
+                    k = (ln - l0) * ICD.CACHE_LINE
+                    self.cache_lines[(area, ln)] = bytes(data[k:k+ICD.CACHE_LINE])
+        # assemble the result from the cached lines
+        data = bytearray()
+        for ln in range(first, last+1):
+            data += self.cache_lines[(area, ln)]
+        offs = maddr - first * ICD.CACHE_LINE
+        return data[offs:offs+n]
+
+    # Read the memory-mapping registers $9F50-$9F53 (RamBLOCK_AB, ROMBLOCK/RamBLOCK_CD, RamBMASK, RMBCTRL)
+    # in one transaction; cached while the CPU is stopped.
+    def read_mapregs(self):
+        if self.cache_mapregs is None:
+            with self.batch():
+                regs = self.ioregs_read(0x50, 4)
+                self.batch_flush()
+            self.cache_mapregs = bytes(regs.result())
+        return self.cache_mapregs
 
     # return true iff the CPU is 65C02, and false iff it is 65C816.
     # The result is cached, and the CPU type is read from the hw only once.
@@ -77,12 +250,19 @@ class ICD:
     # n: number of bytes to read
     def busread(self, cmd, maddr, n):
         hdr = bytes( [cmd, maddr & 0xFF, (maddr >> 8) & 0xFF, (maddr >> 16) & 0xFF, 0x00 ] )
-        self.com.icd_chip_select()
-        rxdata = self.com.spiexchange(hdr, n+len(hdr))
-        # slave.write(hdr, start=False, stop=False, droptail=1)
-        # rxdata = slave.read(n, start=False, stop=False)
-        self.com.icd_chip_deselect()
-        return rxdata[5:]
+        return self.transact(hdr, n+len(hdr), lambda rxdata: rxdata[5:])
+
+    # Read bytes from X65 bus directly into a buffer, without intermediate copies.
+    # cmd: command byte, one of ICD.CMD_*
+    # maddr: 24-bit bus address
+    # mv: writable memoryview of bytes; its length is the number of bytes to read
+    def busread_into(self, cmd, maddr, mv):
+        hdr = bytes( [cmd, maddr & 0xFF, (maddr >> 8) & 0xFF, (maddr >> 16) & 0xFF, 0x00 ] )
+        n = len(mv)
+        def fill(rxdata):
+            mv[:] = memoryview(rxdata)[len(hdr):len(hdr)+n]
+            return n
+        return self.transact(hdr, n+len(hdr), fill)
 
     # Write data bytes to X65 bus. This is a primitive base function used in below methods.
     # cmd: command byte, one of ICD.CMD_*
@@ -90,10 +270,9 @@ class ICD:
     # data: bytes to write
     def buswrite(self, cmd, maddr, data):
         hdr = bytes([cmd, maddr & 0xFF, (maddr >> 8) & 0xFF, (maddr >> 16) & 0xFF ])
-        self.com.icd_chip_select()
-        self.com.spiwriteonly(hdr)
-        self.com.spiwriteonly(data)
-        self.com.icd_chip_deselect()
+        # any host write could change what the CPU sees
+        self.cache_invalidate()
+        self.transact(hdr + bytes(data))
 
 
     # Read from BLOCKREGs area.
@@ -137,6 +316,37 @@ class ICD:
         maddr |= (1 << ICD.ICD_OTHER_IOREG_BIT) | 0x9F00
         return self.buswrite(ICD.ICD_OTHER_WRITE, maddr, data)
 
+    # Write a stream of bytes to a single IO register, without incrementing the address.
+    # Intended for FIFO-like data ports, e.g. VERA DATA0/DATA1.
+    # maddr: 8-bit address of the IO register
+    # data: bytes to write, any length
+    def ioregs_write_fifo(self, maddr, data):
+        maddr &= 0xFF
+        maddr |= (1 << ICD.ICD_OTHER_IOREG_BIT) | 0x9F00
+        k = 0
+        # write in chunks of MAXREQSIZE (FTDI limit)
+        while len(data)-k > ICD.MAXREQSIZE:
+            self.buswrite(ICD.ICD_OTHER_WRITE_FIFO, maddr, data[k:k+ICD.MAXREQSIZE])
+            k = k + ICD.MAXREQSIZE
+        # write the rest
+        self.buswrite(ICD.ICD_OTHER_WRITE_FIFO, maddr, data[k:])
+
+    # Read a stream of bytes from a single IO register, without incrementing the address.
+    # Note that the ICD reads one byte ahead at the end of each transaction; the extra
+    # read is lost for the data ports with side effects (auto-incrementing VERA DATA0/1).
+    # maddr: 8-bit address of the IO register
+    # n: number of bytes to read, any length
+    def ioregs_read_fifo(self, maddr, n):
+        maddr &= 0xFF
+        maddr |= (1 << ICD.ICD_OTHER_IOREG_BIT) | 0x9F00
+        parts = []
+        k = 0
+        # read in chunks of MAXREQSIZE (FTDI limit)
+        while k < n:
+            parts.append(self.busread(ICD.ICD_OTHER_READ_FIFO, maddr, min(n-k, ICD.MAXREQSIZE)))
+            k = k + ICD.MAXREQSIZE
+        return ICD.concat(parts)
+
     # Write 1byte to IO register. Helper function.
     # The IO area is located in the CPU address space at 0x9F00-0x9FFF, but here
     # it is accessed via the ICD as a separate area, thus it as the base address 0x0000.
@@ -149,7 +359,7 @@ class ICD:
     # addr: 8-bit address of the IO register
     def iopeek(self, addr):
         data = self.ioregs_read(addr, 1)
-        return data[0]
+        return ICD.then(data, lambda data: data[0])
 
     # Read from the bootrom area used by the PBL (Primary Boot Loader).
     # maddr: 12-bit offset in the bootrom
@@ -185,8 +395,38 @@ class ICD:
     # maddr: 24-bit address in the SRAM
     # n: number of bytes to read
     def sram_blockread(self, maddr, n):
-        # FIXME: read in chunks of MAXREQSIZE (FTDI limit) - is this necessary?
-        return self.busread(ICD.ICD_SRAM_READ, maddr, n)
+        buf = bytearray(n)
+        nread = self.sram_readinto(maddr, buf)
+        # in the batch mode, the buffer is filled in when the batch is finished
+        return ICD.then(nread, lambda _: buf)
+
+    # Read bytes from SRAM directly into a pre-allocated buffer, in chunks of MAXREQSIZE (FTDI limit).
+    # maddr: 24-bit address in the SRAM
+    # buf: writable buffer (bytearray, memoryview, ...); its length is the number of bytes to read
+    # Returns the number of bytes, or a Deferred of it in the batch mode
+    # (then the buffer is filled in at the end of the batch).
+    def sram_readinto(self, maddr, buf):
+        mv = memoryview(buf).cast('B')
+        n = len(mv)
+        last = n
+        k = 0
+        while k < n:
+            m = min(n-k, ICD.MAXREQSIZE)
+            last = self.busread_into(ICD.ICD_SRAM_READ, maddr+k, mv[k:k+m])
+            k = k + m
+        # chunks are completed in order: the last one done => all done
+        return ICD.then(last, lambda _: n)
+
+    # Read SRAM in chunks of MAXREQSIZE (FTDI limit), yielding each chunk as it arrives.
+    # Only one chunk is held in the memory at a time, e.g. for streaming to a file.
+    # maddr: 24-bit address in the SRAM
+    # n: number of bytes to read
+    def sram_readchunks(self, maddr, n, chunksize=MAXREQSIZE):
+        k = 0
+        while k < n:
+            m = min(n-k, chunksize)
+            yield self.busread(ICD.ICD_SRAM_READ, maddr+k, m)
+            k = k + m
 
     # Run memory test on the SRAM. Destroys the content of the SRAM.
     # seed: random seed for the test
@@ -302,10 +542,12 @@ class ICD:
         def from_hw(cls, icd, CBA, CA):
             # create MAHDecoded object
             self = cls()
-            # read current ROMBLOCK and RAMBLOCK registers from the hw via the icd link
-            bregs = icd.ioregs_read(0x50, 2)
-            # read RMBCTRL reg at 0x9F53
-            rmbctrl = icd.iopeek(0x53)
+            # read current ROMBLOCK and RAMBLOCK registers, RAMBMASK and RMBCTRL reg at 0x9F53
+            # from the hw via the icd link (cached while the CPU is stopped)
+            regs = icd.read_mapregs()
+            bregs = regs[0:2]
+            rambmask = regs[2]
+            rmbctrl = regs[3]
             self.has_bootrom = (rmbctrl & 0x80) != 0
             ENABLE_ROM_CDEF = (rmbctrl & 0x10) != 0
             ENABLE_RAM_CD = (rmbctrl & 0x08) != 0
@@ -316,7 +558,7 @@ class ICD:
                     self.sram_block_raw = 0x00      # low-memory starts in SRAM block 0
                 elif 0xA000 <= CA < 0xC000:
                     # CPU RAM-Block from $A000 to $BFFF
-                    ramblock_raw = bregs[0] ^ 0x80
+                    ramblock_raw = (bregs[0] & rambmask) ^ 0x80
                     self.sram_block_raw = ramblock_raw
                 elif 0xC000 <= CA < 0xE000:
                     # CPU second RAM-Block from $C000 to $DFFF,
@@ -324,11 +566,11 @@ class ICD:
                     # or direct mapped memory.
                     if ENABLE_ROM_CDEF:
                         # ROM-Block
-                        romblock = bregs[1] 
+                        romblock = bregs[1] & 0x1F
                         self.sram_block_raw = (0x080000 + romblock*2*ICD.BLOCKSIZE) >> 13
                     elif ENABLE_RAM_CD:
                         # the second RAM-Block
-                        ramblock2_raw = bregs[1] ^ 0x80
+                        ramblock2_raw = (bregs[1] & rambmask) ^ 0x80
                         self.sram_block_raw = ramblock2_raw
                     else:
                         # nothing of that -> direct underlaying memory
@@ -338,7 +580,7 @@ class ICD:
                     # or direct mapped memory.
                     if ENABLE_ROM_CDEF:
                         # CPU ROM bank (upper 8kB),
-                        romblock = bregs[1] 
+                        romblock = bregs[1] & 0x1F
                         self.sram_block_raw = (0x080000 + (romblock*2 + 1)*ICD.BLOCKSIZE) >> 13
                     else:
                         # direct underlaying memory
@@ -353,50 +595,73 @@ class ICD:
     # and CA (CPU Address [15:0]).
     # MAH is decoded into the bank address.
     def read_byte_as_cpu(self, CBA: int, mahd: MAHDecoded, CA: int) -> int:
-        # We have to differentiate based on the CPU Bank Address (65C816 topmost 8 bits of the address).
-        # In case of CBA = 0, we must decode the address carefully, because it could be in the ROM, RAM, or IO area.
-        # In case of CBA != 0, the address is linear into the SRAM and can be read directly.
-        if CBA == 0:
-            # bank zero -> must decode carefuly!
-            bregs = self.ioregs_read(0x50, 2)
-            rmbctrl = self.iopeek(0x53)
-            MIRROR_ZP = (rmbctrl & 0x20) != 0
-            # ENABLE_ROM_CDEF = (rmbctrl & 0x10) != 0
-            # ENABLE_RAM_CD = (rmbctrl & 0x08) != 0
-
-            if (0 <= CA < 2) and MIRROR_ZP:
-                # bank regs (mirror to zero page is enabled)
-                rdata = bregs[CA]
-            elif CA < 0x9F00:
-                # CPU low memory starts at sram fix 0x000000
-                rdata = self.sram_blockread(CA + 0x000000, 1)
-            elif 0xA000 <= CA < 0xC000:
-                # CPU RAM Bank between $A000 to $BFFF
-                offs = (CA - 0xA000)
-                rdata = self.sram_blockread(offs + mahd.sram_block_raw*ICD.BLOCKSIZE, 1)
-            elif 0xC000 <= CA < 0xE000:
-                # CPU second RAM-Block from $C000 to $DFFF,
-                # or ROM-Block (lower 8kB)
-                # or direct mapped memory.
-                offs = (CA - 0xC000)
-                rdata = self.sram_blockread(offs + mahd.sram_block_raw*ICD.BLOCKSIZE, 1)
-            elif 0xE000 <= CA:
-                # CPU ROM bank (upper 8kB),
-                # or direct mapped memory.
-                offs = (CA - 0xE000)
-                if not mahd.has_bootrom:
-                    rdata = self.sram_blockread(offs + mahd.sram_block_raw*ICD.BLOCKSIZE, 1)
+        return self.read_as_cpu(CBA, mahd, CA, 1)[0]
+
+    # Read n bytes via ICD memory access from the target, the way a CPU would do, see read_byte_as_cpu().
+    # The CA wraps around within the bank, like the CPU program counter.
+    # SRAM and bootrom are read through the memory cache (valid while the CPU is stopped),
+    # so the bytes of one instruction are fetched in a single burst, and the mapping registers just once.
+    # The result is always immediate, also inside of an ICD batch: the pending transactions are flushed.
+    def read_as_cpu(self, CBA: int, mahd: MAHDecoded, CA: int, n: int) -> bytearray:
+        data = bytearray()
+        # mahd describes just the 8kB frame of the starting address
+        mahd_frame = (CA & 0xFFFF) >> 13
+        while n > 0:
+            CA &= 0xFFFF
+            if (CA >> 13) != mahd_frame or mahd.sram_block_raw is None:
+                # crossed to another frame -> use the present mapping in the hw
+                mahd = ICD.MAHDecoded.from_hw(self, CBA, CA)
+                mahd_frame = CA >> 13
+            # We have to differentiate based on the CPU Bank Address (65C816 topmost 8 bits of the address).
+            # In case of CBA = 0, we must decode the address carefully, because it could be in the ROM, RAM, or IO area.
+            # In case of CBA != 0, the address is linear into the SRAM and can be read directly.
+            if CBA == 0:
+                # bank zero -> must decode carefuly!
+                regs = self.read_mapregs()
+                MIRROR_ZP = (regs[3] & 0x20) != 0
+                # ENABLE_ROM_CDEF = (regs[3] & 0x10) != 0
+                # ENABLE_RAM_CD = (regs[3] & 0x08) != 0
+
+                if (0 <= CA < 2) and MIRROR_ZP:
+                    # bank regs (mirror to zero page is enabled)
+                    area, maddr, run = None, CA, 2 - CA
+                elif CA < 0x9F00:
+                    # CPU low memory starts at sram fix 0x000000
+                    area, maddr, run = 'sram', CA + 0x000000, 0x9F00 - CA
+                elif CA < 0xA000:
+                    # IO regs: not cached
+                    area, maddr, run = 'io', CA - 0x9F00, 0xA000 - CA
+                elif (CA < 0xE000) or not mahd.has_bootrom:
+                    # CPU RAM Bank between $A000 to $BFFF,
+                    # or CPU second RAM-Block from $C000 to $DFFF, or ROM-Block,
+                    # or direct mapped memory.
+                    offs = CA & (ICD.BLOCKSIZE - 1)
+                    area, maddr, run = 'sram', offs + mahd.sram_block_raw*ICD.BLOCKSIZE, ICD.BLOCKSIZE - offs
                 else:
-                    # bootrom inside of NORA
-                    # print("[bootrom_blockread({})]".format(offs))
-                    rdata = self.bootrom_blockread(offs, 1)
-        else:
-            # CPU Bank non-zero -> linear address into SRAM
-            # Form linear address from CBA (highest 8 bits) and CA (lower 16 bits).
-            # Since we have just 2 MB or RAM, mask out the remaining bits.
-            lin_addr = ((CBA << 16) | CA) & 0x1FFFFF
-            rdata = self.sram_blockread(lin_addr, 1)
-        return rdata[0]
+                    # bootrom inside of NORA, 512B mirrored
+                    offs = (CA - 0xE000) & 0x1FF
+                    area, maddr, run = 'bootrom', offs, 0x200 - offs
+            else:
+                # CPU Bank non-zero -> linear address into SRAM
+                # Form linear address from CBA (highest 8 bits) and CA (lower 16 bits).
+                # Since we have just 2 MB or RAM, mask out the remaining bits.
+                lin_addr = ((CBA << 16) | CA) & 0x1FFFFF
+                area, maddr, run = 'sram', lin_addr, 0x10000 - CA
+
+            m = min(n, run)
+            if area is None:
+                data += regs[maddr:maddr+m]
+            elif area == 'io':
+                # flushed like the cached reads, also when inside of an outer batch
+                with self.batch():
+                    rd = self.ioregs_read(maddr, m)
+                    self.batch_flush()
+                data += rd.result()
+            else:
+                data += self.cached_read(area, maddr, m)
+            CA += m
+            n -= m
+        return data
 
 
     # 
@@ -432,9 +697,9 @@ class ICD:
 
         hdr = bytes([ ICD.CMD_CPUCTRL | (run_cpu << 4) | (cstep_cpu << 5), cpu_sig ])
 
-        self.com.icd_chip_select()
-        self.com.spiwriteonly(hdr)
-        self.com.icd_chip_deselect()
+        # the CPU state and memory could change from now on
+        self.cache_invalidate()
+        self.transact(hdr)
 
 
     # send the
@@ -449,9 +714,7 @@ class ICD:
         
         hdr = bytes([ ICD.CMD_FORCECDB | (is_forced_db << 4) | (ignore_cpu_writes << 5), forced_db ])
 
-        self.com.icd_chip_select()
-        self.com.spiwriteonly(hdr)
-        self.com.icd_chip_deselect()
+        self.transact(hdr)
 
 
     # Read CPU Status, and LSB of Trace Register.
@@ -469,11 +732,21 @@ class ICD:
         #                               /*dummy*/
         hdr = bytes([ ICD.CMD_GETSTATUS, 0  ])
 
-        self.com.icd_chip_select();
         treglen = 1
-        rxdata = self.com.spiexchange(hdr, treglen+1+len(hdr))
-        self.com.icd_chip_deselect()
-
+        return self.transact(hdr, treglen+1+len(hdr), self.decode_status_checked)
+
+    # Decode the response of CMD_GETSTATUS or CMD_READTRACE, see decode_status(),
+    # and invalidate the memory cache if the CPU is found running.
+    def decode_status_checked(self, rxdata):
+        status = ICD.decode_status(rxdata)
+        if status[4]:
+            self.cache_invalidate()
+        return status
+
+    # Decode the response of CMD_GETSTATUS or CMD_READTRACE.
+    # Returns the tuple (is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, trace-reg bytes).
+    @staticmethod
+    def decode_status(rxdata):
         is_valid = rxdata[2] & 1            # TRACE-REG VALID?  
         is_ovf = rxdata[2] & 2              # TRACE-REG OVERFLOWED?
         is_tbr_valid = rxdata[2] & 4        # TRACE-BUFFER NON-EMPTY?
@@ -505,18 +778,39 @@ class ICD:
         #                               /*dummy*/
         hdr = bytes([ ICD.CMD_READTRACE | (tbr_deq << 4) | (tbr_clear << 5) | (sample_cpu << 6), 0  ])
 
-        self.com.icd_chip_select();
-        rxdata = self.com.spiexchange(hdr, treglen+1+len(hdr))
-        self.com.icd_chip_deselect()
-
-        is_valid = rxdata[2] & 1            # TRACE-REG VALID?  
-        is_ovf = rxdata[2] & 2              # TRACE-REG OVERFLOWED?
-        is_tbr_valid = rxdata[2] & 4        # TRACE-BUFFER NON-EMPTY?
-        is_tbr_full = rxdata[2] & 8         # TRACE-BUFFER FULL?
-        is_cpuruns = rxdata[2] & 16         # CPU-RUNNING?
-        # print('icd_cpu_read_trace got {}'.format(rxdata.hex()))
+        return self.transact(hdr, treglen+1+len(hdr), self.decode_status_checked)
+
+
+    # Read out (dequeue) the whole trace buffer; the CPU must be stopped.
+    # In the packed mode of X65Ftdi all the dequeue commands go back-to-back in one batch
+    # (i.e. one USB transfer); the extra dequeues of an empty buffer are harmless, as NORA
+    # just reports the buffer empty. Otherwise the buffer is dequeued one entry at a time.
+    # Returns bytes with the records packed one after another, TRACEREC_SIZE bytes each,
+    # from the oldest to the newest; see ICD.TraceReg for the decoding of a record.
+    def drain_tracebuffer(self):
+        if self.batch_queue is not None:
+            raise RuntimeError("ICD.drain_tracebuffer cannot be used inside of ICD.batch()")
+        recs = bytearray()
+        if getattr(self.com, 'packed', False):
+            # +1: the last one must report the buffer empty
+            with self.batch():
+                reads = [ self.cpu_read_trace(tbr_deq=True) for i in range(0, ICD.TRACEBUF_DEPTH+1) ]
+            for rd in reads:
+                is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = rd.result()
+                if not is_tbr_valid or is_cpuruns:
+                    break
+                recs += rawbuf[0:ICD.TRACEREC_SIZE]
+        else:
+            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.cpu_read_trace(tbr_deq=True)
+            while is_tbr_valid and not is_cpuruns:
+                recs += rawbuf[0:ICD.TRACEREC_SIZE]
+                is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.cpu_read_trace(tbr_deq=True)
+        return bytes(recs)
 
-        return (is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rxdata[3:])
+    # Split the packed records from drain_tracebuffer() into a list of ICD.TraceReg.
+    @staticmethod
+    def trace_records(recs):
+        return [ ICD.TraceReg(bytearray(recs[k:k+ICD.TRACEREC_SIZE])) for k in range(0, len(recs), ICD.TRACEREC_SIZE) ]
 
 
     # Trace Register
@@ -524,9 +818,9 @@ class ICD:
     class TraceReg:
         # Decode trace-reg raw buffer received by cpu_read_trace()
         def __init__(self, rawbuf):
-            # rawbuf must be (at least) 7 elements
-            while len(rawbuf) < 7:
-                rawbuf.append(0)
+            # rawbuf must be (at least) 7 elements; pad a copy, the caller's buffer is not modified
+            if len(rawbuf) < 7:
+                rawbuf = bytes(rawbuf) + bytes(7 - len(rawbuf))
             
             # extract the basic fields from the raw buffer
             self.sta_flags = rawbuf[0]
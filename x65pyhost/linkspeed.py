@@ -0,0 +1,150 @@
+import os
+import json
+import random
+
+# Link speed (SPI clock of the ICD link) calibration and the profile cache.
+# The FT2232H can clock the SPI up to 30 MHz, but the maximal reliable speed of the ICD link
+# depends on the board, cable and the NORA build. The calibration tries rising frequencies,
+# checks write/readback integrity in several passes per frequency, and stores one step below the highest
+# passing frequency (as a margin) in a small JSON file per board. X65Ftdi uses the stored frequency by default.
+
+# Location of the profile cache; could be overriden by the environment variable.
+PROFILE_FILE = os.environ.get('X65_LINKSPEED_FILE',
+                    os.path.join(os.path.expanduser('~'), '.x65', 'linkspeed.json'))
+
+# Candidate SPI frequencies in Hz; the FT2232H makes the SPI clock as 30MHz/N.
+CAL_FREQS = [ 1E6, 2E6, 3E6, 5E6, 6E6, 7.5E6, 10E6, 15E6, 30E6 ]
+
+# Number of the clean link_test() passes required at each frequency
+CAL_PASSES = 3
+
+# Scratchpad area in the IO space: $9FF0 to $9FFF is in SRAM and not used by any IO device.
+SCRATCH_IOADDR = 0xF0
+SCRATCH_SIZE = 16
+
+
+# Load all profiles from the cache file. Returns a dict: board-key -> profile dict.
+def load_profiles(fname=None):
+    fname = PROFILE_FILE if fname is None else fname
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Return the cached SPI frequency of the board, or None if not known.
+def cached_freq(board, fname=None):
+    prof = load_profiles(fname).get(board)
+    if prof is None:
+        return None
+    return prof.get('freq')
+
+# Store the profile of the board in the cache file.
+# board: board key, see X65Ftdi.board_key()
+# freq: the SPI frequency to use in Hz
+# max_freq: optional highest passing frequency of the calibration; freq is below it by the margin
+# results: optional list of (freq, ok) of the calibration run
+# passes: optional number of the clean passes per frequency of the calibration run
+def save_profile(board, freq, results=None, fname=None, max_freq=None, passes=None):
+    fname = PROFILE_FILE if fname is None else fname
+    profiles = load_profiles(fname)
+    profiles[board] = { 'freq': freq }
+    if max_freq is not None:
+        profiles[board]['max_freq'] = max_freq
+        profiles[board]['margin'] = "one step below max_freq"
+    if passes is not None:
+        profiles[board]['passes'] = passes
+    if results is not None:
+        profiles[board]['results'] = [ [f, ok] for (f, ok) in results ]
+    d = os.path.dirname(fname)
+    if d != '' and not os.path.isdir(d):
+        os.makedirs(d)
+    with open(fname, 'w') as f:
+        json.dump(profiles, f, indent=2)
+
+# Remove the profile of the board from the cache file.
+def clear_profile(board, fname=None):
+    fname = PROFILE_FILE if fname is None else fname
+    profiles = load_profiles(fname)
+    if board in profiles:
+        del profiles[board]
+        with open(fname, 'w') as f:
+            json.dump(profiles, f, indent=2)
+
+
+# Run the integrity test at the current link speed.
+# Writes random patterns to the test area, reads them back and compares.
+# The original content of the test area is NOT restored here, see calibrate().
+# icd: ICD object
+# rounds: number of write/readback rounds
+# sram_addr: None => test the IO scratchpad ($9FF0-$9FFF);
+#            otherwise the SRAM address of a test block of sram_len bytes.
+# Returns True iff all rounds passed.
+def link_test(icd, rounds=32, sram_addr=None, sram_len=4096):
+    for r in range(0, rounds):
+        if sram_addr is None:
+            pattern = random.randbytes(SCRATCH_SIZE)
+            icd.ioregs_write(SCRATCH_IOADDR, pattern)
+            rdback = icd.ioregs_read(SCRATCH_IOADDR, SCRATCH_SIZE)
+        else:
+            pattern = random.randbytes(sram_len)
+            icd.sram_blockwrite(sram_addr, pattern)
+            rdback = icd.sram_blockread(sram_addr, sram_len)
+        if rdback != pattern:
+            return False
+    return True
+
+# Calibrate the link speed: try rising frequencies until the integrity test fails.
+# Each frequency must pass the test CAL_PASSES times; the result is one step below the highest
+# passing frequency, because a link on the edge passes a short test but fails occasionally.
+# The CPU should be stopped, the test area is overwritten during the test
+# and restored (at the initial frequency) at the end.
+# Beware that at a too high frequency a corrupted ICD command could also write elsewhere!
+# icd: ICD object; icd.com must be X65Ftdi
+# freqs: list of candidate frequencies, rising; default CAL_FREQS
+# rounds, sram_addr, sram_len: see link_test()
+# verbose: print the progress
+# passes: number of the clean passes required per frequency; default CAL_PASSES
+# Returns (freq, max_freq, results), where results is the list of (freq, ok), max_freq is the highest
+# passing frequency and freq the one step below it (or the lowest one, if just that passed);
+# both are None if not even the lowest frequency passed.
+def calibrate(icd, freqs=None, rounds=32, sram_addr=None, sram_len=4096, verbose=True, passes=None):
+    com = icd.com
+    freqs = CAL_FREQS if freqs is None else freqs
+    passes = CAL_PASSES if passes is None else passes
+    orig_freq = com.freq
+
+    # save the test area at the initial (known good) speed
+    if sram_addr is None:
+        saved = icd.ioregs_read(SCRATCH_IOADDR, SCRATCH_SIZE)
+    else:
+        saved = icd.sram_blockread(sram_addr, sram_len)
+
+    passed = []
+    results = []
+    for freq in freqs:
+        com.set_spi_freq(freq)
+        try:
+            ok = all(link_test(icd, rounds, sram_addr, sram_len) for p in range(0, passes))
+        except IOError:
+            ok = False
+        results.append( (freq, ok) )
+        if verbose:
+            print("  {:6.2f} MHz: {}".format(freq / 1E6, "OK" if ok else "FAIL"))
+        if not ok:
+            break
+        passed.append(freq)
+    max_freq = passed[-1] if len(passed) > 0 else None
+    # margin: one step below the highest passing frequency
+    best_freq = passed[-2] if len(passed) > 1 else max_freq
+
+    # restore the test area at the initial speed
+    com.set_spi_freq(orig_freq)
+    if sram_addr is None:
+        icd.ioregs_write(SCRATCH_IOADDR, saved)
+    else:
+        icd.sram_blockwrite(sram_addr, saved)
+
+    if best_freq is not None:
+        com.set_spi_freq(best_freq)
+    return (best_freq, max_freq, results)
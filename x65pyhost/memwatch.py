@@ -0,0 +1,164 @@
+from cpumem import CpuMemMap
+from vera import VERA
+
+# Watched memory regions of the debugger panels (memory views, watches), refreshed together.
+# The regions of all the panels form one watch list; at each refresh they are translated to the physical
+# areas, the overlapping and near regions are merged, and everything is read in one ICD batch.
+# The values are compared to the previous refresh, so that the panels re-render just the changed bytes.
+# Areas of the regions:
+#   'cpu'  - 24-bit CPU address CBA:CA, by the present RAM/ROM-Block mapping (see CpuMemMap)
+#   'sram' - 2MB SRAM, physical address
+#   'io'   - IO registers $9F00-$9FFF, offset 0-255
+#   'vram' - VERA VRAM, 17-bit address; read just while the CPU is stopped
+AREAS = [ 'cpu', 'sram', 'io', 'vram' ]
+
+# IO registers with a side effect of the read (FIFOs, auto-incrementing data ports); they are never read.
+# The ICD reads one byte ahead at the end of each transaction, so the register just before
+# is read by a non-incrementing read.
+IO_READ_SENSITIVE = {
+    0x23, 0x24,             # VERA DATA0, DATA1
+    0x57, 0x5A,             # NORA USB_UART_DATA, UEXT_UART_DATA
+    0x60, 0x62,             # NORA PS2K_BUF, PS2M_BUF
+    0x65,                   # NORA N_SPI_DATA
+    0x83,                   # W6100 IDM_DR
+}
+
+# the regions closer than this are read in one burst
+MERGE_GAP = 32
+
+
+# Merge the intervals [(start, end)] closer than gap
+def _merge(ivals, gap):
+    res = []
+    for (a, b) in sorted(ivals):
+        if len(res) > 0 and a <= res[-1][1] + gap:
+            res[-1][1] = max(res[-1][1], b)
+        else:
+            res.append([a, b])
+    return res
+
+
+# Read the IO registers [a, b) around the sensitive ones; list of (offset, data or Deferred in the batch mode)
+def read_io(icd, a, b):
+    reads = []
+    k = a
+    while k < b:
+        if k in IO_READ_SENSITIVE:
+            k += 1
+            continue
+        e = k
+        while e < b and e not in IO_READ_SENSITIVE:
+            e += 1
+        if e in IO_READ_SENSITIVE:
+            # the read-ahead must not reach it
+            if e - 1 > k:
+                reads.append( (k, icd.ioregs_read(k, e - 1 - k)) )
+            reads.append( (e - 1, icd.ioregs_read_fifo(e - 1, 1)) )
+        else:
+            reads.append( (k, icd.ioregs_read(k, e - k)) )
+        k = e
+    return reads
+
+
+class WatchList:
+    def __init__(self):
+        # owner (e.g. a panel) -> list of regions (area, addr, n)
+        self.regions = {}
+        # owner -> list of values of the regions (bytes of int or None) from the last refresh
+        self.values = {}
+
+    # Set the regions of the owner; an empty list removes it
+    def set(self, owner, regions):
+        if len(regions) == 0:
+            self.regions.pop(owner, None)
+        else:
+            self.regions[owner] = list(regions)
+        self.values.pop(owner, None)
+
+    # Refresh all the regions.
+    # is_cpuruns: the CPU is running => VRAM is not read (the VERA address registers are shared with the CPU)
+    # Returns {owner: (values, changed)} of the owners with a change (all of them at the first refresh),
+    # where values is the list of the bytes (None where not read) and changed the set of the changed offsets.
+    def refresh(self, icd, is_cpuruns=False):
+        if len(self.regions) == 0:
+            return {}
+        areas = { r[0] for regs in self.regions.values() for r in regs }
+        read_vram = 'vram' in areas and not is_cpuruns
+        vera = VERA(icd)
+
+        # the mapping registers and the VERA port address, needed to set up the reads
+        with icd.batch():
+            mapregs = icd.ioregs_read(0x50, 4) if 'cpu' in areas else None
+            vaddr = vera.read_addr() if read_vram else None
+        mm = CpuMemMap(*mapregs.result()) if mapregs is not None else None
+
+        # the regions as lists of physical segments (area, phys, n)
+        segs = {}
+        for (owner, regs) in self.regions.items():
+            segs[owner] = []
+            for (area, addr, n) in regs:
+                if area == 'cpu':
+                    segs[owner].append([ (s.area, s.phys, s.length) for s in mm.segments(addr, n) ])
+                elif area != 'vram' or read_vram:
+                    segs[owner].append([ (area, addr, n) ])
+                else:
+                    segs[owner].append(None)
+
+        # merged intervals per physical area
+        ivals = {}
+        for sl in segs.values():
+            for seg in sl:
+                for (area, phys, n) in (seg or []):
+                    ivals.setdefault(area, []).append( (phys, phys + n) )
+
+        # all the reads in one batch: (area, start, Deferred)
+        reads = []
+        with icd.batch():
+            for (area, iv) in ivals.items():
+                for (a, b) in _merge(iv, 0 if area == CpuMemMap.AREA_IO else MERGE_GAP):
+                    if area == CpuMemMap.AREA_SRAM:
+                        reads.append( (area, a, icd.sram_blockread(a, b - a)) )
+                    elif area == CpuMemMap.AREA_IO:
+                        reads.extend( (area, k, d) for (k, d) in read_io(icd, a, min(b, 256)) )
+                    elif area == CpuMemMap.AREA_BANKREG:
+                        reads.append( (area, a, icd.bankregs_read(a, b - a)) )
+                    elif area == CpuMemMap.AREA_BOOTROM:
+                        reads.append( (area, a, icd.bootrom_blockread(a, b - a)) )
+                    else:
+                        # via the data port selected by the CPU program, then its address is restored
+                        reads.append( (area, a, vera.vram_read(a, b - a, port=vaddr.result()[3] & VERA.DC_ADDRSEL)) )
+            if read_vram:
+                icd.ioregs_write(VERA.ADDRx_L, vaddr.result()[0:3])
+
+        # the physical snapshot: area -> list of (start, data)
+        phys = {}
+        for (area, a, d) in reads:
+            phys.setdefault(area, []).append( (a, d.result()) )
+
+        def get(area, addr):
+            for (a, data) in phys.get(area, []):
+                if a <= addr < a + len(data):
+                    return data[addr - a]
+            return None
+
+        # compare the regions of each owner to the previous refresh
+        updates = {}
+        for (owner, regs) in self.regions.items():
+            old = self.values.get(owner)
+            vals = []
+            for ((area, addr, n), seg) in zip(regs, segs[owner]):
+                if seg is None:
+                    # not read now: keep the previous values
+                    k = len(vals)
+                    vals.extend(old[k:k+n] if old is not None else [None] * n)
+                    continue
+                for (parea, p, m) in seg:
+                    vals.extend( get(parea, p + i) for i in range(0, m) )
+            if old is None:
+                changed = set(range(0, len(vals)))
+            else:
+                changed = { i for i in range(0, len(vals)) if vals[i] != old[i] }
+            self.values[owner] = vals
+            if len(changed) > 0:
+                updates[owner] = (vals, changed)
+        return updates
@@ -0,0 +1,124 @@
+import time
+import random
+from collections import Counter
+from icd import ICD
+
+# Statistical PC-sampling profiler of the code running at full speed.
+# The CPU runs freely; at the sampling rate it is briefly stopped, sampled and resumed,
+# all in one ICD batch (one USB transfer in the packed mode of X65Ftdi):
+#   1. stop the CPU,
+#   2. sample the CPU state by cpu_read_trace(sample_cpu=True); this also clears the trace buffer,
+#   3. step a few cycles ("skid") and read their trace records, to find the start (SYNC) of the next
+#      instruction when the CPU was stopped in the middle of one; the completed cycles also carry
+#      a valid MAH, which tells the ROM/RAM blocks apart,
+#   4. run the CPU again.
+# The samples are counted in a histogram keyed by (area_name, CBA, CA), where the area name
+# comes from ICD.MAHDecoded.from_trace (e.g. "RomB:  4", "RAMB: 12", "low :  0", "PBL     ").
+class Profiler:
+    # icd: ICD object
+    # skid_steps: cycles stepped after each sample to reach an instruction start (max. instruction is 8 cycles);
+    #             0 => just the sampled cycle is used, non-SYNC samples are then not attributed.
+    def __init__(self, icd, skid_steps=8):
+        self.icd = icd
+        self.skid_steps = skid_steps
+        self.hist = Counter()
+        self.n_samples = 0
+        self.n_unattributed = 0
+        # overhead statistics: host time of the stop-sample-run transaction, in seconds
+        self.overhead_total = 0.0
+        self.overhead_max = 0.0
+        self.elapsed = 0.0
+
+    # Take one sample; the CPU should be running.
+    # Returns the histogram key, or None if the sample could not be attributed.
+    def sample(self):
+        icd = self.icd
+        t0 = time.perf_counter()
+        with icd.batch():
+            icd.cpu_ctrl(False, False, False)
+            reads = [ icd.cpu_read_trace(tbr_clear=True, sample_cpu=True) ]
+            for k in range(0, self.skid_steps):
+                icd.cpu_ctrl(False, True, False)
+                reads.append(icd.cpu_read_trace())
+            icd.cpu_ctrl(True, False, False)
+        dt = time.perf_counter() - t0
+        self.overhead_total += dt
+        self.overhead_max = max(self.overhead_max, dt)
+        self.n_samples += 1
+
+        # the first SYNC: in the sampled (upcoming) cycle, or in one of the completed skid cycles
+        key = None
+        for i, rd in enumerate(reads):
+            is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = rd.result()
+            tbuf = ICD.TraceReg(rawbuf)
+            if i > 0 and not is_valid:
+                continue
+            if tbuf.is_sync:
+                # MAH of the upcoming cycle is stale, the skid cycle that completes it follows right after
+                if i == 0 and len(reads) > 1:
+                    continue
+                mahd = ICD.MAHDecoded.from_trace(tbuf.MAH, tbuf.CBA, tbuf.CA)
+                key = (mahd.area_name, tbuf.CBA, tbuf.CA)
+                break
+        if key is None:
+            self.n_unattributed += 1
+        else:
+            self.hist[key] += 1
+        return key
+
+    # Run the profiler.
+    # duration: seconds of profiling
+    # rate: samples per second (the intervals are randomized by +-50% to avoid aliasing with periodic code)
+    # progress: optional function(n_samples, elapsed_seconds), called about once per second
+    def run(self, duration, rate=100, progress=None):
+        self.icd.cpu_ctrl(True, False, False)
+        t0 = time.monotonic()
+        t_prog = t0
+        while True:
+            now = time.monotonic()
+            if now - t0 >= duration:
+                break
+            time.sleep(random.uniform(0.5, 1.5) / rate)
+            self.sample()
+            if progress is not None and now - t_prog >= 1.0:
+                progress(self.n_samples, now - t0)
+                t_prog = now
+        self.elapsed = time.monotonic() - t0
+
+    # Mean overhead per sample in seconds, i.e. the time the CPU is held stopped by one sample.
+    def overhead_mean(self):
+        return self.overhead_total / self.n_samples if self.n_samples > 0 else 0.0
+
+    # Fraction of the wall time the CPU was stopped by the sampling.
+    def overhead_duty(self):
+        return self.overhead_total / self.elapsed if self.elapsed > 0 else 0.0
+
+    # Format the histogram key
+    @staticmethod
+    def key_name(key):
+        (area, CBA, CA) = key
+        return "{} ${:02X}:{:04X}".format(area, CBA, CA)
+
+    # Flat profile: list of (key, count), the most frequent first.
+    def flat_profile(self):
+        return self.hist.most_common()
+
+    # Write the flat profile as text.
+    # top: only the top entries; None => all
+    def write_flat(self, f, top=None):
+        total = sum(self.hist.values())
+        f.write("# samples: {}, attributed: {}, unattributed: {}\n".format(self.n_samples, total, self.n_unattributed))
+        f.write("# overhead per sample: mean {:.3f} ms, max {:.3f} ms, CPU stopped {:.2f}% of the time\n".format(
+                    self.overhead_mean() * 1E3, self.overhead_max * 1E3, self.overhead_duty() * 100))
+        f.write("#   count      %   cum-%   address\n")
+        cum = 0
+        for (key, cnt) in self.flat_profile()[0:top]:
+            cum += cnt
+            f.write("{:9} {:6.2f} {:7.2f}   {}\n".format(cnt, cnt * 100.0 / total, cum * 100.0 / total, Profiler.key_name(key)))
+
+    # Write the profile in the collapsed-stack format ("frame;frame count" lines) for flame-graph tools.
+    # There is no call stack in a PC sample, so the frames are just the memory area and the address;
+    # the area (RAM/ROM-Block) groups the addresses in the flame graph.
+    def write_collapsed(self, f):
+        for ((area, CBA, CA), cnt) in sorted(self.hist.items()):
+            f.write("{};${:02X}:{:04X} {}\n".format(area.replace(' ', ''), CBA, CA, cnt))
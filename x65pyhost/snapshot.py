@@ -0,0 +1,196 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+from icd import ICD
+from cpuregs import CpuRegs
+from vera import VERA
+from memwatch import read_io
+
+# Snapshot of the machine state (*.x65s): the 2MB SRAM, the PBL bootrom, the IO page, the bank registers,
+# the CPU registers, and optionally the VERA VRAM and registers; captured and restored while the CPU is stopped.
+#
+# Layout:
+#   header:   magic 'X65SNAP ', u16 version, u32 length of the metadata
+#   metadata: JSON object (CPU type, registers, SHA-1 of each 8kB SRAM block, the stored blocks,
+#             the base snapshot, the list of the sections with their raw and compressed sizes)
+#   sections: zlib-compressed data, in the order of the metadata: 'sram' (the stored blocks one after another),
+#             'bootrom', 'io', 'vram'
+#
+# An incremental snapshot stores just the SRAM blocks whose hash differs from its base snapshot
+# (a file name relative to the snapshot); the rest is taken from the base (and its bases) on load.
+# The SRAM is always transferred whole, in one ICD batch of the maximal bursts.
+#
+# Restore writes all the memory areas, the bank registers, the mapping registers $9F50-$9F53, VERA and
+# the CPU registers. The other IO registers are saved for the inspection only: they belong to the peripherals
+# (timers, UARTs, SPI, PS/2), where the writes have side effects and do not bring back the state.
+
+MAGIC = b'X65SNAP '
+VERSION = 1
+HDR_FMT = '<8sHI'
+ZLIB_LEVEL = 6
+
+SRAM_BLOCKS = ICD.SIZE_2MB // ICD.BLOCKSIZE
+BOOTROM_SIZE = 512
+VRAM_SIZE = 0x20000
+MAPREGS = 0x50              # RamBLOCK_AB, ROMBLOCK/RamBLOCK_CD, RamBMASK, RMBCTRL
+REGS_KEYS = ('AH', 'AL', 'XH', 'XL', 'YH', 'YL', 'SP', 'FL', 'EMU', 'DBR', 'DPR', 'PC')
+
+
+# SHA-1 of the 8kB blocks of the SRAM image
+def block_hashes(sram):
+    return [ hashlib.sha1(sram[b * ICD.BLOCKSIZE:(b + 1) * ICD.BLOCKSIZE]).hexdigest() for b in range(0, SRAM_BLOCKS) ]
+
+
+class Snapshot:
+    def __init__(self):
+        self.is_cputype02 = False
+        self.regs = None            # CpuRegs
+        self.bankregs = None        # bytes of $00, $01
+        self.sram = None            # bytearray of 2MB
+        self.bootrom = None         # bytes
+        self.io = None              # bytes of the IO page $9F00-$9FFF; the registers not read are 0
+        self.io_unread = []         # offsets of the IO registers not read (side effects of the read)
+        self.vera = None            # VERA.read_state() or None
+        self.vram = None            # bytes of 128kB or None
+        self.hashes = None          # block_hashes(self.sram)
+
+    # Capture the state of the stopped CPU.
+    # with_vera: VERA VRAM and registers as well
+    # Returns Snapshot, or None on an error.
+    @classmethod
+    def capture(cls, icd, with_vera=False):
+        snap = cls()
+        snap.is_cputype02 = icd.is_cputype02()
+        snap.regs = CpuRegs()
+        if not snap.regs.cpu_read_regs(icd):
+            print("ERROR: could not read the CPU registers; is the CPU stopped?")
+            return None
+        snap.sram = bytearray(ICD.SIZE_2MB)
+        with icd.batch():
+            icd.sram_readinto(0, snap.sram)
+            bootrom = icd.bootrom_blockread(0, BOOTROM_SIZE)
+            bankregs = icd.bankregs_read(0, 2)
+            io = read_io(icd, 0, 256)
+        snap.bootrom = bytes(bootrom.result())
+        snap.bankregs = bytes(bankregs.result())
+        iopage = bytearray(256)
+        read = set()
+        for (k, d) in io:
+            data = d.result()
+            iopage[k:k+len(data)] = data
+            read.update(range(k, k + len(data)))
+        snap.io = bytes(iopage)
+        snap.io_unread = sorted(set(range(0, 256)) - read)
+        if with_vera:
+            vera = VERA(icd)
+            snap.vera = vera.read_state()
+            sel = snap.vera['ctrl'] & VERA.DC_ADDRSEL
+            snap.vram = bytes(vera.vram_read(0, VRAM_SIZE, port=sel))
+            # the address of the port used for the read
+            icd.ioregs_write(VERA.ADDRx_L, snap.vera['addr'][sel])
+        snap.hashes = block_hashes(snap.sram)
+        return snap
+
+    # Restore the state into the stopped CPU.
+    # Returns True on success.
+    def restore(self, icd):
+        with icd.batch():
+            icd.sram_blockwrite(0, self.sram)
+            icd.bootrom_blockwrite(0, self.bootrom)
+            icd.bankregs_write(0, self.bankregs)
+            icd.ioregs_write(MAPREGS, self.io[MAPREGS:MAPREGS+4])
+        if self.vera is not None:
+            vera = VERA(icd)
+            # vram_write uses the data port 0
+            icd.ioregs_write(VERA.CTRL, [ self.vera['ctrl'] & ~VERA.DC_ADDRSEL & 0x7F ])
+            vera.vram_write(0, self.vram)
+            vera.write_state(self.vera)
+        regs = CpuRegs()
+        if not regs.cpu_write_regs(icd, self.regs):
+            print("ERROR: could not write the CPU registers; is the CPU stopped?")
+            return False
+        return True
+
+    # Save the snapshot into the file.
+    # base: optional file name of the base snapshot => just the SRAM blocks changed against it are stored
+    def save(self, fname, base=None):
+        md = { 'cpu': '65C02' if self.is_cputype02 else '65C816',
+               'regs': { k: getattr(self.regs, k) for k in REGS_KEYS },
+               'bankregs': list(self.bankregs), 'io_unread': self.io_unread,
+               'vera': self.vera, 'hashes': self.hashes }
+        blocks = list(range(0, SRAM_BLOCKS))
+        if base is not None:
+            bmd = Snapshot._read_header(base)[0]
+            blocks = [ b for b in blocks if self.hashes[b] != bmd['hashes'][b] ]
+            md['base'] = os.path.relpath(base, os.path.dirname(os.path.abspath(fname)))
+            md['base_hashes'] = hashlib.sha1(''.join(bmd['hashes']).encode()).hexdigest()
+        md['blocks'] = blocks
+
+        sram = b''.join(self.sram[b * ICD.BLOCKSIZE:(b + 1) * ICD.BLOCKSIZE] for b in blocks)
+        sections = [ ('sram', sram), ('bootrom', self.bootrom), ('io', self.io) ]
+        if self.vram is not None:
+            sections.append( ('vram', self.vram) )
+        zdata = [ zlib.compress(data, ZLIB_LEVEL) for (name, data) in sections ]
+        md['sections'] = [ [ name, len(data), len(z) ] for ((name, data), z) in zip(sections, zdata) ]
+
+        mdbytes = json.dumps(md).encode()
+        with open(fname, 'wb') as f:
+            f.write(struct.pack(HDR_FMT, MAGIC, VERSION, len(mdbytes)))
+            f.write(mdbytes)
+            for z in zdata:
+                f.write(z)
+
+    # Read the header of the file; returns (metadata, offset of the sections)
+    @staticmethod
+    def _read_header(fname):
+        with open(fname, 'rb') as f:
+            hdr = f.read(struct.calcsize(HDR_FMT))
+            (magic, version, mdlen) = struct.unpack(HDR_FMT, hdr)
+            if magic != MAGIC:
+                raise ValueError("{}: not an X65 snapshot".format(fname))
+            if version != VERSION:
+                raise ValueError("{}: unsupported snapshot version {}".format(fname, version))
+            md = json.loads(f.read(mdlen))
+        return (md, len(hdr) + mdlen)
+
+    # Load the snapshot from the file; an incremental one is completed from its base snapshots.
+    @classmethod
+    def load(cls, fname):
+        (md, offs) = cls._read_header(fname)
+        sections = {}
+        with open(fname, 'rb') as f:
+            f.seek(offs)
+            for (name, size, zsize) in md['sections']:
+                sections[name] = zlib.decompress(f.read(zsize))
+                if len(sections[name]) != size:
+                    raise ValueError("{}: corrupted section {}".format(fname, name))
+
+        snap = cls()
+        snap.is_cputype02 = md['cpu'] == '65C02'
+        snap.regs = CpuRegs()
+        for (k, v) in md['regs'].items():
+            setattr(snap.regs, k, v)
+        snap.bankregs = bytes(md['bankregs'])
+        snap.bootrom = sections['bootrom']
+        snap.io = sections['io']
+        snap.io_unread = md['io_unread']
+        snap.vera = md['vera']
+        snap.vram = sections.get('vram')
+        snap.hashes = md['hashes']
+
+        if 'base' in md:
+            base = os.path.join(os.path.dirname(os.path.abspath(fname)), md['base'])
+            bsnap = cls.load(base)
+            if hashlib.sha1(''.join(bsnap.hashes).encode()).hexdigest() != md['base_hashes']:
+                raise ValueError("{}: the base snapshot {} has changed".format(fname, base))
+            snap.sram = bsnap.sram
+        else:
+            snap.sram = bytearray(ICD.SIZE_2MB)
+        data = sections['sram']
+        for (i, b) in enumerate(md['blocks']):
+            snap.sram[b * ICD.BLOCKSIZE:(b + 1) * ICD.BLOCKSIZE] = data[i * ICD.BLOCKSIZE:(i + 1) * ICD.BLOCKSIZE]
+        if block_hashes(snap.sram) != snap.hashes:
+            raise ValueError("{}: the SRAM does not match the stored hashes".format(fname))
+        return snap
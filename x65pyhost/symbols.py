@@ -0,0 +1,298 @@
+import bisect
+import struct
+import numpy as np
+from icd import ICD
+
+# Symbol tables for the trace and disassembly annotation.
+# Symbols are loaded from:
+#   - ELF executables of llvm-mos (*.elf, produced next to the .rom/.prg in testsw/*-c-llvmmos),
+#   - linker map files of lld (mos-*-clang -Wl,-Map=file.map),
+#   - label files of ca65/ld65 (ld65 -Ln file.lbl) or VICE: "al 00C000 .name".
+# The same CPU address is shared by many RAM/ROM-Blocks, so each symbol belongs to a memory area,
+# named as in ICD.MAHDecoded.from_trace ("RomB:  0", "RAMB: 12", "PBL     ", ...), or to any area (None).
+# The symbols of one area are kept in a sorted interval index: a lookup is a binary search,
+# and whole arrays of trace addresses are resolved at once by np.searchsorted.
+
+
+# Normalize the area name (as given by the user, or ICD.MAHDecoded.area_name) to the index key:
+# spaces removed, all the fix-mapped low-memory blocks are just "low", and the RAM-Blocks 192-255,
+# which are the same SRAM as the ROM-Blocks (MAH 64-127, e.g. a ROM-Block seen at $C000-$DFFF),
+# are named as the ROM-Block.
+def area_key(area):
+    if area is None:
+        return None
+    s = area.replace(' ', '')
+    if s.startswith('low:') or s == 'low':
+        return 'low'
+    if s.startswith('RAMB:'):
+        n = int(s[5:])
+        if 192 <= n < 256:
+            return "RomB:{}".format((n - 192) // 2)
+    return s
+
+
+# Is the 24-bit CPU address in the window where the area (index key) is mapped?
+def _in_area_window(k, addr):
+    (CBA, CA) = (addr >> 16, addr & 0xFFFF)
+    if k.startswith('RomB') or k == 'PBL':
+        return CBA == 0 and CA >= 0xC000
+    if k.startswith('RAMB'):
+        return CBA != 0 or 0xA000 <= CA < 0xE000
+    if k == 'low':
+        return CBA == 0 and CA < 0x9F00
+    return True
+
+
+# Interval index of the symbols of one area
+class _AreaIndex:
+    # syms: list of (address, size, symbol id), unsorted
+    def __init__(self, syms):
+        self.syms = syms
+        # by address, the sized symbols first, then the order of loading
+        syms = sorted(syms, key=lambda s: (s[0], -s[1], s[2]))
+        # just one symbol per address
+        uniq = []
+        for s in syms:
+            if len(uniq) == 0 or uniq[-1][0] != s[0]:
+                uniq.append(s)
+        self.starts = [ s[0] for s in uniq ]
+        # the symbol without a size (a label) spans up to the next symbol, but not over the end of its 8kB block
+        # (the unit of the memory mapping); a label in the zero page is just a variable of one byte
+        self.ends = [ s[0] + s[1] if s[1] > 0
+                        else s[0] + 1 if (s[0] & 0xFFFF) < 0x100
+                        else min(self.starts[i+1] if i+1 < len(uniq) else 1 << 24, (s[0] | 0x1FFF) + 1)
+                      for (i, s) in enumerate(uniq) ]
+        self.ids = [ s[2] for s in uniq ]
+        self.np_starts = np.array(self.starts, dtype=np.int64)
+        self.np_ends = np.array(self.ends, dtype=np.int64)
+        self.np_ids = np.array(self.ids, dtype=np.int32)
+
+    # Returns (symbol id, offset), or None
+    def lookup(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or addr >= self.ends[i]:
+            return None
+        return (self.ids[i], addr - self.starts[i])
+
+    # Vectorized lookup; returns (symbol ids, offsets) with the id -1 where no symbol covers the address
+    def lookup_array(self, addrs):
+        i = np.searchsorted(self.np_starts, addrs, side='right') - 1
+        ic = np.maximum(i, 0)
+        ok = (i >= 0) & (addrs < self.np_ends[ic])
+        ids = np.where(ok, self.np_ids[ic], -1).astype(np.int32)
+        offs = np.where(ok, addrs - self.np_starts[ic], 0)
+        return (ids, offs)
+
+
+class SymbolTable:
+    def __init__(self):
+        self.names = []             # symbol id -> name
+        self.pending = {}           # area key -> list of (address, size, symbol id); merged into the index on lookup
+        self.index = {}             # area key -> _AreaIndex
+
+    def __len__(self):
+        return len(self.names)
+
+    # Add one symbol.
+    # addr: 24-bit CPU address CBA:CA
+    # size: in bytes, 0 if not known
+    # area: memory area name (see area_key), None => any area.
+    #       The symbols out of the CPU window of the area (e.g. the RAM variables of a ROM image) are in any area.
+    def add(self, name, addr, size=0, area=None):
+        addr &= 0xFFFFFF
+        k = area_key(area)
+        if k is not None and not _in_area_window(k, addr):
+            k = None
+        self.pending.setdefault(k, []).append((addr, size, len(self.names)))
+        self.names.append(name)
+
+    def _build(self):
+        for (k, syms) in self.pending.items():
+            if k in self.index:
+                # merge with the already indexed symbols
+                syms = self.index[k].syms + syms
+            self.index[k] = _AreaIndex(syms)
+        self.pending = {}
+
+    # Load the symbols from the file, the format is detected from the contents.
+    # area: memory area the code/data is loaded to (e.g. "RomB:0" for a ROM image in ROMBLOCK 0), None => any.
+    # Returns the number of symbols loaded.
+    def load(self, fname, area=None):
+        with open(fname, 'rb') as f:
+            head = f.read(4)
+        if head == b'\x7fELF':
+            return self.load_elf(fname, area)
+        with open(fname, 'r', errors='replace') as f:
+            text = f.read()
+        for line in text.splitlines():
+            if line.strip() == '':
+                continue
+            if line.split()[0] == 'al':
+                return self.load_labels(fname, area)
+            if 'VMA' in line and 'Symbol' in line:
+                return self.load_map(fname, area)
+        raise ValueError("{}: unknown symbol file format".format(fname))
+
+    # Load the symbol table of an ELF32 executable (llvm-mos)
+    def load_elf(self, fname, area=None):
+        with open(fname, 'rb') as f:
+            data = f.read()
+        if data[0:4] != b'\x7fELF' or data[4] != 1 or data[5] != 1:
+            raise ValueError("{}: not a 32-bit little-endian ELF file".format(fname))
+        (e_shoff,) = struct.unpack_from('<I', data, 0x20)
+        (e_shentsize, e_shnum) = struct.unpack_from('<HH', data, 0x2E)
+        shdrs = [ struct.unpack_from('<IIIIIIIIII', data, e_shoff + i * e_shentsize) for i in range(0, e_shnum) ]
+        n = 0
+        for (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_align, sh_entsize) in shdrs:
+            if sh_type != 2:            # SHT_SYMTAB
+                continue
+            stroff = shdrs[sh_link][4]
+            for off in range(sh_offset, sh_offset + sh_size, sh_entsize):
+                (st_name, st_value, st_size, st_info, st_other, st_shndx) = struct.unpack_from('<IIIBBH', data, off)
+                # just the defined functions, objects and plain labels; not sections, files, local temporaries
+                if (st_info & 0x0F) not in (0, 1, 2) or st_shndx == 0 or st_name == 0:
+                    continue
+                name = data[stroff + st_name:data.index(b'\0', stroff + st_name)].decode(errors='replace')
+                if name.startswith('.L') or name.startswith('$'):
+                    continue
+                # absolute symbols (e.g. the zero-page registers __rc0...) are not a part of the loaded image
+                self.add(name, st_value, st_size, None if st_shndx == 0xFFF1 else area)
+                n += 1
+        return n
+
+    # Load the symbols from an lld map file:
+    #      VMA      LMA     Size Align Out     In      Symbol
+    #     c000     c000      1a5     1 .text
+    #     c000     c000       22     1         hello.o:(.text.main)
+    #     c000     c000        0     1                 main
+    #        2        2        0     1 __rc0 = 0x2
+    def load_map(self, fname, area=None):
+        n = 0
+        symcol = None
+        with open(fname, 'r', errors='replace') as f:
+            for line in f:
+                line = line.rstrip()
+                if symcol is None:
+                    if 'VMA' in line and 'Symbol' in line:
+                        symcol = line.index('Symbol')
+                    continue
+                toks = line.split(None, 4)
+                if len(toks) < 5:
+                    continue
+                try:
+                    # the LMA column is not used, just checked to skip the non-symbol lines
+                    int(toks[1], 16)
+                    (vma, size) = (int(toks[0], 16), int(toks[2], 16))
+                except ValueError:
+                    continue
+                rest = toks[4]
+                sym_area = area
+                if ' = ' in rest:
+                    # symbol assignment, absolute
+                    name = rest.split(' = ')[0].strip()
+                    sym_area = None
+                elif len(line) > symcol and line[symcol] != ' ' and line[symcol-1] == ' ' and line[:symcol].split() == toks[0:4]:
+                    name = line[symcol:].strip()
+                else:
+                    continue
+                if name == '.' or name.startswith('.L'):
+                    continue
+                self.add(name, vma, size, sym_area)
+                n += 1
+        return n
+
+    # Load a ca65/ld65 (-Ln) or VICE label file: "al 00C000 .name" or "al C:c000 .name"
+    def load_labels(self, fname, area=None):
+        n = 0
+        with open(fname, 'r', errors='replace') as f:
+            for line in f:
+                toks = line.split()
+                if len(toks) < 3 or toks[0] != 'al':
+                    continue
+                try:
+                    addr = int(toks[1].split(':')[-1], 16)
+                except ValueError:
+                    continue
+                self.add(toks[2].lstrip('.'), addr, 0, area)
+                n += 1
+        return n
+
+    # Find the symbol covering the 24-bit CPU address.
+    # area: the memory area of the address (any spelling of the area name), None => not known.
+    # The symbols of the area are searched first, then those of any area; for an unknown area
+    # also all the other areas.
+    # Returns (name, offset), or None.
+    def lookup(self, addr, area=None):
+        if len(self.pending) > 0:
+            self._build()
+        k = area_key(area)
+        order = [ k, None ] if k is not None else [ None ] + [ a for a in self.index if a is not None ]
+        for a in order:
+            ix = self.index.get(a)
+            if ix is None:
+                continue
+            r = ix.lookup(addr)
+            if r is not None:
+                return (self.names[r[0]], r[1])
+        return None
+
+    # Find the symbol by its name; the first one if there are more of the same name.
+    # Returns (addr, size), or None.
+    def find(self, name):
+        if len(self.pending) > 0:
+            self._build()
+        for ix in self.index.values():
+            for (addr, size, i) in ix.syms:
+                if self.names[i] == name:
+                    return (addr, size)
+        return None
+
+    # Format the address as "name" or "name+$off"; None if there is no symbol.
+    # exact: only the symbol right at the address (no offset)
+    def format_addr(self, addr, area=None, exact=False):
+        r = self.lookup(addr, area)
+        if r is None or (exact and r[1] != 0):
+            return None
+        return r[0] if r[1] == 0 else "{}+${:x}".format(r[0], r[1])
+
+    # Vectorized lookup of trace records, e.g. a TraceArray: ta.MAH, ta.CBA, ta.CA.
+    # The memory area of each record is decoded from MAH, CBA and CA as in ICD.MAHDecoded.from_trace.
+    # Returns (symbol ids, offsets): NumPy arrays, the id indexes self.names, -1 => no symbol.
+    def lookup_trace(self, MAH, CBA, CA):
+        if len(self.pending) > 0:
+            self._build()
+        MAH = np.asarray(MAH).astype(np.int64)
+        CBA = np.asarray(CBA).astype(np.int64)
+        CA = np.asarray(CA).astype(np.int64)
+        addrs = (CBA << 16) | CA
+        ids = np.full(len(addrs), -1, dtype=np.int32)
+        offs = np.zeros(len(addrs), dtype=np.int64)
+        # class of the address decoding (see MAHDecoded.from_trace): 0 = by MAH only, 1 = low memory, 2 = ROM/PBL
+        cls = np.where(CBA != 0, 0, np.where(CA < 0x9F00, 1, np.where(CA >= 0xE000, 2, 0)))
+        group = MAH | (cls << 8)
+        for g in np.unique(group).tolist():
+            (rCBA, rCA) = [ (1, 0), (0, 0), (0, 0xE000) ][g >> 8]
+            k = area_key(ICD.MAHDecoded.from_trace(g & 0xFF, rCBA, rCA).area_name)
+            sel = np.flatnonzero(group == g)
+            for a in (k, None):
+                ix = self.index.get(a)
+                if ix is None:
+                    continue
+                todo = sel[ids[sel] < 0]
+                (i, o) = ix.lookup_array(addrs[todo])
+                ids[todo] = i
+                offs[todo] = o
+        return (ids, offs)
+
+
+# Create a symbol table from the command-line specifications "FILE" or "FILE@AREA" (e.g. "hello.rom.elf@RomB:0").
+# Returns None if there are no files.
+def load_symbol_files(specs):
+    if specs is None or len(specs) == 0:
+        return None
+    syms = SymbolTable()
+    for spec in specs:
+        (fname, area) = spec.rsplit('@', 1) if '@' in spec else (spec, None)
+        n = syms.load(fname, area)
+        print("Loaded {} symbols from {}{}".format(n, fname, " (area {})".format(area) if area is not None else ""))
+    return syms
@@ -0,0 +1,32 @@
+import unittest
+import numpy as np
+from tracearr import TraceRing, TRACE_DTYPE
+
+# Tests of TraceRing: the windows by the absolute cycle numbers agree with array() after wrapping appends.
+# Run: python3 -m unittest test_tracearr
+
+
+# Raw records of the cycles lo..hi-1, each tagged by its number in CA
+def make_recs(lo, hi):
+    a = np.zeros(hi - lo, dtype=TRACE_DTYPE)
+    a['CA'] = np.arange(lo, hi) & 0xFFFF
+    return a.tobytes()
+
+
+class TestTraceRing(unittest.TestCase):
+    def test_wrapping_appends(self):
+        for cap in (1, 3, 4, 7, 256):
+            ring = TraceRing(cap)
+            n = 0
+            # appends shorter, equal and longer than the capacity, also wrapping the ring at once
+            for m in [ 2, cap + 3, 1, cap, 0, cap - 1, 2 * cap + 5, 1, 1 ] * 3:
+                ring.append(make_recs(n, n + m))
+                n += m
+                expect = [ i & 0xFFFF for i in range(ring.first, n) ]
+                self.assertEqual(ring.array().array()['CA'].tolist(), expect)
+                self.assertEqual(ring.cycles(ring.first, n).array()['CA'].tolist(), expect)
+                self.assertEqual([ ring.cycle(i).CA for i in range(ring.first, n) ], expect)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+from struct import pack as spack
+from pyftdi.ftdi import Ftdi
+from x65ftdi import X65Ftdi
+
+# Tests of the ICD link transactions in X65Ftdi against a recording fake of the pyftdi SpiController:
+# the packed mode builds the MPSSE command buffer itself, the legacy mode goes through the gpio and SPI port.
+# Run: python3 -m unittest test_x65ftdi
+
+
+# Records all the calls into one shared log of (name, args...) tuples
+class FakeFtdi:
+    def __init__(self, log):
+        self.log = log
+        self.rdpos = 0
+
+    def set_frequency(self, freq):
+        return freq
+
+    def write_data(self, data):
+        self.log.append( ('write_data', bytes(data)) )
+
+    # the received bytes are a running counter, so the order of the responses can be checked
+    def read_data_bytes(self, size, attempt=1):
+        self.log.append( ('read_data_bytes', size) )
+        data = bytearray((self.rdpos + i) & 0xFF for i in range(0, size))
+        self.rdpos += size
+        return data
+
+
+class FakeGpio:
+    def __init__(self, log):
+        self.log = log
+
+    def set_direction(self, pins, direction):
+        self.log.append( ('gpio.set_direction', pins, direction) )
+
+    def write(self, value):
+        self.log.append( ('gpio.write', value) )
+
+    def read(self):
+        return 0
+
+
+class FakePort:
+    def __init__(self, log, freq):
+        self.log = log
+        self.frequency = freq
+
+    def set_frequency(self, freq):
+        self.frequency = freq
+
+    def exchange(self, out, readlen, start=True, stop=True, duplex=False):
+        self.log.append( ('port.exchange', bytes(out), readlen) )
+        return bytearray(readlen)
+
+    def write(self, out, start=True, stop=True):
+        self.log.append( ('port.write', bytes(out)) )
+
+
+class FakeSpiController:
+    # SCK, MOSI, /CS as outputs, plus ICD2NORAROM and ICDCSN
+    direction = 0x000B | X65Ftdi.PIN_ICD2NORAROM | X65Ftdi.PIN_ICDCSN
+
+    def __init__(self):
+        self.log = []
+        self.ftdi = FakeFtdi(self.log)
+
+    def configure(self, url):
+        pass
+
+    def get_port(self, cs, freq, mode):
+        return FakePort(self.log, freq)
+
+    def get_gpio(self):
+        return FakeGpio(self.log)
+
+
+DIR_HIGH = (FakeSpiController.direction >> 8) & 0xFF
+CS_SELECT = bytes([ Ftdi.SET_BITS_HIGH, 0x00, DIR_HIGH ])
+CS_DESELECT = bytes([ Ftdi.SET_BITS_HIGH, X65Ftdi.PIN_ICDCSN >> 8, DIR_HIGH ])
+
+
+def open_fake(packed):
+    spi = FakeSpiController()
+    com = X65Ftdi(url=None, packed=packed)
+    com.openFtdi('ftdi://fake/1', spi=spi, freq=1E6)
+    del spi.log[:]
+    return (com, spi.log)
+
+
+class TestPacked(unittest.TestCase):
+    def test_exchange_and_writeonly(self):
+        (com, log) = open_fake(True)
+        rxs = com.icd_transfer_many([ (b'\x01\x02', 3), (b'\x03\x04', 0) ])
+        # the exchange is padded with zeros to the read length
+        cmd = (CS_SELECT + spack('<BH', Ftdi.RW_BYTES_PVE_NVE_MSB, 3 - 1) + b'\x01\x02\x00' + CS_DESELECT
+               + CS_SELECT + spack('<BH', Ftdi.WRITE_BYTES_NVE_MSB, 2 - 1) + b'\x03\x04' + CS_DESELECT
+               + bytes([ Ftdi.SEND_IMMEDIATE ]))
+        self.assertEqual(log, [ ('write_data', cmd), ('read_data_bytes', 3) ])
+        self.assertEqual(rxs, [ bytearray(b'\x00\x01\x02'), None ])
+
+    def test_writeonly(self):
+        (com, log) = open_fake(True)
+        self.assertIsNone(com.icd_transfer(b'\x05', 0))
+        # nothing to read back => no SEND_IMMEDIATE and no read
+        cmd = CS_SELECT + spack('<BH', Ftdi.WRITE_BYTES_NVE_MSB, 0) + b'\x05' + CS_DESELECT
+        self.assertEqual(log, [ ('write_data', cmd) ])
+
+    def test_split_at_packed_max_read(self):
+        (com, log) = open_fake(True)
+        n = X65Ftdi.PACKED_MAX_READ + 10
+        out = bytes(i & 0xFF for i in range(0, n))
+        rx = com.icd_transfer(out, n)
+        # the ICD stays selected across the split
+        cmd1 = (CS_SELECT + spack('<BH', Ftdi.RW_BYTES_PVE_NVE_MSB, X65Ftdi.PACKED_MAX_READ - 1)
+                + out[0:X65Ftdi.PACKED_MAX_READ] + bytes([ Ftdi.SEND_IMMEDIATE ]))
+        cmd2 = (spack('<BH', Ftdi.RW_BYTES_PVE_NVE_MSB, 10 - 1) + out[X65Ftdi.PACKED_MAX_READ:]
+                + CS_DESELECT + bytes([ Ftdi.SEND_IMMEDIATE ]))
+        self.assertEqual(log, [ ('write_data', cmd1), ('read_data_bytes', X65Ftdi.PACKED_MAX_READ),
+                                ('write_data', cmd2), ('read_data_bytes', 10) ])
+        self.assertEqual(rx, bytearray(i & 0xFF for i in range(0, n)))
+
+
+class TestLegacy(unittest.TestCase):
+    def test_gpio_and_port(self):
+        (com, log) = open_fake(False)
+        rxs = com.icd_transfer_many([ (b'\x01\x02', 3), (b'\x03\x04', 0) ])
+        self.assertEqual(log, [ ('gpio.write', 0), ('port.exchange', b'\x01\x02', 3), ('gpio.write', X65Ftdi.PIN_ICDCSN),
+                                ('gpio.write', 0), ('port.write', b'\x03\x04'), ('gpio.write', X65Ftdi.PIN_ICDCSN) ])
+        self.assertEqual(rxs, [ bytearray(3), None ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+import numpy as np
+from icd import ICD
+
+# Compact store of long CPU traces.
+# The records are kept in a NumPy structured array with the same 7-byte layout as the trace register
+# (see ICD.cpu_read_trace and ICD.drain_tracebuffer), so a million cycles take about 7 MB,
+# and the trace flags are extracted as boolean masks over the whole array at once.
+# Single records are accessed through TraceView, a light-weight replacement of ICD.TraceReg.
+
+# One trace record: [sta, ctr, CD, CA_lo, CA_hi, MAH, CBA]
+TRACE_DTYPE = np.dtype([ ('sta', 'u1'), ('ctr', 'u1'), ('CD', 'u1'), ('CA', '<u2'), ('MAH', 'u1'), ('CBA', 'u1') ])
+
+
+# One trace record, with the same attributes as ICD.TraceReg, but the flags are computed on access.
+class TraceView:
+    __slots__ = ('sta_flags', 'ctr_flags', 'CD', 'CA', 'MAH', 'CBA')
+
+    def __init__(self, sta_flags, ctr_flags, CD, CA, MAH, CBA):
+        self.sta_flags = sta_flags
+        self.ctr_flags = ctr_flags
+        self.CD = CD
+        self.CA = CA
+        self.MAH = MAH
+        self.CBA = CBA
+
+    # Create from the raw 7-byte record
+    @classmethod
+    def from_raw(cls, rawbuf):
+        return cls(rawbuf[0], rawbuf[1], rawbuf[2], rawbuf[4] * 256 + rawbuf[3], rawbuf[5], rawbuf[6])
+
+    # Return the raw 7-byte record
+    def raw(self):
+        return bytes([ self.sta_flags, self.ctr_flags, self.CD, self.CA & 0xFF, self.CA >> 8, self.MAH, self.CBA ])
+
+    @property
+    def tr_flag(self):
+        return self.sta_flags + (self.ctr_flags << 8)
+
+    def _flag(self, f):
+        return (self.tr_flag & f) == f
+
+    is_sync = property(lambda self: self._flag(ICD.TRACE_FLAG_ISYNC))
+    is_resetn = property(lambda self: self._flag(ICD.TRACE_FLAG_RESETN))
+    is_irqn = property(lambda self: self._flag(ICD.TRACE_FLAG_IRQN))
+    is_nmin = property(lambda self: self._flag(ICD.TRACE_FLAG_NMIN))
+    is_abortn = property(lambda self: self._flag(ICD.TRACE_FLAG_ABORTN))
+    is_read_nwrite = property(lambda self: self._flag(ICD.TRACE_FLAG_RWN))
+    is_emu8 = property(lambda self: self._flag(ICD.TRACE_FLAG_EF))
+    is_nat16 = property(lambda self: not self._flag(ICD.TRACE_FLAG_EF))
+    is_vda = property(lambda self: self._flag(ICD.TRACE_FLAG_VDA))
+    is_vectpull = property(lambda self: self._flag(ICD.TRACE_FLAG_VECTPULL))
+    is_mlock = property(lambda self: self._flag(ICD.TRACE_FLAG_MLOCK))
+    is_vpa = property(lambda self: self._flag(ICD.TRACE_FLAG_SYNC_VPA))
+    is_am8 = property(lambda self: self._flag(ICD.TRACE_FLAG_CSOB_M))
+    is_xy8 = property(lambda self: self._flag(ICD.TRACE_FLAG_CSOB_X))
+    is_rdy = property(lambda self: self._flag(ICD.TRACE_FLAG_RDY))
+
+    def __repr__(self):
+        return "TraceView(CBA={:02x}, CA={:04x}, CD={:02x}, MAH={:02x}, sta={:02x}, ctr={:02x})".format(
+                    self.CBA, self.CA, self.CD, self.MAH, self.sta_flags, self.ctr_flags)
+
+
+# Array of trace records.
+# Indexing by an integer gives a TraceView; by a slice, index array or a boolean mask gives a TraceArray.
+class TraceArray:
+    # recs: NumPy array of TRACE_DTYPE, or None for an empty trace
+    def __init__(self, recs=None):
+        self.recs = np.zeros(0, dtype=TRACE_DTYPE) if recs is None else recs
+        # records appended but not yet merged into self.recs
+        self.pending = []
+
+    # Create from the packed 7-byte records, e.g. from ICD.drain_tracebuffer().
+    # The data is copied.
+    @classmethod
+    def from_bytes(cls, buf):
+        return cls(np.frombuffer(bytes(buf), dtype=TRACE_DTYPE).copy())
+
+    # Create from a list of ICD.TraceReg or TraceView.
+    @classmethod
+    def from_records(cls, tbufs):
+        recs = np.zeros(len(tbufs), dtype=TRACE_DTYPE)
+        for i, tb in enumerate(tbufs):
+            recs[i] = (tb.sta_flags, tb.ctr_flags, tb.CD, tb.CA, tb.MAH, tb.CBA)
+        return cls(recs)
+
+    # Append packed 7-byte records (bytes) or another TraceArray at the end.
+    # The merging is postponed until the records are accessed, so many small appends stay cheap.
+    def append(self, recs):
+        if isinstance(recs, TraceArray):
+            recs = recs.array()
+        else:
+            recs = np.frombuffer(bytes(recs), dtype=TRACE_DTYPE)
+        self.pending.append(recs)
+
+    # Return the underlying NumPy structured array (with all appended records).
+    def array(self):
+        if len(self.pending) > 0:
+            self.recs = np.concatenate([ self.recs ] + self.pending)
+            self.pending = []
+        return self.recs
+
+    # Return the packed 7-byte records.
+    def tobytes(self):
+        return self.array().tobytes()
+
+    def __len__(self):
+        return len(self.recs) + sum(len(p) for p in self.pending)
+
+    def __getitem__(self, idx):
+        recs = self.array()
+        if isinstance(idx, (int, np.integer)):
+            r = recs[idx]
+            return TraceView(int(r['sta']), int(r['ctr']), int(r['CD']), int(r['CA']), int(r['MAH']), int(r['CBA']))
+        return TraceArray(recs[idx])
+
+    def __iter__(self):
+        recs = self.array()
+        # tolist() converts the whole array to python ints at once - much faster than per-element access
+        for (sta, ctr, CD, CA, MAH, CBA) in recs.tolist():
+            yield TraceView(sta, ctr, CD, CA, MAH, CBA)
+
+    # Columns, as NumPy arrays
+    @property
+    def sta_flags(self):
+        return self.array()['sta']
+
+    @property
+    def ctr_flags(self):
+        return self.array()['ctr']
+
+    @property
+    def CD(self):
+        return self.array()['CD']
+
+    @property
+    def CA(self):
+        return self.array()['CA']
+
+    @property
+    def MAH(self):
+        return self.array()['MAH']
+
+    @property
+    def CBA(self):
+        return self.array()['CBA']
+
+    # 24-bit CPU address CBA:CA
+    @property
+    def address(self):
+        recs = self.array()
+        return (recs['CBA'].astype(np.uint32) << 16) | recs['CA']
+
+    # Combination of the status and ctrl flags, as in ICD.TraceReg.tr_flag
+    @property
+    def tr_flag(self):
+        recs = self.array()
+        return recs['sta'].astype(np.uint16) | (recs['ctr'].astype(np.uint16) << 8)
+
+    # Boolean mask of the records that have all the bits of the flag f (ICD.TRACE_FLAG_*)
+    def flag(self, f):
+        if f < 256:
+            return (self.array()['sta'] & f) == f
+        if (f & 0xFF) == 0:
+            return (self.array()['ctr'] & (f >> 8)) == (f >> 8)
+        return (self.tr_flag & f) == f
+
+    is_sync = property(lambda self: self.flag(ICD.TRACE_FLAG_ISYNC))
+    is_resetn = property(lambda self: self.flag(ICD.TRACE_FLAG_RESETN))
+    is_irqn = property(lambda self: self.flag(ICD.TRACE_FLAG_IRQN))
+    is_nmin = property(lambda self: self.flag(ICD.TRACE_FLAG_NMIN))
+    is_abortn = property(lambda self: self.flag(ICD.TRACE_FLAG_ABORTN))
+    is_read_nwrite = property(lambda self: self.flag(ICD.TRACE_FLAG_RWN))
+    is_emu8 = property(lambda self: self.flag(ICD.TRACE_FLAG_EF))
+    is_nat16 = property(lambda self: ~self.flag(ICD.TRACE_FLAG_EF))
+    is_vda = property(lambda self: self.flag(ICD.TRACE_FLAG_VDA))
+    is_vectpull = property(lambda self: self.flag(ICD.TRACE_FLAG_VECTPULL))
+    is_mlock = property(lambda self: self.flag(ICD.TRACE_FLAG_MLOCK))
+    is_vpa = property(lambda self: self.flag(ICD.TRACE_FLAG_SYNC_VPA))
+    is_am8 = property(lambda self: self.flag(ICD.TRACE_FLAG_CSOB_M))
+    is_xy8 = property(lambda self: self.flag(ICD.TRACE_FLAG_CSOB_X))
+    is_rdy = property(lambda self: self.flag(ICD.TRACE_FLAG_RDY))
+
+    # Indices of the instruction starts (SYNC cycles)
+    def sync_indices(self):
+        return np.flatnonzero(self.is_sync)
+
+    # Boolean mask of the records with the 24-bit CPU address in the range [lo, hi)
+    def in_range(self, lo, hi):
+        a = self.address
+        return (a >= lo) & (a < hi)
+
+
+# Ring buffer keeping just the last `capacity` trace records, e.g. for long captures
+# where only the end of the history matters. Accepts the same appends as TraceArray.
+class TraceRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = np.zeros(capacity, dtype=TRACE_DTYPE)
+        self.wpos = 0               # next write position
+        self.total = 0              # count of all records ever appended
+
+    # Append packed 7-byte records (bytes) or a TraceArray.
+    def append(self, recs):
+        if isinstance(recs, TraceArray):
+            recs = recs.array()
+        else:
+            recs = np.frombuffer(bytes(recs), dtype=TRACE_DTYPE)
+        self.total += len(recs)
+        if len(recs) >= self.capacity:
+            # just the tail fits; placed so that the record number n stays at n % capacity
+            self.wpos = self.total % self.capacity
+            self.buf[:] = np.roll(recs[-self.capacity:], self.wpos)
+            return
+        k = min(len(recs), self.capacity - self.wpos)
+        self.buf[self.wpos:self.wpos+k] = recs[0:k]
+        self.buf[0:len(recs)-k] = recs[k:]
+        self.wpos = (self.wpos + len(recs)) % self.capacity
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    # Absolute number of the oldest kept record; the records before it were overwritten.
+    @property
+    def first(self):
+        return self.total - len(self)
+
+    # One record by its absolute number, as TraceView
+    def cycle(self, i):
+        if i < self.first or i >= self.total:
+            raise IndexError("cycle {} is not in the ring".format(i))
+        r = self.buf[i % self.capacity]
+        return TraceView(int(r['sta']), int(r['ctr']), int(r['CD']), int(r['CA']), int(r['MAH']), int(r['CBA']))
+
+    # The records [start, stop) by the absolute numbers, clipped to the kept ones, as TraceArray (a copy).
+    # Unlike array(), just the window is copied.
+    def cycles(self, start, stop):
+        start = max(start, self.first)
+        stop = min(stop, self.total)
+        if stop <= start:
+            return TraceArray()
+        (a, b) = (start % self.capacity, stop % self.capacity)
+        if a < b or b == 0:
+            return TraceArray(self.buf[a:b if b > 0 else self.capacity].copy())
+        return TraceArray(np.concatenate([ self.buf[a:], self.buf[0:b] ]))
+
+    # Return the kept records as TraceArray, from the oldest to the newest.
+    def array(self):
+        if self.total < self.capacity:
+            return TraceArray(self.buf[0:self.total].copy())
+        return TraceArray(np.concatenate([ self.buf[self.wpos:], self.buf[0:self.wpos] ]))
@@ -0,0 +1,94 @@
+import time
+import numpy as np
+from icd import ICD
+from tracearr import TRACE_DTYPE
+
+# Continuous capture of the CPU trace by single-stepping.
+# Many step + read-trace-register pairs are queued in one ICD batch (one USB transfer in the packed mode),
+# and the raw trace records are passed to a sink without any decoding. The sink is anything
+# with append(bytes), e.g. tracefile.TraceWriter, tracearr.TraceArray or tracearr.TraceRing.
+# This records code paths far longer than the 256-entry trace buffer in NORA.
+class TraceCapture:
+    # icd: ICD object
+    # batch_steps: number of CPU cycles stepped per ICD batch
+    # force_*, block_*: CPU signals while stepping, see ICD.cpu_ctrl()
+    def __init__(self, icd, batch_steps=256,
+                    force_irq=False, force_nmi=False, force_abort=False,
+                    block_irq=False, block_nmi=False, block_abort=False):
+        self.icd = icd
+        self.batch_steps = batch_steps
+        self.cpu_sig = dict(force_irq=force_irq, force_nmi=force_nmi, force_abort=force_abort,
+                            block_irq=block_irq, block_nmi=block_nmi, block_abort=block_abort)
+        # statistics of the last capture()
+        self.cycles = 0
+        self.elapsed = 0.0
+        self.stopped_at_until = False
+
+    # Sustained capture rate of the last capture() in cycles/second
+    def rate(self):
+        return self.cycles / self.elapsed if self.elapsed > 0 else 0.0
+
+    # Stop the CPU and read out the trace history before the capture:
+    # the trace buffer followed by the trace register.
+    # Returns the packed 7-byte records.
+    def read_history(self):
+        self.icd.cpu_ctrl(False, False, False, **self.cpu_sig)
+        is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = self.icd.cpu_read_trace()
+        hist = self.icd.drain_tracebuffer() if is_tbr_valid else b''
+        if is_valid:
+            hist += bytes(rawbuf[0:ICD.TRACEREC_SIZE])
+        return hist
+
+    # Step the CPU and capture the cycles; the CPU must be stopped.
+    # n_cycles: number of cycles to capture
+    # sink: object with append(bytes) receiving the packed 7-byte records
+    # until: optional 24-bit CPU address; the capture stops after the SYNC cycle of an instruction there
+    #        (the CPU could have been stepped a few cycles further, up to the end of the batch);
+    #        or a function(records) getting each batch as a TRACE_DTYPE array, and returning the index
+    #        of the cycle to stop after, or None to continue
+    # progress: optional function(cycles_done, elapsed_seconds) called after each batch
+    # Returns the number of captured cycles, or None on an error.
+    def capture(self, n_cycles, sink, until=None, progress=None):
+        icd = self.icd
+        self.cycles = 0
+        self.stopped_at_until = False
+        t0 = time.monotonic()
+        while self.cycles < n_cycles:
+            k = min(self.batch_steps, n_cycles - self.cycles)
+            with icd.batch():
+                reads = []
+                for i in range(0, k):
+                    icd.cpu_ctrl(False, True, False, **self.cpu_sig)
+                    reads.append(icd.cpu_read_trace())
+            recs = bytearray()
+            for rd in reads:
+                is_valid, is_ovf, is_tbr_valid, is_tbr_full, is_cpuruns, rawbuf = rd.result()
+                if is_cpuruns:
+                    print("ERROR: the CPU is running, the capture needs it stopped!")
+                    return None
+                # is_valid=False => the step did not produce a cycle (CPU held?); nothing to record
+                if is_valid:
+                    recs += rawbuf[0:ICD.TRACEREC_SIZE]
+            if len(recs) == 0:
+                print("ERROR: {} CPU steps without any trace record! Is CPU stopped?".format(k))
+                return None
+            if until is not None:
+                arr = np.frombuffer(bytes(recs), dtype=TRACE_DTYPE)
+                if callable(until):
+                    hit = until(arr)
+                else:
+                    hits = np.flatnonzero(((arr['sta'] & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC)
+                                        & (arr['CA'] == (until & 0xFFFF)) & (arr['CBA'] == (until >> 16)))
+                    hit = int(hits[0]) if len(hits) > 0 else None
+                if hit is not None:
+                    recs = recs[0:(hit + 1) * ICD.TRACEREC_SIZE]
+                    self.stopped_at_until = True
+            sink.append(bytes(recs))
+            self.cycles += len(recs) // ICD.TRACEREC_SIZE
+            self.elapsed = time.monotonic() - t0
+            if progress is not None:
+                progress(self.cycles, self.elapsed)
+            if self.stopped_at_until:
+                break
+        self.elapsed = time.monotonic() - t0
+        return self.cycles
@@ -0,0 +1,202 @@
+import os
+import json
+import struct
+import numpy as np
+from tracearr import TRACE_DTYPE, TraceArray, TraceView
+from icd import ICD
+
+# Binary trace recording file (*.x65t).
+#
+# Layout:
+#   header:   magic 'X65TRACE', u16 version, u16 record size, u32 length of the metadata
+#   metadata: JSON object (CPU type, initial bank and mapping registers, CPU registers snapshot, ...),
+#             padded with spaces so that the records start at a multiple of 16 bytes
+#   records:  fixed-size trace records, 7 bytes each (the 56-bit trace word of NORA), in the order of execution
+#
+# The sparse index of instruction starts (SYNC cycles) is stored in the side-car file <name>.idx:
+#   magic 'X65TIDX ', u32 stride, u64 number of cycles covered, u64 number of instructions,
+#   then u64 cycle numbers of the instructions 0, stride, 2*stride, ...
+# The index is rebuilt automatically when it is missing or stale.
+
+MAGIC = b'X65TRACE'
+IDX_MAGIC = b'X65TIDX '
+VERSION = 1
+HDR_FMT = '<8sHHI'
+IDX_HDR_FMT = '<8sIQQ'
+INDEX_STRIDE = 1024         # one index entry per this many instructions
+
+
+# Build the sparse SYNC index over the records.
+# first_instr: number of the instruction of the first SYNC in recs
+# first_cycle: cycle number of recs[0]
+# Returns (list of cycle numbers of the instructions with number % stride == 0, count of SYNCs in recs).
+def _index_chunk(recs, first_instr, first_cycle, stride=INDEX_STRIDE):
+    syncs = np.flatnonzero((recs['sta'] & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC)
+    # the first instruction in this chunk to be indexed
+    k0 = (-first_instr) % stride
+    return ([ first_cycle + int(c) for c in syncs[k0::stride] ], len(syncs))
+
+
+# Write a trace file; records are appended as raw bytes, no per-cycle processing in python.
+# Usage:
+#   with TraceWriter('run.x65t', is_cputype02=False, regs=cpuregs) as tw:
+#       tw.append(icd.drain_tracebuffer())
+class TraceWriter:
+    # fname: the file name
+    # is_cputype02: CPU type
+    # bankregs: initial bank registers $00, $01 (RAMBLOCK, ROMBLOCK)
+    # mapregs: initial mapping registers $9F50-$9F53
+    # regs: CpuRegs snapshot at the start of the trace
+    # meta: dict with any further metadata
+    def __init__(self, fname, is_cputype02=False, bankregs=None, mapregs=None, regs=None, meta=None):
+        self.fname = fname
+        md = { 'cpu': '65C02' if is_cputype02 else '65C816' }
+        if bankregs is not None:
+            md['bankregs'] = list(bankregs)
+        if mapregs is not None:
+            md['mapregs'] = list(mapregs)
+        if regs is not None:
+            md['regs'] = { k: getattr(regs, k) for k in ('AH', 'AL', 'XH', 'XL', 'YH', 'YL', 'SP', 'FL', 'EMU', 'DBR', 'DPR', 'PC') }
+        if meta is not None:
+            md.update(meta)
+        mdbytes = json.dumps(md).encode()
+        hdrlen = struct.calcsize(HDR_FMT) + len(mdbytes)
+        mdbytes += b' ' * ((-hdrlen) % 16)
+        self.f = open(fname, 'wb')
+        self.f.write(struct.pack(HDR_FMT, MAGIC, VERSION, TRACE_DTYPE.itemsize, len(mdbytes)))
+        self.f.write(mdbytes)
+        self.n_cycles = 0
+        self.n_instrs = 0
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Append records: packed 7-byte records (bytes, e.g. from ICD.drain_tracebuffer()), TraceArray,
+    # or a single ICD.TraceReg / TraceView.
+    def append(self, recs):
+        if isinstance(recs, TraceArray):
+            buf = recs.tobytes()
+        elif isinstance(recs, (ICD.TraceReg, TraceView)):
+            buf = TraceView(recs.sta_flags, recs.ctr_flags, recs.CD, recs.CA, recs.MAH, recs.CBA).raw()
+        else:
+            buf = bytes(recs)
+        if len(buf) % TRACE_DTYPE.itemsize != 0:
+            raise ValueError("TraceWriter: length {} is not a multiple of the record size".format(len(buf)))
+        arr = np.frombuffer(buf, dtype=TRACE_DTYPE)
+        (idx, nsync) = _index_chunk(arr, self.n_instrs, self.n_cycles)
+        self.index += idx
+        self.n_instrs += nsync
+        self.n_cycles += len(arr)
+        self.f.write(buf)
+
+    def close(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        write_index(self.fname, self.n_cycles, self.n_instrs, self.index)
+
+
+# Write the side-car index file
+def write_index(fname, n_cycles, n_instrs, index, stride=INDEX_STRIDE):
+    with open(fname + '.idx', 'wb') as f:
+        f.write(struct.pack(IDX_HDR_FMT, IDX_MAGIC, stride, n_cycles, n_instrs))
+        f.write(np.array(index, dtype='<u8').tobytes())
+
+
+# Random-access reader of a trace file; the records are memory-mapped, not loaded.
+class TraceReader:
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            hdr = f.read(struct.calcsize(HDR_FMT))
+            (magic, version, recsize, mdlen) = struct.unpack(HDR_FMT, hdr)
+            if magic != MAGIC or recsize != TRACE_DTYPE.itemsize:
+                raise ValueError("{}: not an X65 trace file".format(fname))
+            self.meta = json.loads(f.read(mdlen).decode())
+        self.data_offset = struct.calcsize(HDR_FMT) + mdlen
+        n = (os.path.getsize(fname) - self.data_offset) // TRACE_DTYPE.itemsize
+        if n > 0:
+            self.recs = np.memmap(fname, dtype=TRACE_DTYPE, mode='r', offset=self.data_offset, shape=(n,))
+        else:
+            self.recs = np.zeros(0, dtype=TRACE_DTYPE)
+        self._load_index()
+
+    def _load_index(self):
+        n = len(self.recs)
+        try:
+            with open(self.fname + '.idx', 'rb') as f:
+                (magic, stride, n_cycles, n_instrs) = struct.unpack(IDX_HDR_FMT, f.read(struct.calcsize(IDX_HDR_FMT)))
+                index = np.frombuffer(f.read(), dtype='<u8')
+                if magic == IDX_MAGIC and n_cycles == n and self._index_valid(index, stride, n_instrs):
+                    self.stride = stride
+                    self.n_instrs = n_instrs
+                    self.index = index
+                    return
+        except (OSError, struct.error):
+            pass
+        # missing or stale -> rebuild (in memory only)
+        (idx, nsync) = _index_chunk(self.recs, 0, 0)
+        self.stride = INDEX_STRIDE
+        self.n_instrs = nsync
+        self.index = np.array(idx, dtype='<u8')
+
+    # Check the loaded index against the records: one entry per stride instructions,
+    # each of them a SYNC cycle, in the increasing order
+    def _index_valid(self, index, stride, n_instrs):
+        if stride <= 0 or len(index) != (n_instrs + stride - 1) // stride:
+            return False
+        if len(index) == 0:
+            return True
+        if index[-1] >= len(self.recs) or np.any(np.diff(index.astype(np.int64)) <= 0):
+            return False
+        sta = self.recs['sta'][index.astype(np.intp)]
+        return bool(np.all((sta & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC))
+
+    def is_cputype02(self) -> bool:
+        return self.meta.get('cpu') == '65C02'
+
+    # number of cycles (records)
+    def __len__(self):
+        return len(self.recs)
+
+    # One cycle as TraceView
+    def cycle(self, i):
+        r = self.recs[i]
+        return TraceView(int(r['sta']), int(r['ctr']), int(r['CD']), int(r['CA']), int(r['MAH']), int(r['CBA']))
+
+    # The range of cycles [start, stop) as TraceArray (still backed by the memory map)
+    def cycles(self, start, stop):
+        return TraceArray(self.recs[start:stop])
+
+    # Cycle number of the instruction k (counted from 0 = the first SYNC in the file)
+    def instr_cycle(self, k):
+        if k < 0 or k >= self.n_instrs:
+            raise IndexError("instruction {} out of the trace".format(k))
+        c = int(self.index[k // self.stride])
+        todo = k % self.stride
+        # scan forward from the indexed instruction, in growing windows
+        win = 4 * (todo + 1)
+        while True:
+            chunk = self.recs[c:c+win]
+            syncs = np.flatnonzero((chunk['sta'] & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC)
+            if len(syncs) > todo:
+                return c + int(syncs[todo])
+            if c + win >= len(self.recs):
+                raise ValueError("{}: the index does not match the records (instruction {})".format(self.fname, k))
+            win *= 4
+
+    # Number of the instruction executing at the cycle i (-1 before the first SYNC)
+    def cycle_instr(self, i):
+        # find the last indexed instruction at or before i
+        j = int(np.searchsorted(self.index, i, side='right')) - 1
+        if j < 0:
+            return -1
+        c = int(self.index[j])
+        chunk = self.recs[c:i+1]
+        nsync = int(np.count_nonzero((chunk['sta'] & ICD.TRACE_FLAG_ISYNC) == ICD.TRACE_FLAG_ISYNC))
+        return j * self.stride + nsync - 1
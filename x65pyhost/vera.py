@@ -1,3 +1,5 @@
+from icd import ICD
+
 
 class VERA:
     ADDRx_L = 0x20
@@ -123,6 +125,55 @@ class VERA:
         # SPI
         print("  SPI_CTRL=0x{:02X}".format(regs[VERA.SPI_CTRL]))
 
+    # Read the address ADDRx_L/M/H of the data port selected by ADDRSEL, and CTRL, without touching the data ports:
+    # ADDRx_H is read by a non-incrementing read, so the read-ahead stays on it.
+    # Returns [ADDRx_L, ADDRx_M, ADDRx_H, CTRL], or a Deferred of it in the batch mode.
+    def read_addr(self):
+        return ICD.concat([ self.icd.ioregs_read(VERA.ADDRx_L, 2), self.icd.ioregs_read_fifo(VERA.ADDRx_H, 1),
+                            self.icd.ioregs_read(VERA.CTRL, 1) ])
+
+    # Read the register state of VERA: both data port addresses and both DCSEL pages,
+    # by switching ADDRSEL/DCSEL in CTRL, which is restored at the end. The data ports are not read.
+    # Returns dict (JSON-serializable) for write_state().
+    def read_state(self):
+        icd = self.icd
+        ctrl = icd.ioregs_read(VERA.CTRL, 1)[0] & 0x7F
+        with icd.batch():
+            addrs = []
+            for sel in (0, 1):
+                icd.ioregs_write(VERA.CTRL, [ (ctrl & ~VERA.DC_ADDRSEL) | sel ])
+                addrs.append(self.read_addr())
+            dcs = []
+            for dc in (0, 1):
+                icd.ioregs_write(VERA.CTRL, [ (ctrl & ~VERA.DC_SEL) | (dc << 1) ])
+                dcs.append(icd.ioregs_read(VERA.DC_VIDEO, 4))
+            icd.ioregs_write(VERA.CTRL, [ ctrl ])
+            irq = icd.ioregs_read(VERA.IEN, 3)
+            # L0/L1 and AUDIO_CTRL, then AUDIO_RATE without the read-ahead into AUDIO_DATA
+            layers = ICD.concat([ icd.ioregs_read(VERA.L0_CONFIG, VERA.AUDIO_CTRL - VERA.L0_CONFIG + 1),
+                                  icd.ioregs_read_fifo(VERA.AUDIO_RATE, 1) ])
+        return { 'ctrl': ctrl, 'addr': [ list(a.result()[0:3]) for a in addrs ], 'dc': [ list(d.result()) for d in dcs ],
+                 'ien': irq.result()[0], 'irqline': irq.result()[2], 'layers': list(layers.result()) }
+
+    # Write the register state from read_state(); ISR is not written (writes clear the flags)
+    def write_state(self, st):
+        icd = self.icd
+        ctrl = st['ctrl'] & 0x7F
+        with icd.batch():
+            for dc in (0, 1):
+                icd.ioregs_write(VERA.CTRL, [ (ctrl & ~VERA.DC_SEL) | (dc << 1) ])
+                icd.ioregs_write(VERA.DC_VIDEO, st['dc'][dc])
+            icd.ioregs_write(VERA.IEN, [ st['ien'] ])
+            icd.ioregs_write(VERA.IRQLINE_L, [ st['irqline'] ])
+            layers = st['layers']
+            icd.ioregs_write(VERA.L0_CONFIG, layers[0:VERA.AUDIO_CTRL - VERA.L0_CONFIG])
+            # AUDIO_CTRL bit 7 written resets the FIFO
+            icd.ioregs_write(VERA.AUDIO_CTRL, [ layers[-2] & 0x3F, layers[-1] ])
+            for sel in (0, 1):
+                icd.ioregs_write(VERA.CTRL, [ (ctrl & ~VERA.DC_ADDRSEL) | sel ])
+                icd.ioregs_write(VERA.ADDRx_L, st['addr'][sel])
+            icd.ioregs_write(VERA.CTRL, [ ctrl ])
+
     def vpoke(self, addr, data):
         self.icd.ioregs_write(VERA.ADDRx_L, [addr & 0xFF, (addr >> 8) & 0xFF, (addr >> 16) & 0x01])
         self.icd.iopoke(VERA.DATA0, data)
@@ -131,4 +182,29 @@ class VERA:
         self.icd.ioregs_write(VERA.ADDRx_L, [addr & 0xFF, (addr >> 8) & 0xFF, 
                                              ((addr >> 16) & 0x01) | (inc << 4)])
 
+    # Write a block of bytes to VRAM, starting at addr, via the auto-incrementing DATA0 port.
+    # Note: changes ADDR0 (and uses ADDRSEL=0, as vpoke).
+    def vram_write(self, addr, buf):
+        with self.icd.batch():
+            self.vpoke0_setup(addr, 1)
+            self.icd.ioregs_write_fifo(VERA.DATA0, buf)
+
+    # Read a block of n bytes from VRAM, starting at addr, via the auto-incrementing DATA0 port.
+    # The ICD over-reads one byte at the end of each transaction, which also increments ADDR0,
+    # so the address is set up again before each chunk.
+    # port: 1 => use DATA1; it must be the port selected by ADDRSEL (the ADDRx registers are written)
+    def vram_read(self, addr, n, port=0):
+        parts = []
+        with self.icd.batch():
+            k = 0
+            while k < n:
+                self.vpoke0_setup(addr + k, 1)
+                parts.append(self.icd.ioregs_read_fifo(VERA.DATA0 + port, min(n-k, ICD.MAXREQSIZE)))
+                k = k + ICD.MAXREQSIZE
+            data = ICD.concat(parts)
+        # outside of any batch the result is ready now; n == 0 gives the empty bytearray right away
+        if isinstance(data, ICD.Deferred) and self.icd.batch_queue is None:
+            return data.result()
+        return data
+
 
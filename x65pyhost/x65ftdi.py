@@ -1,4 +1,7 @@
 import pyftdi.spi
+from pyftdi.ftdi import Ftdi
+from struct import pack as spack
+import linkspeed
 
 # Documenation pyftdi: SPI API
 # https://eblot.github.io/pyftdi/api/spi.html
@@ -24,32 +27,87 @@ class X65Ftdi:
 
     PINS_ALL = PIN_NORAFCSN | PIN_NORADONE | PIN_NORARSTN | PIN_ICD2NORAROM | PIN_ICDCSN | PIN_AURARSTN | PIN_AURAFCSN | PIN_VERAFCSN | PIN_VAFCDONE | PIN_VERARSTN | PIN_CPUTYPE02
 
-    def __init__(self, url = 'ftdi://ftdi:2232/1', log_file_name=None):
-        if url is not None:
-            self.openFtdi(url)
+    # Packed mode: max. number of bytes clocked-in by a single MPSSE command buffer
+    # before we read the response back. Keeps the FT2232H RX FIFO (4kB) from filling up
+    # and stalling the MPSSE engine while we are still writing commands.
+    PACKED_MAX_READ = 4096
+    # Max. length of one MPSSE data-clocking command (16-bit length field)
+    MPSSE_MAX_DATALEN = 65536
+
+    # SPI clock of the ICD link if no calibrated profile is available (see linkspeed.py)
+    DEFAULT_SPI_FREQ = 1E6
+
+    # url: pyftdi URL of the FTDI device; None => do not open now (call openFtdi() later).
+    # log_file_name: optional log file of all SPI traffic.
+    # packed: True => each ICD transaction (chip-select edges + SPI payload) is packed
+    #         into a single MPSSE command buffer and sent in one USB write (plus one read).
+    #         False => legacy mode with separate gpio/spi calls (3-4 USB round trips per transaction).
+    # freq: SPI clock in Hz; None => the calibrated frequency from the link profile cache
+    #       if the board has been calibrated (do-linkcal.py), otherwise DEFAULT_SPI_FREQ.
+    def __init__(self, url = 'ftdi://ftdi:2232/1', log_file_name=None, packed=True, freq=None):
+        self.packed = packed
+        self.freq = freq
         # open log file?
         if log_file_name is not None:
             self.logf = open(log_file_name, 'a')
             self.logf.write('\n\nStart of log\n')
         else:
             self.logf = None
+        if url is not None:
+            self.openFtdi(url, freq=freq)
 
-    def openFtdi(self, url = 'ftdi://ftdi:2232/1'):
+    # spi: optional pre-made SPI controller object with the pyftdi SpiController interface
+    #      (e.g. a recording fake for testing); by default a new pyftdi SpiController is created.
+    # freq: SPI clock in Hz, see __init__()
+    def openFtdi(self, url = 'ftdi://ftdi:2232/1', spi=None, freq=None):
         # Instantiate a SPI controller
-        self.spi = pyftdi.spi.SpiController()
+        self.spi = pyftdi.spi.SpiController() if spi is None else spi
+        self.url = url
 
         # Configure the first interface (IF/1) of the first FTDI device as a
         # SPI master
         self.spi.configure(url)
 
-        # Get a SPI port to a SPI slave w/ /CS on A*BUS3 and SPI mode 0 @ 6MHz
-        self.slave = self.spi.get_port(cs=0, freq=1E6, mode=0)
+        # SPI clock: explicit, or calibrated for this board, or the safe default
+        if freq is None:
+            freq = linkspeed.cached_freq(self.board_key())
+        if freq is None:
+            freq = X65Ftdi.DEFAULT_SPI_FREQ
+
+        # Get a SPI port to a SPI slave w/ /CS on A*BUS3 and SPI mode 0
+        self.slave = self.spi.get_port(cs=0, freq=freq, mode=0)
+        self.freq = self.slave.frequency
 
         # Get GPIO port to manage extra pins, use A*BUS4 as GPO, A*BUS4 as GPI
         self.gpio = self.spi.get_gpio()
 
         self.pinout_idle()
 
+        if self.packed:
+            # The packed transactions bypass SpiPort.exchange(), which would otherwise
+            # program the SPI clock divider on the first use -> set it up now.
+            self.spi.ftdi.set_frequency(self.slave.frequency)
+
+    # Change the SPI clock of the ICD link.
+    # freq: frequency in Hz; limited to the max. frequency of the FTDI chip.
+    def set_spi_freq(self, freq):
+        self.slave.set_frequency(freq)
+        if self.packed:
+            # the packed transactions do not go through SpiPort.exchange() -> set the divider now
+            self.spi.ftdi.set_frequency(self.slave.frequency)
+        self.freq = self.slave.frequency
+
+    # Key identifying the board in the link profile cache:
+    # the FTDI URL, plus the serial number of the FTDI chip if available.
+    def board_key(self):
+        try:
+            serial = self.spi.ftdi.usb_dev.serial_number
+        except Exception:
+            serial = None
+        if serial:
+            return '{}#{}'.format(self.url, serial)
+        return self.url
+
     # // configure the high-byte (ACBUSx) to route SPI to the ICD,
     # // and keep ICD high (deselect).
     def pinout_idle(self):
@@ -95,6 +153,110 @@ class X65Ftdi:
             self.logf.write('  WO.out {}\n'.format( ''.join('{:02x} '.format(x) for x in out) ))
         self.slave.write(out,  start=False, stop=False)
 
+    # Run one complete ICD transaction: select the ICD, clock the SPI bytes, deselect the ICD.
+    # out: bytes to send
+    # readlen: number of bytes to exchange and return (full duplex); 0 => write-only transaction
+    # Returns the received bytes, or None for a write-only transaction.
+    def icd_transfer(self, out, readlen=0):
+        return self.icd_transfer_many([ (out, readlen) ])[0]
+
+    # Run a sequence of complete ICD transactions, in order.
+    # txns: list of (out, readlen) tuples, see icd_transfer().
+    # Returns the list of responses, one per transaction.
+    # In the packed mode the whole sequence goes out in as few USB transfers as possible.
+    def icd_transfer_many(self, txns):
+        if self.packed:
+            return self._mpsse_transfer_many(txns)
+        # legacy mode: separate gpio and spi calls for each transaction
+        rxs = []
+        for out, readlen in txns:
+            self.icd_chip_select()
+            if readlen > 0:
+                rxs.append(self.spiexchange(out, readlen))
+            else:
+                self.spiwriteonly(out)
+                rxs.append(None)
+            self.icd_chip_deselect()
+        return rxs
+
+    # Packed mode implementation of icd_transfer_many():
+    # the ACBUS chip-select edges (SET_BITS_HIGH) and the SPI clocking commands of all transactions
+    # are concatenated into one MPSSE command buffer, written in one USB write, and the responses
+    # are read back in one USB read. Only if the responses exceed PACKED_MAX_READ the buffer is split
+    # into more round-trips; the ICD stays selected across such a split.
+    def _mpsse_transfer_many(self, txns):
+        ftdi = self.spi.ftdi
+        # direction of ACBUSx pins, as configured in pinout_idle()
+        dir_high = (self.spi.direction >> 8) & 0xFF
+        # drive low ICD2NORAROM and ICDCSN => ICD selected
+        cs_select = bytes([ Ftdi.SET_BITS_HIGH, 0x00, dir_high ])
+        # drive low ICD2NORAROM, drive high ICDCSN => ICD deselected
+        cs_deselect = bytes([ Ftdi.SET_BITS_HIGH, (X65Ftdi.PIN_ICDCSN >> 8) & 0xFF, dir_high ])
+
+        cmd = bytearray()           # MPSSE command buffer
+        cmd_rdlen = 0               # number of bytes the commands in cmd will return
+        rxbuf = bytearray()         # all received bytes, of all transactions
+
+        def flush():
+            nonlocal cmd, cmd_rdlen, rxbuf
+            if cmd_rdlen > 0:
+                cmd.append(Ftdi.SEND_IMMEDIATE)
+            ftdi.write_data(cmd)
+            if cmd_rdlen > 0:
+                data = ftdi.read_data_bytes(cmd_rdlen, 4)
+                if len(data) != cmd_rdlen:
+                    raise IOError('ICD: short read from FTDI ({} of {} bytes)'.format(len(data), cmd_rdlen))
+                rxbuf += data
+            cmd = bytearray()
+            cmd_rdlen = 0
+
+        for out, readlen in txns:
+            out = bytes(out)
+            cmd += cs_select
+            if readlen > 0:
+                # full-duplex exchange; pad the output with zeros to the read length
+                exlen = max(len(out), readlen)
+                if len(out) < exlen:
+                    out = bytes(out) + bytes(exlen - len(out))
+                k = 0
+                while k < exlen:
+                    n = min(exlen - k, X65Ftdi.PACKED_MAX_READ - cmd_rdlen)
+                    cmd += spack('<BH', Ftdi.RW_BYTES_PVE_NVE_MSB, n - 1)
+                    cmd += out[k:k+n]
+                    cmd_rdlen += n
+                    k += n
+                    if cmd_rdlen >= X65Ftdi.PACKED_MAX_READ:
+                        flush()
+            else:
+                # write-only
+                k = 0
+                while k < len(out):
+                    n = min(len(out) - k, X65Ftdi.MPSSE_MAX_DATALEN)
+                    cmd += spack('<BH', Ftdi.WRITE_BYTES_NVE_MSB, n - 1)
+                    cmd += out[k:k+n]
+                    k += n
+            cmd += cs_deselect
+        flush()
+
+        # split the received bytes back to the transactions
+        rxs = []
+        k = 0
+        for out, readlen in txns:
+            if readlen > 0:
+                exlen = max(len(out), readlen)
+                rx = rxbuf[k:k+readlen]
+                k += exlen
+            else:
+                rx = None
+            rxs.append(rx)
+            if self.logf is not None:
+                self.logf.write('SELECT\n')
+                self.logf.write('  {}.out {}\n'.format('EX' if rx is not None else 'WO', ''.join('{:02x} '.format(x) for x in out) ))
+                if rx is not None:
+                    self.logf.write('  EX.inp {}\n'.format( ''.join('{:02x} '.format(x) for x in rx) ))
+                self.logf.write('DESEL\n')
+        return rxs
+
     # Read the CPUTYPE02 signal available on FTDI pin ACBUS5.
     # Returns TRUE in case of 65C02, and FALSE in case of 65C816 CPU is installed on the target board.
     def is_cputype02(self):